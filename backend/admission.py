@@ -0,0 +1,222 @@
+"""Admission control that keeps checkout fast while reports run.
+
+Every API request belongs to a route class with its own concurrency limit and
+wait queue, so slow reports can only hold their own slots and never delay an
+invoice:
+
+* ``checkout`` - invoice and cart writes, never shed for pressure
+* ``lookup``   - every other read or write
+* ``report``   - reports, exports and admin jobs; shed first
+
+A request that finds its class full waits in that class's queue for up to
+``max_wait`` seconds. A request whose queue is full, or that waits too long,
+gets ``503`` with ``Retry-After``. The server is under pressure when the event
+loop lags by more than ``lag_threshold`` seconds or checkout requests are
+queueing. Under pressure, sheddable classes are turned away at once, so the
+loop and the Mongo pool stay free for checkout.
+
+Health probes, metrics, the profiler's endpoints and the long-polling change
+feed bypass admission, so diagnostics still answer while the loop lags.
+CPU-bound report work runs on a small thread pool through ``offload``. The
+event loop then keeps serving requests between the interpreter's thread
+switches instead of waiting for the whole computation.
+"""
+import asyncio
+import functools
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from starlette.responses import JSONResponse
+
+EXEMPT_PREFIXES = ("/api/health/", "/api/metrics/", "/api/admin/profiles", "/api/events")
+REPORT_PREFIXES = ("/api/reports/", "/api/exports/", "/api/admin/")
+CHECKOUT_PREFIXES = ("/api/invoices",)
+LAG_SAMPLE_SECONDS = 0.1
+
+
+class RouteClass:
+    def __init__(self, name: str, concurrency: int, queue_size: int, max_wait: float, sheddable: bool):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.sheddable = sheddable
+        self.in_flight = 0
+        self._waiters: "deque[asyncio.Future]" = deque()
+        self.admitted = 0
+        self.rejected = 0
+        self.shed = 0
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self) -> bool:
+        if self.in_flight < self.concurrency and not self._waiters:
+            self.in_flight += 1
+            self.admitted += 1
+            return True
+        if len(self._waiters) >= self.queue_size:
+            self.rejected += 1
+            return False
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.max_wait)
+        except asyncio.TimeoutError:
+            # Unless it was handed a slot just as the wait ran out
+            if self._withdraw(waiter):
+                self.rejected += 1
+                return False
+        except asyncio.CancelledError:
+            # The client went away; a slot it was already handed goes to the next waiter
+            if not self._withdraw(waiter):
+                self.release()
+            raise
+        self.admitted += 1
+        return True
+
+    def _withdraw(self, waiter: asyncio.Future) -> bool:
+        """Leave the queue; False if ``waiter`` already holds a slot"""
+        if waiter.done() and not waiter.cancelled():
+            return False
+        waiter.cancel()
+        self._waiters.remove(waiter)
+        return True
+
+    def release(self):
+        # Hand the slot straight to the oldest waiter so it cannot be overtaken
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "concurrency": self.concurrency,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "shed": self.shed,
+        }
+
+
+class AdmissionController:
+    def __init__(self, classes: Dict[str, RouteClass], lag_threshold: float = 0.1, retry_after: int = 5):
+        self.classes = classes
+        self.lag_threshold = lag_threshold
+        self.retry_after = retry_after
+        self.loop_lag = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._measure_lag())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def classify(self, method: str, path: str) -> Optional[RouteClass]:
+        if method == "OPTIONS" or not path.startswith("/api/") or path.startswith(EXEMPT_PREFIXES):
+            return None
+        if path.startswith(REPORT_PREFIXES):
+            return self.classes["report"]
+        if method != "GET" and path.startswith(CHECKOUT_PREFIXES):
+            return self.classes["checkout"]
+        return self.classes["lookup"]
+
+    def under_pressure(self) -> bool:
+        return self.loop_lag > self.lag_threshold or self.classes["checkout"].waiting > 0
+
+    async def admit(self, route_class: RouteClass) -> bool:
+        if route_class.sheddable and self.under_pressure():
+            route_class.shed += 1
+            return False
+        return await route_class.acquire()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "loop_lag_ms": round(self.loop_lag * 1000, 1),
+            "under_pressure": self.under_pressure(),
+            "classes": {name: route_class.stats() for name, route_class in self.classes.items()},
+        }
+
+    async def _measure_lag(self):
+        """Track how late the loop wakes a sleeper; the larger of now and a decaying recent peak"""
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(LAG_SAMPLE_SECONDS)
+            lag = max(loop.time() - started - LAG_SAMPLE_SECONDS, 0.0)
+            self.loop_lag = max(lag, self.loop_lag * 0.8)
+
+
+class AdmissionMiddleware:
+    def __init__(self, app, controller: AdmissionController):
+        self.app = app
+        self.controller = controller
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        route_class = self.controller.classify(scope["method"], scope["path"])
+        if route_class is None:
+            await self.app(scope, receive, send)
+            return
+
+        if not await self.controller.admit(route_class):
+            response = JSONResponse(
+                {"detail": f"Server is busy, {route_class.name} requests are being limited. Please retry shortly"},
+                status_code=503,
+                headers={"Retry-After": str(self.controller.retry_after)}
+            )
+            await response(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            route_class.release()
+
+
+_cpu_pool: Optional[ThreadPoolExecutor] = None
+
+
+async def offload(function: Callable, *args, **kwargs):
+    """Run CPU-bound report work on the report thread pool"""
+    global _cpu_pool
+    if _cpu_pool is None:
+        _cpu_pool = ThreadPoolExecutor(
+            max_workers=int(os.environ.get("REPORT_CPU_WORKERS", "2")), thread_name_prefix="report-cpu"
+        )
+    return await asyncio.get_running_loop().run_in_executor(_cpu_pool, functools.partial(function, *args, **kwargs))
+
+
+def admission_settings_from_env() -> Dict[str, Any]:
+    def route_class(name: str, concurrency: int, queue_size: int, max_wait: float, sheddable: bool) -> RouteClass:
+        prefix = f"ADMISSION_{name.upper()}"
+        return RouteClass(
+            name,
+            concurrency=int(os.environ.get(f"{prefix}_CONCURRENCY", concurrency)),
+            queue_size=int(os.environ.get(f"{prefix}_QUEUE", queue_size)),
+            max_wait=float(os.environ.get(f"{prefix}_MAX_WAIT_SECONDS", max_wait)),
+            sheddable=sheddable,
+        )
+
+    return {
+        "classes": {
+            "checkout": route_class("checkout", 64, 256, 10, sheddable=False),
+            "lookup": route_class("lookup", 32, 128, 2, sheddable=False),
+            "report": route_class("report", 2, 8, 5, sheddable=True),
+        },
+        "lag_threshold": float(os.environ.get("ADMISSION_LAG_THRESHOLD_SECONDS", "0.1")),
+        "retry_after": int(os.environ.get("ADMISSION_RETRY_AFTER_SECONDS", "5")),
+    }
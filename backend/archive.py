@@ -0,0 +1,224 @@
+"""Hot/cold archival of completed invoices.
+
+Completed invoices older than a configurable age are moved out of the hot
+``invoices`` collection into yearly partitions named ``invoices_archive_<year>``.
+Alongside the move we keep:
+
+* ``invoice_archive_index`` - invoice id -> partition, so single lookups
+  fall back to the archive in one extra indexed read
+* ``invoice_rollups``       - per branch per day totals of archived invoices
+* ``invoice_archive_totals`` - per branch archived invoice count, used to keep
+  invoice numbering and dashboard totals intact once history leaves ``invoices``
+
+Every step is idempotent, so an interrupted run is repaired by the next one.
+"""
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from database import current_tenant_id
+from money import MONEY_SCALE
+from orchestration import gather_queries
+
+ARCHIVE_PREFIX = "invoices_archive_"
+PARTITION_REFRESH_SECONDS = 300
+PARTITIONS_STAMP_ID = "invoice_partitions"
+
+# Partition names per tenant. Creating a partition bumps a version stamp in
+# ``archive_versions``, which every process checks before using its list, so
+# a partition another worker created is seen by the next query. The list is
+# also reloaded every PARTITION_REFRESH_SECONDS.
+_known_partitions = {}
+
+
+def _partitions_state() -> dict:
+    return _known_partitions.setdefault(
+        current_tenant_id(), {"names": set(), "version": None, "loaded_at": float("-inf")}
+    )
+
+
+def partition_name(created_at: datetime) -> str:
+    return f"{ARCHIVE_PREFIX}{created_at.year}"
+
+
+async def _partitions_version(db) -> int:
+    stamp = await db.archive_versions.find_one({"_id": PARTITIONS_STAMP_ID}) or {}
+    return stamp.get("version", 0)
+
+
+async def refresh_partitions(db) -> set:
+    # The version is read first, so a list is never stored under a newer version than it reflects
+    version = await _partitions_version(db)
+    names = await db.list_collection_names(filter={"name": {"$regex": f"^{ARCHIVE_PREFIX}"}})
+    state = _partitions_state()
+    state["names"] = set(names)
+    state["version"] = version
+    state["loaded_at"] = time.monotonic()
+    return state["names"]
+
+
+async def partitions_for_range(db, start: Optional[datetime], end: Optional[datetime]) -> List[str]:
+    """Archive partitions that may hold invoices created between ``start`` and ``end``"""
+    state = _partitions_state()
+    if (time.monotonic() - state["loaded_at"] > PARTITION_REFRESH_SECONDS
+            or await _partitions_version(db) != state["version"]):
+        await refresh_partitions(db)
+    first_year = start.year if start else 0
+    last_year = end.year if end else 9999
+    return sorted(
+        name for name in state["names"]
+        if first_year <= int(name[len(ARCHIVE_PREFIX):]) <= last_year
+    )
+
+
+async def find_invoice(db, invoice_id: str, projection: Optional[dict] = None) -> Optional[dict]:
+    """Find an invoice in the hot collection, falling back to the archive"""
+    invoice = await db.invoices.find_one({"id": invoice_id}, projection)
+    if invoice:
+        return invoice
+    entry = await db.invoice_archive_index.find_one({"id": invoice_id})
+    if not entry:
+        return None
+    return await db[entry["partition"]].find_one({"id": invoice_id}, projection)
+
+
+async def find_invoices(db, query: dict, start: Optional[datetime], end: Optional[datetime],
+                        length: int = 1000) -> List[dict]:
+    """Run an invoice query over the hot collection and the archive partitions covering the range"""
+    collections = [db.invoices]
+    if query.get("status", "completed") == "completed":
+        collections += [db[partition] for partition in await partitions_for_range(db, start, end)]
+    results = await gather_queries({
+        collection.name: (lambda collection=collection: collection.find(query).to_list(length))
+        for collection in collections
+    })
+    return [invoice for invoices in results.values() for invoice in invoices]
+
+
+async def aggregate_invoices(db, pipeline: List[dict], start: Optional[datetime], end: Optional[datetime]) -> List[dict]:
+    """Run an aggregation over the hot collection and the archive partitions covering the range.
+
+    Each collection returns its own groups; callers merge groups that span collections.
+    """
+    collections = [db.invoices] + [db[partition] for partition in await partitions_for_range(db, start, end)]
+    results = await gather_queries({
+        collection.name: (lambda collection=collection: collection.aggregate(pipeline).to_list(None))
+        for collection in collections
+    })
+    return [row for rows in results.values() for row in rows]
+
+
+async def invoice_sources(db, start: Optional[datetime], end: Optional[datetime]) -> list:
+    """Collections to scan, oldest first, for completed invoices in a range"""
+    partitions = await partitions_for_range(db, start, end)
+    return [db[partition] for partition in partitions] + [db.invoices]
+
+
+async def archived_invoice_count(db, branch_id: str = "") -> int:
+    if branch_id:
+        totals = await db.invoice_archive_totals.find_one({"branch_id": branch_id})
+        return totals["invoice_count"] if totals else 0
+    totals = await db.invoice_archive_totals.find().to_list(None)
+    return sum(total["invoice_count"] for total in totals)
+
+
+async def archive_completed_invoices(db, older_than_days: int, batch_size: int = 500) -> dict:
+    """Move completed invoices older than ``older_than_days`` into the archive"""
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    archived = 0
+    touched_branches = set()
+
+    while True:
+        batch = await db.invoices.find(
+            {"status": "completed", "created_at": {"$lt": cutoff}}
+        ).sort("created_at", ASCENDING).limit(batch_size).to_list(batch_size)
+        if not batch:
+            break
+
+        by_partition: Dict[str, List[dict]] = {}
+        for invoice in batch:
+            invoice.pop("_id", None)
+            by_partition.setdefault(partition_name(invoice["created_at"]), []).append(invoice)
+
+        for partition, invoices in by_partition.items():
+            await _ensure_partition(db, partition)
+            try:
+                await db[partition].insert_many(invoices, ordered=False)
+            except BulkWriteError as exc:
+                # Duplicates are copies left behind by an interrupted run
+                if any(error["code"] != 11000 for error in exc.details["writeErrors"]):
+                    raise
+            await db.invoice_archive_index.bulk_write([
+                UpdateOne(
+                    {"id": invoice["id"]},
+                    {"$set": {"id": invoice["id"], "invoice_number": invoice["invoice_number"], "partition": partition}},
+                    upsert=True
+                )
+                for invoice in invoices
+            ], ordered=False)
+            await _rebuild_rollups(db, partition, invoices)
+
+        # Totals first: until the delete, invoices are counted twice, which only skips invoice numbers
+        branches = {invoice.get("branch_id", "main") for invoice in batch}
+        for branch_id in branches:
+            await _rebuild_archive_totals(db, branch_id)
+
+        ids = [invoice["id"] for invoice in batch]
+        await db.invoices.delete_many({"id": {"$in": ids}, "status": "completed"})
+        archived += len(batch)
+        touched_branches.update(branches)
+
+    await refresh_partitions(db)
+    return {"archived": archived, "cutoff": cutoff, "branches": sorted(touched_branches)}
+
+
+async def _ensure_partition(db, partition: str):
+    if partition in _partitions_state()["names"] or partition in await refresh_partitions(db):
+        return
+    await db[partition].create_index("id", unique=True)
+    await db[partition].create_index([("status", ASCENDING), ("created_at", DESCENDING)])
+    await db[partition].create_index([("branch_id", ASCENDING), ("created_at", DESCENDING)])
+    # Before any invoice moves in, so other processes include the partition in their next query
+    await db.archive_versions.update_one({"_id": PARTITIONS_STAMP_ID}, {"$inc": {"version": 1}}, upsert=True)
+    _partitions_state()["names"].add(partition)
+
+
+async def _rebuild_rollups(db, partition: str, invoices: List[dict]):
+    """Recompute the daily rollups touched by ``invoices`` from the partition contents"""
+    days = {
+        (invoice.get("branch_id", "main"), invoice["created_at"].replace(hour=0, minute=0, second=0, microsecond=0))
+        for invoice in invoices
+    }
+    for branch_id, day in days:
+        totals = await db[partition].aggregate([
+            {"$match": {"branch_id": branch_id, "created_at": {"$gte": day, "$lt": day + timedelta(days=1)}}},
+            {"$group": {
+                "_id": None,
+                "invoice_count": {"$sum": 1},
+                "revenue": {"$sum": "$final_total"},
+                "items_sold": {"$sum": {"$sum": "$items.quantity"}},
+            }},
+        ]).to_list(1)
+        if not totals:
+            continue
+        await db.invoice_rollups.update_one(
+            {"branch_id": branch_id, "date": day},
+            {"$set": {**{key: totals[0][key] for key in ("invoice_count", "revenue", "items_sold")},
+                      "money_scale": MONEY_SCALE}},
+            upsert=True
+        )
+
+
+async def _rebuild_archive_totals(db, branch_id: str):
+    totals = await db.invoice_rollups.aggregate([
+        {"$match": {"branch_id": branch_id}},
+        {"$group": {"_id": None, "invoice_count": {"$sum": "$invoice_count"}}},
+    ]).to_list(1)
+    await db.invoice_archive_totals.update_one(
+        {"branch_id": branch_id},
+        {"$set": {"invoice_count": totals[0]["invoice_count"] if totals else 0}},
+        upsert=True
+    )
@@ -0,0 +1,83 @@
+"""Cost of the forecasting step for a large catalogue.
+
+Builds the per item and branch rows that the Mongo aggregation in
+forecasting.py returns for a year of sales, then times turning them into
+arrays, the reorder point maths and the per item combination. Mongo time
+(aggregation and bulk writes) depends on the deployment and is reported by the
+``maintenance/forecast-demand`` job itself. Run with::
+
+    python benchmarks/forecasting.py --items 200000 --branches 3
+"""
+import argparse
+import sys
+import time
+import uuid
+from datetime import date, timedelta
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from forecasting import MIN_OBSERVED_DAYS, item_reorder_points, reorder_points  # noqa: E402
+
+
+def aggregation_rows(item_count: int, branch_count: int, history_days: int, rng: np.random.Generator) -> list:
+    item_ids = [str(uuid.uuid4()) for _ in range(item_count)]
+    branches = ["main"] + [f"branch-{index}" for index in range(1, branch_count)]
+    today = date.today()
+    rows = []
+    for item_id in item_ids:
+        for branch_id in branches:
+            sale_days = int(rng.integers(1, history_days))
+            daily = rng.poisson(rng.uniform(0.2, 5), sale_days)
+            rows.append({
+                "_id": {"item_id": item_id, "branch_id": branch_id},
+                "total": int(daily.sum()),
+                "sum_squares": int((daily ** 2).sum()),
+                "first_day": (today - timedelta(days=int(rng.integers(0, history_days)))).isoformat(),
+            })
+    return rows
+
+
+def timed(label: str, function, *args):
+    started = time.perf_counter()
+    result = function(*args)
+    print(f"  {label:<36}{(time.perf_counter() - started) * 1000:>10.1f} ms")
+    return result
+
+
+def run(rows: list, history_days: int, lead_time_days: float, service_level: float):
+    today = np.datetime64(date.today(), "D")
+
+    def to_arrays():
+        count = len(rows)
+        total = np.fromiter((row["total"] for row in rows), dtype=np.float64, count=count)
+        sum_squares = np.fromiter((row["sum_squares"] for row in rows), dtype=np.float64, count=count)
+        first_day = np.array([row["first_day"] for row in rows], dtype="datetime64[D]")
+        observed = np.clip((today - first_day).astype(np.int64) + 1, MIN_OBSERVED_DAYS, history_days).astype(np.float64)
+        return total, sum_squares, observed
+
+    def encode_items():
+        return np.unique(np.array([row["_id"]["item_id"] for row in rows], dtype=object), return_inverse=True)
+
+    print(f"\n{len(rows):,} item/branch rows")
+    total, sum_squares, observed = timed("rows to arrays", to_arrays)
+    stats = timed("branch reorder points", reorder_points, total, sum_squares, observed, lead_time_days, service_level)
+    item_ids, item_codes = timed("encode item ids", encode_items)
+    timed("item reorder points", item_reorder_points, item_codes, len(item_ids), stats["daily_mean"],
+          stats["daily_variance"], lead_time_days, service_level)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--items", type=int, default=200000)
+    parser.add_argument("--branches", type=int, default=3)
+    parser.add_argument("--history-days", type=int, default=365)
+    parser.add_argument("--lead-time-days", type=float, default=7)
+    parser.add_argument("--service-level", type=float, default=0.95)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    rows = aggregation_rows(args.items, args.branches, args.history_days, np.random.default_rng(7))
+    print(f"generated synthetic rows in {time.perf_counter() - started:.1f} s")
+    run(rows, args.history_days, args.lead_time_days, args.service_level)
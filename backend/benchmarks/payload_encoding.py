@@ -0,0 +1,133 @@
+"""Payload size and CPU cost of the response encodings offered by the API.
+
+Builds synthetic payloads shaped like ``/api/reports/inventory`` and
+``/api/invoices`` responses and measures, for each encoding, the encoded size
+and the time to encode and decode it. Run with::
+
+    python benchmarks/payload_encoding.py --items 5000 --invoices 100
+"""
+import argparse
+import gzip
+import json
+import random
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import brotli
+import msgpack
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from compression import NegotiatedEncodingMiddleware  # noqa: E402  (defaults under test)
+
+CATEGORIES = ["Brake System", "Lubricants", "Filters", "Electrical", "Suspension", "Engine"]
+
+
+def inventory_report(item_count: int) -> dict:
+    items = [
+        {
+            "name": f"Part {index}",
+            "sku": f"SKU{index:06d}",
+            "category": random.choice(CATEGORIES),
+            "stock_quantity": random.randint(0, 200),
+            "cost_price": round(random.uniform(10, 5000), 2),
+            "min_stock": 5,
+        }
+        for index in range(item_count)
+    ]
+    breakdown = {}
+    for item in items:
+        category = breakdown.setdefault(item["category"], {"count": 0, "stock_value": 0, "items": []})
+        value = item["stock_quantity"] * item["cost_price"]
+        category["count"] += 1
+        category["stock_value"] += value
+        category["items"].append({"name": item["name"], "sku": item["sku"], "stock": item["stock_quantity"], "value": value})
+    return {
+        "total_items": item_count,
+        "total_stock_value": sum(category["stock_value"] for category in breakdown.values()),
+        "low_stock_items": [item for item in items if item["stock_quantity"] <= item["min_stock"]],
+        "category_breakdown": breakdown,
+    }
+
+
+def invoice_listing(invoice_count: int) -> list:
+    now = datetime.utcnow()
+    invoices = []
+    for index in range(invoice_count):
+        lines = [
+            {
+                "item_id": str(uuid.uuid4()),
+                "sku": f"SKU{random.randint(0, 99999):06d}",
+                "name": f"Part {random.randint(0, 99999)}",
+                "quantity": quantity,
+                "unit_price": price,
+                "line_total": quantity * price,
+            }
+            for quantity, price in ((random.randint(1, 5), round(random.uniform(10, 2000), 2)) for _ in range(random.randint(1, 8)))
+        ]
+        total = sum(line["line_total"] for line in lines)
+        created_at = (now - timedelta(minutes=index)).isoformat()
+        invoices.append({
+            "id": str(uuid.uuid4()),
+            "invoice_number": f"MAI-{index:06d}",
+            "branch_id": "main",
+            "customer_name": "Walk-in Customer",
+            "customer_phone": "",
+            "items": lines,
+            "subtotal": total,
+            "final_total": total,
+            "payment_mode": "Cash",
+            "status": "completed",
+            "created_at": created_at,
+            "updated_at": created_at,
+            "created_by": "system",
+        })
+    return invoices
+
+
+def measure(name: str, encode, decode, payload, repeat: int):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        encoded = encode(payload)
+    encode_ms = (time.perf_counter() - started) * 1000 / repeat
+    started = time.perf_counter()
+    for _ in range(repeat):
+        decode(encoded)
+    decode_ms = (time.perf_counter() - started) * 1000 / repeat
+    print(f"  {name:<22}{len(encoded):>12,}{encode_ms:>12.2f}{decode_ms:>12.2f}")
+
+
+def run(label: str, payload, repeat: int):
+    defaults = NegotiatedEncodingMiddleware(app=None)
+    as_json = lambda value: json.dumps(value).encode()  # noqa: E731
+    print(f"\n{label}")
+    print(f"  {'encoding':<22}{'bytes':>12}{'encode ms':>12}{'decode ms':>12}")
+    measure("json", as_json, json.loads, payload, repeat)
+    for level in (1, defaults.gzip_level, 9):
+        measure(f"json+gzip-{level}", lambda v: gzip.compress(as_json(v), compresslevel=level),
+                lambda b: json.loads(gzip.decompress(b)), payload, repeat)
+    for quality in (1, defaults.brotli_quality, 11):
+        measure(f"json+br-{quality}", lambda v: brotli.compress(as_json(v), quality=quality),
+                lambda b: json.loads(brotli.decompress(b)), payload, repeat)
+    # The middleware transcodes already rendered JSON, so include the json.loads it pays
+    measure("msgpack (from json)", lambda v: msgpack.packb(json.loads(as_json(v))), msgpack.unpackb, payload, repeat)
+    measure(f"msgpack+gzip-{defaults.gzip_level}",
+            lambda v: gzip.compress(msgpack.packb(json.loads(as_json(v))), compresslevel=defaults.gzip_level),
+            lambda b: msgpack.unpackb(gzip.decompress(b)), payload, repeat)
+    measure(f"msgpack+br-{defaults.brotli_quality}",
+            lambda v: brotli.compress(msgpack.packb(json.loads(as_json(v))), quality=defaults.brotli_quality),
+            lambda b: msgpack.unpackb(brotli.decompress(b)), payload, repeat)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--items", type=int, default=5000, help="items in the inventory report")
+    parser.add_argument("--invoices", type=int, default=100, help="invoices in the listing")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    random.seed(7)
+    run(f"/api/reports/inventory with {args.items} items", inventory_report(args.items), args.repeat)
+    run(f"/api/invoices with {args.invoices} invoices", invoice_listing(args.invoices), args.repeat)
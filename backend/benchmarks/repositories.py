@@ -0,0 +1,170 @@
+"""Latency of the storage backends behind the repository layer.
+
+Runs the same workload against ``MongoRepositories`` and ``SqliteRepositories``
+(see repositories.py): it seeds a catalogue and invoice history, then times
+the calls a till makes, one at a time as a single counter would. Each backend
+gets a scratch database, which is removed afterwards.
+
+Mongo needs MONGO_URL, from the environment or backend/.env, and is skipped
+when it is not set. Run with::
+
+    python benchmarks/repositories.py --items 5000 --invoices 20000 --repeat 500
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+from repositories import MongoRepositories  # noqa: E402
+from sqlite_repositories import SqliteRepositories  # noqa: E402
+
+CATEGORIES = ["Brake System", "Lubricants", "Filters", "Electrical", "Suspension", "Engine"]
+BRANCHES = ["main", "north", "south"]
+
+
+def item(index: int) -> dict:
+    now = datetime.utcnow()
+    return {
+        "id": str(uuid.uuid4()), "sku": f"SKU{index:06d}", "name": f"Part {index}",
+        "category": random.choice(CATEGORIES), "sub_category": "", "brand": f"Brand {index % 40}",
+        "cost_price": random.randint(1000, 500000), "selling_price": random.randint(1500, 700000),
+        "stock_quantity": random.randint(0, 200), "reserved_quantity": 0, "min_stock": 5,
+        "money_scale": 100, "created_at": now, "updated_at": now,
+    }
+
+
+def invoice(index: int, items: list, created_at: datetime) -> dict:
+    lines = [
+        {"item_id": line["id"], "sku": line["sku"], "name": line["name"], "quantity": 2,
+         "unit_price": line["selling_price"], "line_total": 2 * line["selling_price"]}
+        for line in random.sample(items, 3)
+    ]
+    total = sum(line["line_total"] for line in lines)
+    return {
+        "id": str(uuid.uuid4()), "invoice_number": f"MAI-{index:06d}", "branch_id": random.choice(BRANCHES),
+        "customer_name": f"Customer {index}", "customer_phone": f"98450{index:05d}", "items": lines,
+        "subtotal": total, "final_total": total, "payment_mode": "cash",
+        "status": "ongoing" if index % 20 == 0 else "completed", "money_scale": 100,
+        "created_at": created_at, "updated_at": created_at,
+    }
+
+
+def transaction(item_id: str, created_at: datetime) -> dict:
+    return {
+        "id": str(uuid.uuid4()), "item_id": item_id, "transaction_type": "OUT", "quantity": 1,
+        "reference_type": "INVOICE", "reference_id": str(uuid.uuid4()), "created_at": created_at,
+    }
+
+
+async def seed(repositories, items: list, invoices: list):
+    for document in items:
+        await repositories.items.insert(document)
+    for document in invoices:
+        await repositories.invoices.insert(document)
+    await repositories.stock_transactions.insert_many(
+        [transaction(line["item_id"], document["created_at"]) for document in invoices for line in document["items"]]
+    )
+
+
+async def timed(label: str, repeat: int, call):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        await call()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    print(f"  {label:<28} median {statistics.median(timings):>8.3f}   p95 {timings[int(len(timings) * 0.95)]:>8.3f}   "
+          f"max {timings[-1]:>8.3f}")
+
+
+async def run(name: str, repositories, args):
+    random.seed(7)
+    items = [item(index) for index in range(args.items)]
+    start = datetime.utcnow() - timedelta(days=365)
+    invoices = [invoice(index, items, start + timedelta(minutes=index)) for index in range(args.invoices)]
+
+    started = time.perf_counter()
+    await seed(repositories, items, invoices)
+    print(f"\n{name}: seeded {args.items:,} items and {args.invoices:,} invoices in {time.perf_counter() - started:.1f} s")
+    print("  (ms per call)")
+
+    ids = [document["id"] for document in items]
+    ongoing = [document["id"] for document in invoices if document["status"] == "ongoing"]
+    await timed("item by id", args.repeat, lambda: repositories.items.get(random.choice(ids)))
+    await timed("item version fields", args.repeat, lambda: repositories.items.get(random.choice(ids), ("id", "updated_at")))
+    await timed("items by sku", args.repeat, lambda: repositories.items.by_sku(f"SKU{random.randrange(args.items):06d}"))
+    await timed("item search", args.repeat // 10 or 1, lambda: repositories.items.list("brake"))
+    await timed("low stock items", args.repeat // 10 or 1, lambda: repositories.items.low_stock())
+    await timed("update item stock", args.repeat,
+                lambda: repositories.items.update(random.choice(ids), {"stock_quantity": random.randint(0, 200)}))
+    await timed("latest invoices of branch", args.repeat,
+                lambda: repositories.invoices.list("completed", random.choice(BRANCHES), 50))
+    await timed("ongoing invoices", args.repeat, lambda: repositories.invoices.list("ongoing", "", 100))
+    await timed("count branch invoices", args.repeat, lambda: repositories.invoices.count(branch_id=random.choice(BRANCHES)))
+    await timed("insert invoice", args.repeat,
+                lambda: repositories.invoices.insert(invoice(random.randrange(10 ** 6), items, datetime.utcnow())))
+    await timed("guarded invoice update", args.repeat,
+                lambda: repositories.invoices.update(random.choice(ongoing), {"updated_at": datetime.utcnow()}, status="ongoing"))
+    await timed("ledger batch of 500", args.repeat // 10 or 1, lambda: repositories.stock_transactions.insert_many(
+        [transaction(random.choice(ids), datetime.utcnow()) for _ in range(500)]))
+    await timed("item stock history", args.repeat, lambda: repositories.stock_transactions.for_item(random.choice(ids)))
+
+
+async def run_mongo(args):
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    load_dotenv(BACKEND_DIR / ".env")
+    if not os.environ.get("MONGO_URL"):
+        print("\nmongo: skipped, MONGO_URL is not set")
+        return
+    client = AsyncIOMotorClient(os.environ["MONGO_URL"])
+    db = client[f"repository_benchmark_{uuid.uuid4().hex[:8]}"]
+    try:
+        # The same indexes as the SQLite schema
+        await db.items.create_index("id", unique=True)
+        await db.items.create_index("sku")
+        await db.invoices.create_index("id", unique=True)
+        await db.invoices.create_index([("status", 1), ("created_at", -1)])
+        await db.invoices.create_index([("branch_id", 1), ("created_at", -1)])
+        await db.branches.create_index("id", unique=True)
+        await db.stock_transactions.create_index("id", unique=True)
+        await db.stock_transactions.create_index([("item_id", 1), ("created_at", -1)])
+        await run("mongo", MongoRepositories(db), args)
+    finally:
+        await client.drop_database(db.name)
+        client.close()
+
+
+async def run_sqlite(args):
+    with tempfile.TemporaryDirectory() as directory:
+        repositories = SqliteRepositories(Path(directory) / "benchmark.sqlite3", synchronous=args.sqlite_synchronous)
+        try:
+            await run(f"sqlite (synchronous={args.sqlite_synchronous})", repositories, args)
+        finally:
+            await repositories.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--items", type=int, default=5000)
+    parser.add_argument("--invoices", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=500)
+    parser.add_argument("--backends", default="mongo,sqlite")
+    parser.add_argument("--sqlite-synchronous", default="NORMAL")
+    args = parser.parse_args()
+
+    backends = args.backends.split(",")
+    if "mongo" in backends:
+        asyncio.run(run_mongo(args))
+    if "sqlite" in backends:
+        asyncio.run(run_sqlite(args))
@@ -0,0 +1,135 @@
+"""Cold-start cost of the API: import time, time to ready and first-request latency.
+
+Three measurements, each in a fresh interpreter so nothing is already cached:
+
+* ``import server`` wall time over ``--repeat`` runs, plus the slowest
+  modules reported by ``python -X importtime``
+* time for ``uvicorn server:app`` to answer ``/api/health/live`` and
+  ``/api/health/ready`` (the lifespan has connected to Mongo and provisioned
+  the default tenant)
+* latency of the first and subsequent requests to ``--path``
+
+Needs MONGO_URL and DB_NAME, from the environment or backend/.env. Run with::
+
+    python benchmarks/startup.py --repeat 5 --path /api/items
+"""
+import argparse
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+IMPORT_TIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)")
+
+
+def import_wall_time(repeat: int):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "import server"], cwd=BACKEND_DIR, check=True)
+        timings.append((time.perf_counter() - started) * 1000)
+    print("\nimport server (ms, includes interpreter start)")
+    print(f"  median {statistics.median(timings):>10.1f}   min {min(timings):>10.1f}   max {max(timings):>10.1f}")
+
+
+def slowest_imports(top: int):
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import server"], cwd=BACKEND_DIR,
+                            check=True, capture_output=True, text=True)
+    # Modules imported directly by server.py, each with everything it pulls in. importtime
+    # prints children before their parent, indented two spaces per level.
+    modules, children = [], []
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if not match:
+            continue
+        depth = len(match.group(3)) // 2
+        if depth == 1:
+            children.append((int(match.group(2)) / 1000, match.group(4)))
+        elif depth == 0:
+            if match.group(4) == "server":
+                modules = children
+                total_ms = int(match.group(2)) / 1000
+            children = []
+    print(f"\nslowest imports of server.py (cumulative ms of {total_ms:.1f} total)")
+    for cumulative_ms, module in sorted(modules, reverse=True)[:top]:
+        print(f"  {module:<40}{cumulative_ms:>10.1f}")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def get(url: str):
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(url, timeout=30) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as error:
+        status = error.code
+    return status, (time.perf_counter() - started) * 1000
+
+
+def wait_for(url: str, started: float, deadline: float) -> float:
+    while time.perf_counter() < deadline:
+        try:
+            status, _ = get(url)
+            if status == 200:
+                return (time.perf_counter() - started) * 1000
+        except (urllib.error.URLError, ConnectionError):
+            pass
+        time.sleep(0.01)
+    raise TimeoutError(f"{url} did not become available")
+
+
+def serve_and_request(path: str, requests: int, timeout: float):
+    port = free_port()
+    base = f"http://127.0.0.1:{port}"
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--port", str(port), "--log-level", "warning"],
+        cwd=BACKEND_DIR,
+    )
+    try:
+        deadline = started + timeout
+        live_ms = wait_for(f"{base}/api/health/live", started, deadline)
+        ready_ms = wait_for(f"{base}/api/health/ready", started, deadline)
+        latencies = [get(f"{base}{path}")[1] for _ in range(requests)]
+    finally:
+        process.terminate()
+        process.wait()
+
+    print("\nuvicorn server:app (ms from spawn)")
+    print(f"  {'live':<40}{live_ms:>10.1f}")
+    print(f"  {'ready':<40}{ready_ms:>10.1f}")
+    print(f"\nGET {path} (ms)")
+    print(f"  {'first request':<40}{latencies[0]:>10.1f}")
+    if len(latencies) > 1:
+        print(f"  {'median of the rest':<40}{statistics.median(latencies[1:]):>10.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5, help="fresh interpreters timed for the import")
+    parser.add_argument("--top", type=int, default=10, help="slowest imports to list")
+    parser.add_argument("--path", default="/api/items", help="endpoint timed after startup")
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for readiness")
+    parser.add_argument("--skip-server", action="store_true", help="only measure imports, no Mongo needed")
+    args = parser.parse_args()
+
+    from dotenv import load_dotenv
+    load_dotenv(BACKEND_DIR / '.env')
+
+    import_wall_time(args.repeat)
+    slowest_imports(args.top)
+    if not args.skip_server:
+        serve_and_request(args.path, args.requests, args.timeout)
@@ -0,0 +1,186 @@
+"""Line-level editing of parked carts (ongoing invoices).
+
+Each change touches a single line: it is applied with a positional update on
+``items.$`` and adjusts ``subtotal``/``final_total`` with ``$inc``, so editing
+a cart costs the same whatever its size. Prices and totals are handled in
+integer minor units (see money.py), so the ``$inc`` totals stay exact.
+Updates are guarded on the line's previous quantity and price; a concurrent
+edit of the same line yields a 409 and the till retries. Invoices saved whole
+may hold several lines for one item: edits change the first of them and
+removing the item removes them all.
+
+Item data for new lines comes from a short-lived per-process cache. Every line
+of a parked cart holds a soft reservation (see reservations.py) that expires
+``CART_RESERVATION_MINUTES`` after the cart was last edited, so stock parked
+in abandoned carts is released again without anyone cleaning up. Only a
+growing line is checked against available stock.
+"""
+import os
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+from pymongo import ReturnDocument
+
+from money import invoice_from_document, stored_minor, to_minor
+from reservations import extend_reservations, release_reservations, set_reservation
+
+CART_ITEM_CACHE_SECONDS = float(os.environ.get("CART_ITEM_CACHE_SECONDS", "10"))
+
+ITEM_FIELDS = {"_id": 0, "id": 1, "sku": 1, "name": 1, "selling_price": 1, "money_scale": 1}
+LINE_FIELDS = ("item_id", "quantity", "unit_price", "line_total")
+
+
+class ItemCache:
+    """Item fields needed to price a cart line, kept for ``ttl`` seconds"""
+
+    def __init__(self, ttl: float = CART_ITEM_CACHE_SECONDS, max_entries: int = 5000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._items: Dict[str, Tuple[float, dict]] = {}
+
+    async def get(self, db, item_id: str) -> Optional[dict]:
+        cached = self._items.get(item_id)
+        if cached and time.monotonic() - cached[0] < self.ttl:
+            return cached[1]
+        item = await db.items.find_one({"id": item_id}, ITEM_FIELDS)
+        if item:
+            if len(self._items) >= self.max_entries:
+                self._items.clear()
+            self._items[item_id] = (time.monotonic(), item)
+        return item
+
+    def invalidate(self, item_id: str):
+        self._items.pop(item_id, None)
+
+
+async def _load_lines(db, invoice_id: str, item_id: str) -> Tuple[dict, List[dict]]:
+    """The cart and its lines for ``item_id``; invoices saved whole may hold more than one"""
+    invoice = await db.invoices.find_one(
+        {"id": invoice_id},
+        {"_id": 0, "status": 1, "branch_id": 1, **{f"items.{field}": 1 for field in LINE_FIELDS}}
+    )
+    if not invoice:
+        raise HTTPException(status_code=404, detail="Invoice not found")
+    if invoice["status"] != "ongoing":
+        raise HTTPException(status_code=400, detail="Only ongoing invoices can be edited")
+    return invoice, [line for line in invoice.get("items") or [] if line["item_id"] == item_id]
+
+
+async def _apply(db, invoice_id: str, item_id: str, query: dict, update: dict) -> dict:
+    update.setdefault("$set", {})["updated_at"] = datetime.utcnow()
+    cart = await db.invoices.find_one_and_update(
+        {"id": invoice_id, "status": "ongoing", **query},
+        update,
+        projection={"_id": 0, "subtotal": 1, "final_total": 1, "updated_at": 1, "money_scale": 1,
+                    "items": {"$elemMatch": {"item_id": item_id}}},
+        return_document=ReturnDocument.AFTER
+    )
+    if cart is None:
+        raise HTTPException(status_code=409, detail="Cart was changed by another request, please retry")
+    cart = invoice_from_document(cart)
+    lines = cart.get("items") or []
+    return {
+        "invoice_id": invoice_id,
+        "line": lines[0] if lines else None,
+        "subtotal": cart["subtotal"],
+        "final_total": cart["final_total"],
+        "updated_at": cart["updated_at"],
+        "reserved_until": None,
+    }
+
+
+async def _reserve_and_apply(db, invoice: dict, invoice_id: str, item_id: str, quantity: int,
+                             query: dict, update: dict) -> dict:
+    branch_id = invoice.get("branch_id", "main")
+    previous = await set_reservation(db, invoice_id, branch_id, item_id, quantity)
+    try:
+        result = await _apply(db, invoice_id, item_id, query, update)
+    except HTTPException:
+        await set_reservation(db, invoice_id, branch_id, item_id, previous, enforce=False)
+        raise
+    result["reserved_until"] = await extend_reservations(db, invoice_id)
+    return result
+
+
+def _line_match(line: dict) -> dict:
+    return {"$elemMatch": {"item_id": line["item_id"], "quantity": line["quantity"], "unit_price": line["unit_price"]}}
+
+
+def _line_guard(line: dict) -> dict:
+    return {"items": _line_match(line)}
+
+
+def _lines_guard(lines: List[dict]) -> dict:
+    return {"items": {"$all": [_line_match(line) for line in lines]}}
+
+
+async def add_line(db, items: ItemCache, invoice_id: str, item_id: str, quantity: int,
+                   selected_price: Optional[float] = None) -> dict:
+    """Add ``quantity`` of an item to a cart, merging into its existing line"""
+    invoice, lines = await _load_lines(db, invoice_id, item_id)
+    if lines:
+        return await set_line_quantity(db, items, invoice_id, item_id, lines[0]["quantity"] + quantity,
+                                       selected_price, current=(invoice, lines))
+
+    item = await items.get(db, item_id)
+    if not item:
+        raise HTTPException(status_code=404, detail=f"Item {item_id} not found")
+
+    unit_price = stored_minor(item, "selling_price") if selected_price is None else to_minor(selected_price)
+    line_total = quantity * unit_price
+    new_line = {
+        "item_id": item["id"],
+        "sku": item["sku"],
+        "name": item["name"],
+        "quantity": quantity,
+        "unit_price": unit_price,
+        "line_total": line_total
+    }
+    return await _reserve_and_apply(
+        db, invoice, invoice_id, item_id, quantity,
+        {"items.item_id": {"$ne": item_id}},
+        {"$push": {"items": new_line}, "$inc": {"subtotal": line_total, "final_total": line_total}}
+    )
+
+
+async def set_line_quantity(db, items: ItemCache, invoice_id: str, item_id: str, quantity: int,
+                            selected_price: Optional[float] = None, current=None) -> dict:
+    """Change an item's first line's quantity (and optionally price); a quantity of 0 removes the item"""
+    invoice, lines = current or await _load_lines(db, invoice_id, item_id)
+    if not lines:
+        raise HTTPException(status_code=404, detail=f"Item {item_id} is not in this cart")
+    if quantity <= 0:
+        return await remove_line(db, invoice_id, item_id, current=(invoice, lines))
+
+    line = lines[0]
+    unit_price = line["unit_price"] if selected_price is None else to_minor(selected_price)
+    line_total = quantity * unit_price
+    delta = line_total - line["line_total"]
+    # The reservation covers the item across all of its lines
+    reserved = quantity + sum(other["quantity"] for other in lines[1:])
+    return await _reserve_and_apply(
+        db, invoice, invoice_id, item_id, reserved,
+        _line_guard(line),
+        {
+            "$set": {"items.$.quantity": quantity, "items.$.unit_price": unit_price, "items.$.line_total": line_total},
+            "$inc": {"subtotal": delta, "final_total": delta},
+        }
+    )
+
+
+async def remove_line(db, invoice_id: str, item_id: str, current=None) -> dict:
+    """Remove every line of an item from a cart and release its reservation"""
+    invoice, lines = current or await _load_lines(db, invoice_id, item_id)
+    if not lines:
+        raise HTTPException(status_code=404, detail=f"Item {item_id} is not in this cart")
+    removed = sum(line["line_total"] for line in lines)
+    result = await _apply(
+        db, invoice_id, item_id,
+        _lines_guard(lines),
+        {"$pull": {"items": {"item_id": item_id}}, "$inc": {"subtotal": -removed, "final_total": -removed}}
+    )
+    await release_reservations(db, invoice_id, item_id)
+    result["reserved_until"] = await extend_reservations(db, invoice_id)
+    return result
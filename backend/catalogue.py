@@ -0,0 +1,121 @@
+"""Compact catalogue snapshots and deltas for the billing screen.
+
+Tills keep the whole catalogue locally. They download a snapshot once and then
+poll for deltas since the version they hold. Both payloads only carry the
+fields billing needs, laid out as one array per column, and are served
+gzip-compressed.
+
+A version is an ``updated_at`` in milliseconds since the epoch. ``updated_at``
+is stamped by the writing process before the write commits, so a change can
+become visible after a poll that already returned a later version. Versions
+handed out therefore lag ``CATALOGUE_SAFETY_SECONDS`` behind the time the
+catalogue was read, and changes made within that window are sent again on
+the next poll. Deleted items leave a tombstone in ``item_tombstones`` so deltas can
+report removals; tombstones expire after ``TOMBSTONE_RETENTION_DAYS``, after
+which older versions must resync from a snapshot.
+"""
+import gzip
+import json
+import os
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from pymongo import DESCENDING
+
+from money import item_from_document
+
+CATALOGUE_FIELDS = ["id", "sku", "name", "category", "sub_category", "brand", "selling_price", "stock_quantity"]
+TOMBSTONE_RETENTION_DAYS = 30
+# Longest expected gap between stamping updated_at and the write committing, including clock skew
+CATALOGUE_SAFETY_SECONDS = float(os.environ.get("CATALOGUE_SAFETY_SECONDS", "30"))
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def to_version(moment: Optional[datetime]) -> int:
+    if moment is None:
+        return 0
+    return int((moment - _EPOCH).total_seconds() * 1000)
+
+
+def from_version(version: int) -> datetime:
+    return _EPOCH + timedelta(milliseconds=version)
+
+
+def safe_version(latest: int, read_at: datetime) -> int:
+    """The version a till may resume from: changes stamped before it were committed when the catalogue was read"""
+    return min(latest, to_version(read_at - timedelta(seconds=CATALOGUE_SAFETY_SECONDS)))
+
+
+def columnar(items: List[dict]) -> dict:
+    items = [item_from_document(item) for item in items]
+    return {field: [item.get(field) for item in items] for field in CATALOGUE_FIELDS}
+
+
+def encode(payload: dict) -> bytes:
+    return gzip.compress(json.dumps(payload, separators=(",", ":")).encode(), compresslevel=6)
+
+
+async def current_version(db) -> int:
+    latest_item = await db.items.find_one({}, {"updated_at": 1}, sort=[("updated_at", DESCENDING)])
+    latest_removal = await db.item_tombstones.find_one({}, {"deleted_at": 1}, sort=[("deleted_at", DESCENDING)])
+    return max(
+        to_version(latest_item["updated_at"]) if latest_item else 0,
+        to_version(latest_removal["deleted_at"]) if latest_removal else 0,
+    )
+
+
+class CatalogueSnapshots:
+    """Keeps the encoded snapshot for the latest version so repeat downloads skip the scan.
+
+    ``version`` identifies the snapshot (the latest change it contains); the
+    body tells tills the safe version to poll deltas from.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.body = None
+
+    async def get(self, db) -> tuple:
+        version = await current_version(db)
+        if version != self.version:
+            read_at = datetime.utcnow()
+            projection = {field: 1 for field in CATALOGUE_FIELDS}
+            projection.update({"_id": 0, "money_scale": 1})
+            items = await db.items.find({}, projection).sort("sku", 1).to_list(None)
+            self.body = encode({
+                "version": safe_version(version, read_at),
+                "count": len(items),
+                "fields": CATALOGUE_FIELDS,
+                "columns": columnar(items),
+            })
+            self.version = version
+        return self.version, self.body
+
+
+async def build_delta(db, since: int) -> bytes:
+    # Inclusive bound: changes sharing the last seen millisecond are resent, tills upsert by id
+    since_dt = from_version(since)
+    read_at = datetime.utcnow()
+    projection = {field: 1 for field in CATALOGUE_FIELDS}
+    projection.update({"_id": 0, "updated_at": 1, "money_scale": 1})
+    changed = await db.items.find({"updated_at": {"$gte": since_dt}}, projection).to_list(None)
+    removed = await db.item_tombstones.find({"deleted_at": {"$gte": since_dt}}, {"_id": 0}).to_list(None)
+
+    latest = max(
+        [since]
+        + [to_version(item["updated_at"]) for item in changed]
+        + [to_version(tombstone["deleted_at"]) for tombstone in removed]
+    )
+    version = max(since, safe_version(latest, read_at))
+    return encode({
+        "version": version,
+        "since": since,
+        "fields": CATALOGUE_FIELDS,
+        "columns": columnar(changed),
+        "removed": [tombstone["id"] for tombstone in removed],
+    })
+
+
+def delta_expired(since: int) -> bool:
+    return from_version(since) < datetime.utcnow() - timedelta(days=TOMBSTONE_RETENTION_DAYS)
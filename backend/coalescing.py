@@ -0,0 +1,61 @@
+"""Single-flight coalescing of identical concurrent reads.
+
+When several requests for the same endpoint and parameters arrive while one
+is already being served, they wait for that one and share its result instead
+of each querying Mongo. Nothing is cached: once the shared call finishes, the
+next request runs a fresh query.
+
+Requests only share results within the same tenant. Only use on read-only
+handlers that do not write to their ``Response``, since followers never run
+the handler body themselves.
+"""
+import asyncio
+import functools
+from collections import defaultdict
+from typing import Awaitable, Callable, Dict, Hashable
+
+from fastapi import Request, Response
+
+from database import current_tenant_id
+
+
+class SingleFlight:
+    def __init__(self):
+        self._in_flight: Dict[Hashable, asyncio.Task] = {}
+        self._stats = defaultdict(lambda: {"requests": 0, "executions": 0, "collapsed": 0})
+
+    async def do(self, name: str, key: Hashable, call: Callable[[], Awaitable]):
+        stats = self._stats[name]
+        stats["requests"] += 1
+        task = self._in_flight.get(key)
+        if task is None:
+            stats["executions"] += 1
+            task = asyncio.ensure_future(call())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            stats["collapsed"] += 1
+        # Shielded so a disconnecting client does not cancel the query others wait on
+        return await asyncio.shield(task)
+
+    def coalesce(self, name: str = None):
+        def decorator(handler):
+            endpoint = name or handler.__name__
+
+            @functools.wraps(handler)
+            async def wrapper(*args, **kwargs):
+                params = tuple(sorted(
+                    (param, value) for param, value in kwargs.items()
+                    if not isinstance(value, (Request, Response))
+                ))
+                key = (endpoint, current_tenant_id(), args, params)
+                return await self.do(endpoint, key, lambda: handler(*args, **kwargs))
+
+            return wrapper
+        return decorator
+
+    def stats(self) -> dict:
+        return {
+            endpoint: {**counts, "in_flight": sum(1 for key in self._in_flight if key[0] == endpoint)}
+            for endpoint, counts in self._stats.items()
+        }
@@ -0,0 +1,142 @@
+"""Response compression and MessagePack content negotiation.
+
+JSON responses are re-encoded as ``application/msgpack`` for GET requests whose
+``Accept`` header asks for it, then compressed with brotli or gzip (preferring
+brotli) when the client accepts it and the body is at least ``minimum_size``
+bytes. Non-JSON responses, file downloads (``Content-Disposition``), bodies
+streamed in several messages and responses that already carry a
+``Content-Encoding`` pass through untouched, so a large JSON job result is
+never buffered in memory.
+
+See benchmarks/payload_encoding.py for the size and CPU trade-offs behind the
+default levels. brotli and msgpack are imported on first use.
+"""
+import gzip
+import json
+
+from starlette.datastructures import Headers, MutableHeaders
+
+MSGPACK = "application/msgpack"
+
+
+def qualities(header: str) -> dict:
+    """Quality value per entry of an Accept or Accept-Encoding header; a missing q is 1"""
+    values = {}
+    for entry in header.lower().split(","):
+        name, *params = [part.strip() for part in entry.split(";")]
+        if not name:
+            continue
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        values[name] = quality
+    return values
+
+
+def encoding_quality(accepted: dict, encoding: str) -> float:
+    return accepted.get(encoding, accepted.get("*", 0.0))
+
+
+def accepts_encoding(accept_encoding: str, encoding: str) -> bool:
+    """Whether a body already stored with ``encoding`` may be sent as it is"""
+    return encoding_quality(qualities(accept_encoding), encoding) > 0
+
+
+def choose_encoding(accept_encoding: str):
+    accepted = qualities(accept_encoding)
+    # Highest quality wins; on a tie brotli comes first. q=0 means "not acceptable"
+    quality, encoding = max(((encoding_quality(accepted, encoding), encoding) for encoding in ("br", "gzip")),
+                            key=lambda candidate: candidate[0])
+    return encoding if quality > 0 else None
+
+
+class NegotiatedEncodingMiddleware:
+    def __init__(self, app, minimum_size: int = 1024, gzip_level: int = 6, brotli_quality: int = 4):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_headers = Headers(scope=scope)
+        encoding = choose_encoding(request_headers.get("accept-encoding", ""))
+        wants_msgpack = scope["method"] == "GET" and qualities(request_headers.get("accept", "")).get(MSGPACK, 0) > 0
+        if encoding is None and not wants_msgpack:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        passthrough = False
+        body = []
+
+        async def send_wrapper(message):
+            nonlocal start_message, passthrough
+            if message["type"] == "http.response.start":
+                start_message = message
+                headers = Headers(raw=message["headers"])
+                passthrough = (
+                    "content-encoding" in headers
+                    or "content-disposition" in headers
+                    or not headers.get("content-type", "").startswith("application/json")
+                )
+                if passthrough:
+                    await send(message)
+                return
+
+            if passthrough:
+                await send(message)
+                return
+            if not body and message.get("more_body", False):
+                # Streamed, e.g. a file; buffering it would hold the whole body in memory
+                passthrough = True
+                await send(start_message)
+                await send(message)
+                return
+
+            body.append(message.get("body", b""))
+            if message.get("more_body", False):
+                return
+            await self._send_encoded(send, start_message, b"".join(body), encoding, wants_msgpack)
+
+        await self.app(scope, receive, send_wrapper)
+
+    async def _send_encoded(self, send, start_message, body: bytes, encoding, wants_msgpack: bool):
+        headers = MutableHeaders(raw=start_message["headers"])
+        transformed = False
+
+        if wants_msgpack and body:
+            import msgpack
+
+            body = msgpack.packb(json.loads(body), use_bin_type=True)
+            headers["Content-Type"] = MSGPACK
+            headers.add_vary_header("Accept")
+            transformed = True
+
+        headers.add_vary_header("Accept-Encoding")
+        if encoding and len(body) >= self.minimum_size:
+            if encoding == "br":
+                import brotli
+
+                body = brotli.compress(body, quality=self.brotli_quality)
+            else:
+                body = gzip.compress(body, compresslevel=self.gzip_level)
+            headers["Content-Encoding"] = encoding
+            transformed = True
+
+        # A re-encoded body is only semantically equivalent to the original
+        etag = headers.get("etag")
+        if transformed and etag and not etag.startswith("W/"):
+            headers["ETag"] = f"W/{etag}"
+
+        headers["Content-Length"] = str(len(body))
+        await send(start_message)
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,67 @@
+"""Maintained invoice counters for O(1) dashboard statistics.
+
+``invoice_counters`` holds one document per branch with the number of
+completed and ongoing invoices. Invoice writes adjust it with ``$inc``;
+archived invoices stay counted as completed. Counters are seeded from the
+invoices once per tenant by the ``maintenance/backfills`` job and can be
+rebuilt at any time if they drift.
+"""
+from datetime import datetime
+from typing import Dict
+
+from archive import archived_invoice_count
+
+INVOICE_STATUSES = ("completed", "ongoing")
+# An invoice being completed is counted as ongoing until its completion moves the count
+COUNTED_AS = {"completing": "ongoing"}
+MIGRATION_ID = "invoice-counters"
+
+
+async def increment_invoice_count(db, branch_id: str, status: str, amount: int = 1):
+    await db.invoice_counters.update_one(
+        {"branch_id": branch_id}, {"$inc": {status: amount}}, upsert=True
+    )
+
+
+async def move_invoice_count(db, branch_id: str, from_status: str, to_status: str):
+    await db.invoice_counters.update_one(
+        {"branch_id": branch_id}, {"$inc": {from_status: -1, to_status: 1}}, upsert=True
+    )
+
+
+async def invoice_counts(db, branch_id: str = "") -> Dict[str, int]:
+    query = {"branch_id": branch_id} if branch_id else {}
+    counters = await db.invoice_counters.find(query).to_list(None)
+    return {status: sum(counter.get(status, 0) for counter in counters) for status in INVOICE_STATUSES}
+
+
+async def rebuild_invoice_counters(db) -> Dict[str, Dict[str, int]]:
+    """Recount invoices per branch and status and overwrite the counters"""
+    grouped = await db.invoices.aggregate([
+        {"$group": {"_id": {"branch_id": "$branch_id", "status": "$status"}, "count": {"$sum": 1}}}
+    ]).to_list(None)
+    totals: Dict[str, Dict[str, int]] = {}
+    for group in grouped:
+        status = COUNTED_AS.get(group["_id"]["status"], group["_id"]["status"])
+        if status not in INVOICE_STATUSES:
+            continue
+        branch_counts = totals.setdefault(group["_id"]["branch_id"], dict.fromkeys(INVOICE_STATUSES, 0))
+        branch_counts[status] += group["count"]
+
+    # Earlier rebuilds also wrote untracked statuses
+    await db.invoice_counters.update_many(
+        {}, {"$set": dict.fromkeys(INVOICE_STATUSES, 0), "$unset": dict.fromkeys(COUNTED_AS, "")}
+    )
+    archived_branches = await db.invoice_archive_totals.distinct("branch_id")
+    for branch_id in set(archived_branches) | set(totals):
+        branch_counts = totals.setdefault(branch_id, dict.fromkeys(INVOICE_STATUSES, 0))
+        branch_counts["completed"] += await archived_invoice_count(db, branch_id)
+        await db.invoice_counters.update_one({"branch_id": branch_id}, {"$set": branch_counts}, upsert=True)
+    return totals
+
+
+async def ensure_counters_seeded(db):
+    # Invoice writes create counters before seeding runs, so a marker records it
+    if not await db.migrations.find_one({"_id": MIGRATION_ID}):
+        await rebuild_invoice_counters(db)
+        await db.migrations.update_one({"_id": MIGRATION_ID}, {"$set": {"completed_at": datetime.utcnow()}}, upsert=True)
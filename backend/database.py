@@ -0,0 +1,196 @@
+"""MongoDB connection management.
+
+The Motor client is created when the application starts (see ``lifespan`` in
+server.py) rather than at import time, using pool and timeout settings read
+from the environment:
+
+=====================================  ==========================================
+MONGO_MAX_POOL_SIZE                    connections per worker process (100)
+MONGO_MIN_POOL_SIZE                    connections kept warm per worker (0)
+MONGO_MAX_IDLE_TIME_MS                 close pooled connections idle this long
+MONGO_WAIT_QUEUE_TIMEOUT_MS            fail requests waiting this long for a connection
+MONGO_SERVER_SELECTION_TIMEOUT_MS      give up finding a usable server (5000)
+MONGO_CONNECT_TIMEOUT_MS               TCP connect timeout (5000)
+MONGO_SOCKET_TIMEOUT_MS                per operation socket timeout (30000, 0 disables)
+MONGO_REPORT_READ_PREFERENCE           read preference for reports (secondaryPreferred)
+MONGO_REPORT_MAX_STALENESS_SECONDS     max replication lag tolerated for report reads
+MONGO_INVOICE_WRITE_CONCERN            ``w`` for invoice writes (majority)
+MONGO_INVOICE_JOURNAL                  journal invoice writes (true)
+=====================================  ==========================================
+
+Every worker process owns its own pool, so a deployment opens up to
+``workers * MONGO_MAX_POOL_SIZE`` connections.
+"""
+import os
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Optional
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.read_preferences import Nearest, Primary, PrimaryPreferred, Secondary, SecondaryPreferred
+from pymongo.write_concern import WriteConcern
+
+READ_PREFERENCES = {
+    "primary": Primary,
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest,
+}
+
+# Collections written with the stricter invoice write concern
+DURABLE_COLLECTIONS = ("invoices", "stock_transactions")
+
+DEFAULT_TENANT_ID = "default"
+
+
+@dataclass(frozen=True)
+class Tenant:
+    id: str
+    db_name: str
+
+
+# Tenant of the request or job being served; unset means the default tenant (DB_NAME)
+current_tenant: ContextVar[Optional[Tenant]] = ContextVar("current_tenant", default=None)
+
+
+def current_tenant_id() -> str:
+    tenant = current_tenant.get()
+    return tenant.id if tenant else DEFAULT_TENANT_ID
+
+
+def _optional_int(name: str) -> Optional[int]:
+    value = os.environ.get(name)
+    return int(value) if value else None
+
+
+@dataclass
+class DatabaseSettings:
+    mongo_url: str
+    db_name: str
+    max_pool_size: int = 100
+    min_pool_size: int = 0
+    max_idle_time_ms: Optional[int] = None
+    wait_queue_timeout_ms: Optional[int] = None
+    server_selection_timeout_ms: int = 5000
+    connect_timeout_ms: int = 5000
+    socket_timeout_ms: Optional[int] = 30000
+    report_read_preference: str = "secondaryPreferred"
+    report_max_staleness_seconds: Optional[int] = None
+    invoice_write_concern: str = "majority"
+    invoice_journal: bool = True
+
+    @classmethod
+    def from_env(cls) -> "DatabaseSettings":
+        read_preference = os.environ.get("MONGO_REPORT_READ_PREFERENCE", "secondaryPreferred")
+        if read_preference not in READ_PREFERENCES:
+            raise ValueError(f"MONGO_REPORT_READ_PREFERENCE must be one of: {', '.join(READ_PREFERENCES)}")
+        return cls(
+            mongo_url=os.environ['MONGO_URL'],
+            db_name=os.environ['DB_NAME'],
+            max_pool_size=int(os.environ.get("MONGO_MAX_POOL_SIZE", "100")),
+            min_pool_size=int(os.environ.get("MONGO_MIN_POOL_SIZE", "0")),
+            max_idle_time_ms=_optional_int("MONGO_MAX_IDLE_TIME_MS"),
+            wait_queue_timeout_ms=_optional_int("MONGO_WAIT_QUEUE_TIMEOUT_MS"),
+            server_selection_timeout_ms=int(os.environ.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000")),
+            connect_timeout_ms=int(os.environ.get("MONGO_CONNECT_TIMEOUT_MS", "5000")),
+            # 0 means no timeout, which Motor takes as None
+            socket_timeout_ms=int(os.environ.get("MONGO_SOCKET_TIMEOUT_MS", "30000")) or None,
+            report_read_preference=read_preference,
+            report_max_staleness_seconds=_optional_int("MONGO_REPORT_MAX_STALENESS_SECONDS"),
+            invoice_write_concern=os.environ.get("MONGO_INVOICE_WRITE_CONCERN", "majority"),
+            invoice_journal=os.environ.get("MONGO_INVOICE_JOURNAL", "true").lower() == "true",
+        )
+
+    def client_options(self) -> dict:
+        options = {
+            "maxPoolSize": self.max_pool_size,
+            "minPoolSize": self.min_pool_size,
+            "serverSelectionTimeoutMS": self.server_selection_timeout_ms,
+            "connectTimeoutMS": self.connect_timeout_ms,
+            "socketTimeoutMS": self.socket_timeout_ms,
+        }
+        if self.max_idle_time_ms is not None:
+            options["maxIdleTimeMS"] = self.max_idle_time_ms
+        if self.wait_queue_timeout_ms is not None:
+            options["waitQueueTimeoutMS"] = self.wait_queue_timeout_ms
+        return options
+
+    def read_preference(self):
+        preference = READ_PREFERENCES[self.report_read_preference]
+        if preference is Primary:
+            return Primary()
+        return preference(max_staleness=self.report_max_staleness_seconds or -1)
+
+    def write_concern(self) -> WriteConcern:
+        w = int(self.invoice_write_concern) if self.invoice_write_concern.isdigit() else self.invoice_write_concern
+        return WriteConcern(w=w, j=self.invoice_journal)
+
+
+class Database:
+    """Owns the Motor client and hands out databases configured per role.
+
+    ``default`` is used for request handling, ``reports`` reads with the
+    report read preference so heavy aggregations can be served by secondaries.
+    Databases belong to the current tenant; every tenant shares the one client
+    and its connection pool.
+    """
+
+    def __init__(self, settings: DatabaseSettings):
+        self.settings = settings
+        self.client: Optional[AsyncIOMotorClient] = None
+        self._databases = {}
+
+    def connect(self):
+        if self.client is None:
+            self.client = AsyncIOMotorClient(self.settings.mongo_url, **self.settings.client_options())
+            self._databases = {}
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+            self._databases = {}
+
+    def get(self, role: str = "default", db_name: Optional[str] = None):
+        if self.client is None:
+            raise RuntimeError("Database is not connected; it is opened by the application lifespan")
+        if db_name is None:
+            tenant = current_tenant.get()
+            db_name = tenant.db_name if tenant else self.settings.db_name
+        database = self._databases.get((db_name, role))
+        if database is None:
+            if role == "reports":
+                database = self.client.get_database(db_name, read_preference=self.settings.read_preference())
+            else:
+                database = self.client.get_database(db_name)
+            self._databases[(db_name, role)] = database
+        return database
+
+    def collection(self, role: str, name: str):
+        database = self.get(role)
+        if role == "default" and name in DURABLE_COLLECTIONS:
+            return database.get_collection(name, write_concern=self.settings.write_concern())
+        return database[name]
+
+
+class DatabaseProxy:
+    """Stand-in for a Motor database that resolves the connection on each access.
+
+    Lets route handlers keep using ``db.items`` while the client itself is
+    only created once the application starts.
+    """
+
+    def __init__(self, database: Database, role: str = "default"):
+        self._database = database
+        self._role = role
+
+    def __getattr__(self, name: str):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        if name in ("list_collection_names", "command", "get_collection", "aggregate"):
+            return getattr(self._database.get(self._role), name)
+        return self._database.collection(self._role, name)
+
+    def __getitem__(self, name: str):
+        return self._database.collection(self._role, name)
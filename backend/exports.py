@@ -0,0 +1,204 @@
+"""Columnar exports of completed invoices for analytics tools.
+
+Invoices are streamed from Mongo in chunks, flattened with pandas and appended
+to a Parquet or Arrow IPC file, so memory stays bounded by ``chunk_size``
+regardless of the size of the export. Two datasets are available:
+
+* ``invoices`` - one row per invoice header
+* ``lines``    - one row per ``InvoiceItem``, carrying its invoice's keys
+
+Amounts are stored in minor units (see money.py) and exported in currency
+units, converted a column at a time.
+
+pandas and pyarrow are only imported once an export actually runs, so they do
+not slow down API startup.
+
+Run from the command line with::
+
+    python exports.py 2024-01-01 2024-12-31 --dataset lines --output lines.parquet
+"""
+from __future__ import annotations
+
+import asyncio
+import functools
+from datetime import datetime
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from archive import invoice_sources
+from money import INVOICE_MONEY_FIELDS, LINE_MONEY_FIELDS
+
+if TYPE_CHECKING:
+    import pandas as pd
+    import pyarrow as pa
+
+EXPORT_DATASETS = ("invoices", "lines")
+EXPORT_FORMATS = {"parquet": ".parquet", "arrow": ".arrow"}
+
+
+@functools.lru_cache(maxsize=None)
+def dataset_schema(dataset: str) -> pa.Schema:
+    import pyarrow as pa
+
+    if dataset == "invoices":
+        return pa.schema([
+            ("id", pa.string()),
+            ("invoice_number", pa.string()),
+            ("branch_id", pa.string()),
+            ("customer_name", pa.string()),
+            ("customer_phone", pa.string()),
+            ("payment_mode", pa.string()),
+            ("line_count", pa.int32()),
+            ("subtotal", pa.float64()),
+            ("final_total", pa.float64()),
+            ("created_at", pa.timestamp("ms")),
+            ("updated_at", pa.timestamp("ms")),
+        ])
+    return pa.schema([
+        ("invoice_id", pa.string()),
+        ("invoice_number", pa.string()),
+        ("branch_id", pa.string()),
+        ("created_at", pa.timestamp("ms")),
+        ("line_no", pa.int32()),
+        ("item_id", pa.string()),
+        ("sku", pa.string()),
+        ("name", pa.string()),
+        ("quantity", pa.int64()),
+        ("unit_price", pa.float64()),
+        ("line_total", pa.float64()),
+        ("cost_price", pa.float64()),  # null for lines sold before cost snapshots
+    ])
+
+
+def invoice_frame(invoices) -> pd.DataFrame:
+    import pandas as pd
+
+    frame = pd.DataFrame.from_records(invoices, columns=[
+        "id", "invoice_number", "branch_id", "customer_name", "customer_phone",
+        "payment_mode", "items", "subtotal", "final_total", "created_at", "updated_at", "money_scale"
+    ])
+    frame["line_count"] = frame["items"].map(len)
+    _to_currency_units(frame, INVOICE_MONEY_FIELDS)
+    return frame.drop(columns=["items"])
+
+
+def line_frame(invoices) -> pd.DataFrame:
+    import pandas as pd
+
+    lines = [
+        {
+            "invoice_id": invoice["id"],
+            "invoice_number": invoice["invoice_number"],
+            "branch_id": invoice.get("branch_id", "main"),
+            "created_at": invoice["created_at"],
+            "line_no": line_no,
+            **{field: item[field] for field in ("item_id", "sku", "name", "quantity", "unit_price", "line_total")},
+            "cost_price": item.get("cost_price"),
+            "money_scale": invoice.get("money_scale"),
+        }
+        for invoice in invoices
+        for line_no, item in enumerate(invoice.get("items", []), start=1)
+    ]
+    frame = pd.DataFrame.from_records(lines, columns=[*dataset_schema("lines").names, "money_scale"])
+    _to_currency_units(frame, LINE_MONEY_FIELDS)
+    return frame
+
+
+def _to_currency_units(frame: pd.DataFrame, fields):
+    """Divide stored amounts by their document's scale; unmigrated documents already hold currency units"""
+    scale = frame.pop("money_scale").fillna(1)
+    for field in fields:
+        frame[field] = frame[field] / scale
+
+
+class _ChunkWriter:
+    def __init__(self, path: Path, schema: pa.Schema, file_format: str):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if file_format == "parquet":
+            self._writer = pq.ParquetWriter(path, schema, compression="zstd")
+        else:
+            self._writer = pa.ipc.new_file(str(path), schema)
+        self.schema = schema
+
+    def write(self, frame: pd.DataFrame):
+        import pyarrow as pa
+
+        self._writer.write_table(pa.Table.from_pandas(frame, schema=self.schema, preserve_index=False))
+
+    def close(self):
+        self._writer.close()
+
+
+async def export_invoices(db, path: Path, start_dt: datetime, end_dt: datetime, dataset: str = "invoices",
+                          file_format: str = "parquet", branch_id: str = "", chunk_size: int = 5000) -> int:
+    """Write completed invoices created between ``start_dt`` and ``end_dt`` to ``path``.
+
+    Archived invoices are included. Returns the number of rows written.
+    """
+    if dataset not in EXPORT_DATASETS:
+        raise ValueError(f"Unknown dataset '{dataset}'")
+    if file_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown format '{file_format}'")
+
+    query = {"status": "completed", "created_at": {"$gte": start_dt, "$lte": end_dt}}
+    if branch_id:
+        query["branch_id"] = branch_id
+
+    to_frame = invoice_frame if dataset == "invoices" else line_frame
+    schema = dataset_schema(dataset)
+    writer = await asyncio.to_thread(_ChunkWriter, path, schema, file_format)
+    rows = 0
+    try:
+        chunk = []
+        for collection in await invoice_sources(db, start_dt, end_dt):
+            cursor = collection.find(query, {"_id": 0}).sort("created_at", 1).batch_size(chunk_size)
+            async for invoice in cursor:
+                chunk.append(invoice)
+                if len(chunk) >= chunk_size:
+                    rows += await asyncio.to_thread(_write_chunk, writer, to_frame, chunk)
+                    chunk = []
+        if chunk:
+            rows += await asyncio.to_thread(_write_chunk, writer, to_frame, chunk)
+    finally:
+        await asyncio.to_thread(writer.close)
+    return rows
+
+
+def _write_chunk(writer: _ChunkWriter, to_frame, chunk) -> int:
+    frame = to_frame(chunk)
+    writer.write(frame)
+    return len(frame)
+
+
+if __name__ == "__main__":
+    import os
+
+    import typer
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    cli = typer.Typer(help="Export completed invoices to columnar files")
+
+    @cli.command()
+    def invoices(
+        start_date: str = typer.Argument(..., help="Start date in YYYY-MM-DD format"),
+        end_date: str = typer.Argument(..., help="End date in YYYY-MM-DD format"),
+        dataset: str = typer.Option("invoices", help="'invoices' or 'lines'"),
+        file_format: str = typer.Option("parquet", "--format", help="'parquet' or 'arrow'"),
+        branch_id: str = typer.Option("", help="Filter by branch"),
+        chunk_size: int = typer.Option(5000, help="Invoices held in memory at once"),
+        output: Path = typer.Option(None, help="Output file, defaults to <dataset>-<start>-<end>.<format>"),
+    ):
+        load_dotenv(Path(__file__).parent / '.env')
+        start_dt = datetime.strptime(start_date, "%Y-%m-%d")
+        end_dt = datetime.strptime(end_date, "%Y-%m-%d").replace(hour=23, minute=59, second=59)
+        output = output or Path(f"{dataset}-{start_date}-{end_date}{EXPORT_FORMATS[file_format]}")
+
+        client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+        db = client[os.environ['DB_NAME']]
+        rows = asyncio.run(export_invoices(db, output, start_dt, end_dt, dataset, file_format, branch_id, chunk_size))
+        typer.echo(f"Wrote {rows} rows to {output}")
+
+    cli()
@@ -0,0 +1,197 @@
+"""Demand forecasting and reorder points from the stock ledger.
+
+Mongo reduces the ``OUT`` transactions of the last ``history_days`` to one row
+per item and branch: units sold, the sum of squared daily units and the first
+day with a sale. From those numpy derives, for every row at once, the mean
+and variance of daily demand. Days without sales count as zero demand, and
+each row is measured from its first sale so new items are not diluted by the
+days before they existed. The reorder point is then::
+
+    mean * lead_time + z * std * sqrt(lead_time)
+
+where ``z`` is the normal quantile of the service level. Branch demands are
+summed per item, treating branches as independent, because stock is held per
+item. The results go to ``demand_forecasts`` (per item and branch), and each
+item's ``suggested_min_stock``, plus ``min_stock`` when ``apply`` is on, is
+written with bulk updates and announced as an ``item.updated`` event. Items
+without sales in the window are left alone.
+
+Runs may overlap, e.g. a scheduled run and one submitted by hand. Each run
+inserts its forecasts under its own ``run_id``; ``forecast_runs`` points at the
+latest-started run that has finished, and only runs older than that one are
+deleted. A run that is superseded before it finishes does not touch the items.
+
+See benchmarks/forecasting.py for the cost of the numpy step at 200k items.
+"""
+from __future__ import annotations
+
+import os
+import uuid
+from datetime import datetime, timedelta
+from statistics import NormalDist
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
+
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from outbox import EventFeed, event
+
+if TYPE_CHECKING:
+    import numpy as np
+
+FORECAST_HISTORY_DAYS = int(os.environ.get("FORECAST_HISTORY_DAYS", "365"))
+FORECAST_LEAD_TIME_DAYS = float(os.environ.get("FORECAST_LEAD_TIME_DAYS", "7"))
+FORECAST_SERVICE_LEVEL = float(os.environ.get("FORECAST_SERVICE_LEVEL", "0.95"))
+FORECAST_APPLY_MIN_STOCK = os.environ.get("FORECAST_APPLY_MIN_STOCK", "false").lower() == "true"
+
+CURRENT_RUN_ID = "demand"
+
+# Rows first seen less than this many days ago are measured over this many days
+MIN_OBSERVED_DAYS = 14
+WRITE_BATCH_SIZE = 1000
+
+
+def demand_pipeline(since: datetime) -> List[dict]:
+    return [
+        {"$match": {"transaction_type": "OUT", "created_at": {"$gte": since}}},
+        {"$group": {
+            "_id": {
+                "item_id": "$item_id",
+                "branch_id": "$branch_id",
+                "day": {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}},
+            },
+            "quantity": {"$sum": "$quantity"},
+        }},
+        {"$group": {
+            "_id": {"item_id": "$_id.item_id", "branch_id": "$_id.branch_id"},
+            "total": {"$sum": "$quantity"},
+            "sum_squares": {"$sum": {"$multiply": ["$quantity", "$quantity"]}},
+            "first_day": {"$min": "$_id.day"},
+        }},
+    ]
+
+
+async def current_forecast_run(db) -> Optional[str]:
+    """Run id of the forecasts to serve, the latest-started run that finished"""
+    current = await db.forecast_runs.find_one({"_id": CURRENT_RUN_ID})
+    return current["run_id"] if current else None
+
+
+async def _publish_run(db, run_id: str, started: datetime) -> bool:
+    """Point ``forecast_runs`` at this run unless a later-started one already finished"""
+    try:
+        await db.forecast_runs.update_one(
+            {"_id": CURRENT_RUN_ID, "started": {"$lt": started}},
+            {"$set": {"run_id": run_id, "started": started, "finished_at": datetime.utcnow()}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        pass  # a later-started run holds the pointer
+    current = await db.forecast_runs.find_one({"_id": CURRENT_RUN_ID})
+    await db.demand_forecasts.delete_many({"created_at": {"$lt": current["started"]}})
+    return current["run_id"] == run_id
+
+
+def reorder_points(total: np.ndarray, sum_squares: np.ndarray, observed_days: np.ndarray,
+                   lead_time_days: float, service_level: float) -> Dict[str, np.ndarray]:
+    """Daily demand statistics and reorder points for every row at once"""
+    import numpy as np
+
+    z = NormalDist().inv_cdf(service_level)
+    mean = total / observed_days
+    variance = np.maximum(sum_squares / observed_days - mean ** 2, 0.0)
+    reorder_point = mean * lead_time_days + z * np.sqrt(variance * lead_time_days)
+    return {"daily_mean": mean, "daily_variance": variance, "reorder_point": reorder_point}
+
+
+def item_reorder_points(item_codes: np.ndarray, item_count: int, daily_mean: np.ndarray, daily_variance: np.ndarray,
+                        lead_time_days: float, service_level: float) -> np.ndarray:
+    """Combine per-branch demand into one reorder point per item"""
+    import numpy as np
+
+    z = NormalDist().inv_cdf(service_level)
+    mean = np.bincount(item_codes, weights=daily_mean, minlength=item_count)
+    variance = np.bincount(item_codes, weights=daily_variance, minlength=item_count)
+    reorder_point = mean * lead_time_days + z * np.sqrt(variance * lead_time_days)
+    return np.maximum(np.ceil(reorder_point), 1).astype(np.int64)
+
+
+async def forecast_demand(db, history_days: int = FORECAST_HISTORY_DAYS, lead_time_days: float = FORECAST_LEAD_TIME_DAYS,
+                          service_level: float = FORECAST_SERVICE_LEVEL, apply: bool = FORECAST_APPLY_MIN_STOCK,
+                          events: Optional[EventFeed] = None) -> Dict[str, Any]:
+    import numpy as np
+
+    started = datetime.utcnow()
+    today = started.date()
+    rows = await db.stock_transactions.aggregate(
+        demand_pipeline(datetime.combine(today - timedelta(days=history_days - 1), datetime.min.time())),
+        allowDiskUse=True
+    ).to_list(None)
+    if not rows:
+        return {"rows": 0, "items": 0, "updated_items": 0}
+
+    count = len(rows)
+    total = np.fromiter((row["total"] for row in rows), dtype=np.float64, count=count)
+    sum_squares = np.fromiter((row["sum_squares"] for row in rows), dtype=np.float64, count=count)
+    first_day = np.array([row["first_day"] for row in rows], dtype="datetime64[D]")
+    observed_days = (np.datetime64(today, "D") - first_day).astype(np.int64) + 1
+    observed_days = np.clip(observed_days, MIN_OBSERVED_DAYS, history_days).astype(np.float64)
+
+    branch_stats = reorder_points(total, sum_squares, observed_days, lead_time_days, service_level)
+    item_ids, item_codes = np.unique(np.array([row["_id"]["item_id"] for row in rows], dtype=object), return_inverse=True)
+    min_stock = item_reorder_points(item_codes, len(item_ids), branch_stats["daily_mean"], branch_stats["daily_variance"],
+                                    lead_time_days, service_level)
+
+    # Per item and branch forecasts, served once this run is published
+    run_id = str(uuid.uuid4())
+    forecasts = [
+        {
+            "run_id": run_id,
+            "item_id": row["_id"]["item_id"],
+            "branch_id": row["_id"]["branch_id"],
+            "units_sold": int(total[index]),
+            "observed_days": int(observed_days[index]),
+            "daily_mean": float(branch_stats["daily_mean"][index]),
+            "daily_std": float(np.sqrt(branch_stats["daily_variance"][index])),
+            "reorder_point": float(branch_stats["reorder_point"][index]),
+            "created_at": started,
+        }
+        for index, row in enumerate(rows)
+    ]
+    for start in range(0, len(forecasts), WRITE_BATCH_SIZE):
+        await db.demand_forecasts.insert_many(forecasts[start:start + WRITE_BATCH_SIZE], ordered=False)
+    if not await _publish_run(db, run_id, started):
+        return {"rows": count, "items": len(item_ids), "updated_items": 0, "superseded": True}
+
+    # Only write items whose values change
+    current = {
+        item["id"]: item
+        for item in await db.items.find({}, {"_id": 0, "id": 1, "min_stock": 1, "suggested_min_stock": 1}).to_list(None)
+    }
+    changes = []
+    for item_id, value in zip(item_ids.tolist(), min_stock.tolist()):
+        item = current.get(item_id)
+        if item is None:
+            continue
+        fields = {"suggested_min_stock": value}
+        if apply:
+            fields["min_stock"] = value
+        changed = {field: field_value for field, field_value in fields.items() if item.get(field) != field_value}
+        if changed:
+            changes.append((item_id, changed))
+    for start in range(0, len(changes), WRITE_BATCH_SIZE):
+        batch = changes[start:start + WRITE_BATCH_SIZE]
+        written_at = datetime.utcnow()
+        await db.items.bulk_write([
+            UpdateOne({"id": item_id}, {"$set": {**changed, "updated_at": written_at}}) for item_id, changed in batch
+        ], ordered=False)
+        if events:
+            await events.publish(db, [event("item.updated", item_id, **changed) for item_id, changed in batch])
+
+    return {
+        "rows": count,
+        "items": len(item_ids),
+        "updated_items": len(changes),
+        "applied_to_min_stock": apply,
+        "seconds": round((datetime.utcnow() - started).total_seconds(), 2),
+    }
@@ -0,0 +1,43 @@
+"""Multi-worker deployment profile.
+
+Run the API across all cores with::
+
+    gunicorn -c gunicorn.conf.py server:app
+
+Each worker is a separate process with its own Motor connection pool, job
+workers and report cache, so size ``MONGO_MAX_POOL_SIZE`` so that
+``WEB_CONCURRENCY * MONGO_MAX_POOL_SIZE`` stays within the server's
+connection limit. State the workers must agree on lives in Mongo:
+
+* job status, so polling may hit any worker; result files are shared
+  through ``JOB_RESULTS_DIR``, which must be on a filesystem visible to
+  every worker
+* scheduled job runs, claimed by one worker each (see jobs.py)
+* the report cache version stamp, so a worker drops cached reports another
+  worker invalidated (see report_cache.py)
+
+Workers are async and each runs background jobs, so there is one per core and
+they are not recycled by request count. A stopping worker lets its running
+jobs finish for ``JOB_DRAIN_SECONDS`` (see jobs.py); ``graceful_timeout``
+leaves room for that before the worker is killed.
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get("BIND", "0.0.0.0:8001")
+# An async worker keeps a core busy on its own; more would only compete for it
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# Recycling interrupts running jobs, so it is off unless MAX_REQUESTS is set
+max_requests = int(os.environ.get("MAX_REQUESTS", "0"))
+max_requests_jitter = int(os.environ.get("MAX_REQUESTS_JITTER", "0"))
+
+# Reports may legitimately run for a while; keep this above the proxy timeout
+timeout = int(os.environ.get("WORKER_TIMEOUT", "120"))
+# Time to finish in-flight requests and drain running jobs on shutdown
+graceful_timeout = int(os.environ.get("GRACEFUL_TIMEOUT", float(os.environ.get("JOB_DRAIN_SECONDS", "120")) + 30))
+keepalive = int(os.environ.get("KEEPALIVE", "5"))
+
+accesslog = "-"
+errorlog = "-"
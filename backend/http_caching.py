@@ -0,0 +1,63 @@
+"""ETag / Last-Modified helpers for conditional GETs on read endpoints."""
+import hashlib
+import json
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Optional
+
+from fastapi import Request, Response
+
+# Completed invoices never change, let clients keep them for a year
+IMMUTABLE = "private, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+# Fields needed to compute a version-based ETag without loading the document
+VERSION_FIELDS = ("id", "updated_at", "status")
+VERSION_PROJECTION = {"_id": 0, **{field: 1 for field in VERSION_FIELDS}}
+
+
+def version_etag(doc: dict) -> str:
+    """ETag from a document's id and ``updated_at``"""
+    updated_at = doc["updated_at"].replace(tzinfo=None).isoformat(timespec="milliseconds")
+    return f'"{doc["id"]}-{updated_at}"'
+
+
+def content_etag(value) -> str:
+    """ETag from a hash of the content, for documents without ``updated_at``"""
+    payload = json.dumps(value, sort_keys=True, default=str).encode()
+    return f'"{hashlib.blake2b(payload, digest_size=12).hexdigest()}"'
+
+
+def http_date(moment: datetime) -> str:
+    return format_datetime(moment.replace(tzinfo=timezone.utc, microsecond=0), usegmt=True)
+
+
+def is_not_modified(request: Request, etag: str, last_modified: Optional[datetime] = None) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in candidates or etag in candidates
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        return last_modified.replace(tzinfo=timezone.utc, microsecond=0) <= since
+    return False
+
+
+def is_conditional(request: Request) -> bool:
+    return "if-none-match" in request.headers or "if-modified-since" in request.headers
+
+
+def cache_headers(etag: str, last_modified: Optional[datetime] = None, cache_control: str = REVALIDATE) -> dict:
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if last_modified is not None:
+        headers["Last-Modified"] = http_date(last_modified)
+    return headers
+
+
+def not_modified(headers: dict) -> Response:
+    return Response(status_code=304, headers=headers)
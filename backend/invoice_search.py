@@ -0,0 +1,164 @@
+"""Invoice search for counter staff, e.g. finding a past sale for a warranty claim.
+
+Filters combine freely: a prefix of ``invoice_number``, a prefix of the
+customer's phone number or name, a date range and a range of ``final_total``.
+Phone and name are matched on normalised keys stored with each invoice
+(``customer_phone_key``: digits only, ``customer_name_key``: lower case with
+single spaces), so the prefix is an anchored regex that can use an index.
+Invoices written before the keys existed are backfilled once per tenant by
+the ``maintenance/backfills`` job.
+
+Results are newest first, with only the fields a result list needs. Pages
+are keyset-paginated on ``(created_at, id)``: the ``next`` token holds the
+last invoice returned, and the following page starts after it, so page 1000
+costs the same as page 1. Each collection (the hot invoices and the archive
+partitions covering the date range) returns at most one page, and the
+results are merged.
+"""
+import re
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+
+from archive import ARCHIVE_PREFIX, partitions_for_range
+from money import from_minor, stored_minor, to_minor
+from orchestration import gather_queries
+
+SEARCH_INDEXES = [
+    [("created_at", DESCENDING), ("id", DESCENDING)],
+    [("invoice_number", ASCENDING)],
+    [("customer_phone_key", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)],
+    [("customer_name_key", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)],
+]
+
+SUMMARY_FIELDS = {
+    "_id": 0, "id": 1, "invoice_number": 1, "branch_id": 1, "customer_name": 1, "customer_phone": 1,
+    "final_total": 1, "money_scale": 1, "payment_mode": 1, "status": 1, "created_at": 1,
+}
+
+MIGRATION_ID = "invoice-search-keys"
+BACKFILL_BATCH_SIZE = 500
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def phone_key(phone: str) -> str:
+    return re.sub(r"\D", "", phone or "")
+
+
+def name_key(name: str) -> str:
+    return " ".join((name or "").lower().split())
+
+
+def search_keys(customer_name: str, customer_phone: str) -> Dict[str, str]:
+    return {"customer_name_key": name_key(customer_name), "customer_phone_key": phone_key(customer_phone)}
+
+
+async def ensure_search_indexes(db):
+    """Search indexes on the hot invoices and every archive partition"""
+    partitions = await db.list_collection_names(filter={"name": {"$regex": f"^{ARCHIVE_PREFIX}"}})
+    for name in ["invoices", *partitions]:
+        for keys in SEARCH_INDEXES:
+            await db[name].create_index(keys)
+
+
+async def ensure_search_keys(db):
+    """Add search keys to invoices written before they existed, once per tenant"""
+    if await db.migrations.find_one({"_id": MIGRATION_ID}):
+        return
+    partitions = await db.list_collection_names(filter={"name": {"$regex": f"^{ARCHIVE_PREFIX}"}})
+    backfilled = 0
+    for name in ["invoices", *partitions]:
+        missing = {"customer_name_key": {"$exists": False}}
+        while True:
+            batch = await db[name].find(missing, {"customer_name": 1, "customer_phone": 1}).limit(
+                BACKFILL_BATCH_SIZE).to_list(BACKFILL_BATCH_SIZE)
+            if not batch:
+                break
+            await db[name].bulk_write([
+                UpdateOne({"_id": invoice["_id"]}, {"$set": search_keys(
+                    invoice.get("customer_name", ""), invoice.get("customer_phone", "")
+                )})
+                for invoice in batch
+            ], ordered=False)
+            backfilled += len(batch)
+    await db.migrations.update_one(
+        {"_id": MIGRATION_ID}, {"$set": {"completed_at": datetime.utcnow(), "backfilled": backfilled}}, upsert=True
+    )
+
+
+def encode_cursor(invoice: dict) -> str:
+    milliseconds = (invoice["created_at"] - _EPOCH) // timedelta(milliseconds=1)
+    return f"{milliseconds}.{invoice['id']}"
+
+
+def decode_cursor(token: str) -> Tuple[datetime, str]:
+    milliseconds, _, invoice_id = token.partition(".")
+    if not milliseconds.isdigit() or not invoice_id:
+        raise HTTPException(status_code=400, detail="Invalid search cursor")
+    return _EPOCH + timedelta(milliseconds=int(milliseconds)), invoice_id
+
+
+def _prefix(value: str) -> dict:
+    return {"$regex": f"^{re.escape(value)}"}
+
+
+def search_query(number: str = "", phone: str = "", name: str = "", start: Optional[datetime] = None,
+                 end: Optional[datetime] = None, min_total: Optional[float] = None, max_total: Optional[float] = None,
+                 status: str = "", branch_id: str = "", after: str = "") -> dict:
+    query = {}
+    if number:
+        query["invoice_number"] = _prefix(number.strip().upper())
+    if phone:
+        if not phone_key(phone):
+            raise HTTPException(status_code=400, detail="Phone must contain digits")
+        query["customer_phone_key"] = _prefix(phone_key(phone))
+    if name:
+        query["customer_name_key"] = _prefix(name_key(name))
+    if start or end:
+        query["created_at"] = {**({"$gte": start} if start else {}), **({"$lte": end} if end else {})}
+    if min_total is not None or max_total is not None:
+        query["final_total"] = {
+            **({"$gte": to_minor(min_total)} if min_total is not None else {}),
+            **({"$lte": to_minor(max_total)} if max_total is not None else {}),
+        }
+    if status:
+        query["status"] = status
+    if branch_id:
+        query["branch_id"] = branch_id
+    if after:
+        created_at, invoice_id = decode_cursor(after)
+        query["$or"] = [
+            {"created_at": {"$lt": created_at}},
+            {"created_at": created_at, "id": {"$lt": invoice_id}},
+        ]
+    return query
+
+
+def summary(invoice: dict) -> dict:
+    invoice = {**invoice, "final_total": from_minor(stored_minor(invoice, "final_total"))}
+    invoice.pop("money_scale", None)
+    return invoice
+
+
+async def search_invoices(db, query: dict, start: Optional[datetime], end: Optional[datetime],
+                          limit: int, include_archive: bool = True) -> Dict:
+    collections = [db.invoices]
+    if include_archive:
+        collections += [db[partition] for partition in await partitions_for_range(db, start, end)]
+    results = await gather_queries({
+        collection.name: (lambda collection=collection: collection.find(query, SUMMARY_FIELDS)
+                          .sort([("created_at", DESCENDING), ("id", DESCENDING)]).limit(limit).to_list(limit))
+        for collection in collections
+    })
+    invoices: List[dict] = sorted(
+        (invoice for found in results.values() for invoice in found),
+        key=lambda invoice: (invoice["created_at"], invoice["id"]),
+        reverse=True
+    )[:limit]
+    return {
+        "invoices": [summary(invoice) for invoice in invoices],
+        "next": encode_cursor(invoices[-1]) if len(invoices) == limit else None,
+    }
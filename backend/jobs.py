@@ -0,0 +1,373 @@
+"""Background job queue for long-running reports and exports.
+
+Jobs are submitted over the API, recorded in the ``jobs`` collection and
+executed by a small pool of asyncio workers inside the API process. Results
+are written to files under ``JOB_RESULTS_DIR`` so they can be downloaded once
+the job has completed.
+
+Each job runs in the tenant it was submitted for. The owning process
+heartbeats its queued and running jobs; a job whose heartbeat stops (its
+process died) is reported as failed the next time it is read.
+
+Scheduled jobs are due at ``next_run_at`` in the ``job_schedules``
+collection. Every worker process polls the schedules, and the one whose
+update moves ``next_run_at`` forward submits the run, so a schedule fires once
+per interval however many workers there are, and restarting a worker does
+not restart the interval.
+
+On shutdown the process stops taking jobs and gives running ones up to
+``drain_seconds`` to finish. Jobs still running after that, or queued and
+never started, are marked failed at once, and a scheduled run among them is
+made due again so another process picks it up.
+"""
+import asyncio
+import inspect
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from fastapi import HTTPException, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.params import Param
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
+from pymongo.errors import DuplicateKeyError
+
+from database import current_tenant
+
+logger = logging.getLogger(__name__)
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_COMPLETED = "completed"
+JOB_FAILED = "failed"
+
+HEARTBEAT_SECONDS = 30
+STALE_AFTER_SECONDS = 4 * HEARTBEAT_SECONDS
+MAX_SCHEDULE_POLL_SECONDS = 60
+PROCESS_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+class Job(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    kind: str
+    params: Dict[str, Any] = {}
+    status: str = JOB_QUEUED  # "queued", "running", "completed" or "failed"
+    error: Optional[str] = None
+    result_file: Optional[str] = None
+    result_media_type: Optional[str] = None
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    owner: Optional[str] = None
+    heartbeat_at: Optional[datetime] = None
+
+
+class JobCreate(BaseModel):
+    kind: str
+    params: Dict[str, Any] = {}
+
+
+class JobManager:
+    """Runs registered job kinds on a bounded pool of asyncio workers.
+
+    A runner is any coroutine function whose keyword arguments are filled from
+    the submitted ``params`` — route handlers can be registered as-is, their
+    ``Query`` defaults are honoured. A runner may declare a parameter
+    annotated with ``Job`` to receive the job being executed, and may return
+    a ``Path`` to a file it wrote itself instead of a JSON-serialisable value.
+    """
+
+    def __init__(self, db, results_dir: Path, concurrency: int = 2, max_queued: int = 100,
+                 retention_hours: int = 72, drain_seconds: float = 0, tenants=None):
+        self.db = db
+        self.tenants = tenants
+        self.results_dir = Path(results_dir)
+        self.concurrency = concurrency
+        self.retention_hours = retention_hours
+        self.drain_seconds = drain_seconds
+        self.runners: Dict[str, Callable[..., Awaitable[Any]]] = {}
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queued)
+        self._workers = []
+        self._schedules = []
+        self._active: Dict[str, Any] = {}  # job id -> tenant, for heartbeats
+        self._running: Dict[str, asyncio.Task] = {}
+        self._scheduled = set()  # ids of jobs submitted by the scheduler
+        self._stopping = False
+
+    def register(self, kind: str, runner: Callable[..., Awaitable[Any]]):
+        self.runners[kind] = runner
+
+    def schedule(self, kind: str, interval_seconds: float, params: Optional[Dict[str, Any]] = None):
+        """Submit ``kind`` every ``interval_seconds``, once per tenant across all worker processes"""
+        self._schedules.append((kind, interval_seconds, params or {}))
+
+    async def start(self):
+        self._stopping = False
+        self.results_dir.mkdir(parents=True, exist_ok=True)
+        await asyncio.to_thread(self._purge_old_results)
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        self._workers.append(asyncio.create_task(self._heartbeat()))
+        if self._schedules:
+            self._workers.append(asyncio.create_task(self._scheduler()))
+
+    async def stop(self):
+        """Let running jobs finish for up to ``drain_seconds``, then fail whatever did not finish"""
+        self._stopping = True
+        if self._running and self.drain_seconds > 0:
+            await asyncio.wait(list(self._running.values()), timeout=self.drain_seconds)
+        unfinished, scheduled = dict(self._active), set(self._scheduled)
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        while not self._queue.empty():
+            self._queue.get_nowait()
+            self._queue.task_done()
+        await self._interrupt(unfinished, scheduled)
+
+    async def _interrupt(self, jobs: Dict[str, Any], scheduled: set):
+        for job_id, tenant in jobs.items():
+            token = current_tenant.set(tenant)
+            try:
+                job = await self.db.jobs.find_one_and_update(
+                    {"id": job_id, "status": {"$in": [JOB_QUEUED, JOB_RUNNING]}},
+                    {"$set": {"status": JOB_FAILED, "error": "Interrupted by server shutdown",
+                              "finished_at": datetime.utcnow()}},
+                    projection={"_id": 0, "kind": 1}
+                )
+                if job and job_id in scheduled:
+                    # Due again, so the next process to poll runs it instead of waiting a whole interval
+                    await self.db.job_schedules.update_one(
+                        {"_id": job["kind"], "claimed_by": PROCESS_ID}, {"$set": {"next_run_at": datetime.utcnow()}}
+                    )
+            except Exception:
+                logger.exception("Could not record interrupted job %s", job_id)
+            finally:
+                current_tenant.reset(token)
+        self._scheduled.clear()
+
+    async def submit(self, kind: str, params: Dict[str, Any]) -> Job:
+        runner = self.runners.get(kind)
+        if runner is None:
+            raise HTTPException(status_code=404, detail=f"Unknown job kind '{kind}'")
+        if self._stopping:
+            raise HTTPException(status_code=503, detail="Server is shutting down, try again shortly",
+                                headers={"Retry-After": "30"})
+        if self._queue.full():
+            raise HTTPException(status_code=503, detail="Job queue is full, try again later",
+                                headers={"Retry-After": "30"})
+
+        # Validate parameters up front so bad requests fail at submission
+        bind_params(runner, params)
+
+        job = Job(kind=kind, params=params, owner=PROCESS_ID, heartbeat_at=datetime.utcnow())
+        await self.db.jobs.insert_one(job.dict())
+        tenant = current_tenant.get()
+        self._active[job.id] = tenant
+        try:
+            self._queue.put_nowait((tenant, job.id))
+        except asyncio.QueueFull:
+            # Filled up by other submissions while the job was being stored
+            self._active.pop(job.id, None)
+            await self.db.jobs.update_one({"id": job.id}, {"$set": {
+                "status": JOB_FAILED, "error": "Job queue was full", "finished_at": datetime.utcnow()
+            }})
+            raise HTTPException(status_code=503, detail="Job queue is full, try again later",
+                                headers={"Retry-After": "30"})
+        return job
+
+    async def get(self, job_id: str) -> Job:
+        job = await self.db.jobs.find_one({"id": job_id})
+        if not job:
+            raise HTTPException(status_code=404, detail="Job not found")
+        job = Job(**job)
+
+        stale_before = datetime.utcnow() - timedelta(seconds=STALE_AFTER_SECONDS)
+        if job.status in (JOB_QUEUED, JOB_RUNNING) and job.heartbeat_at and job.heartbeat_at < stale_before:
+            # The owning process stopped without finishing the job
+            job.status, job.error, job.finished_at = JOB_FAILED, "Interrupted by server restart", datetime.utcnow()
+            await self.db.jobs.update_one(
+                {"id": job.id, "status": {"$in": [JOB_QUEUED, JOB_RUNNING]}},
+                {"$set": {"status": job.status, "error": job.error, "finished_at": job.finished_at}}
+            )
+        return job
+
+    def result_path(self, job: Job, suffix: str) -> Path:
+        return self.results_dir / f"{job.id}{suffix}"
+
+    async def _worker(self):
+        while True:
+            tenant, job_id = await self._queue.get()
+            if self._stopping:
+                # Left queued; stop fails it
+                self._queue.task_done()
+                continue
+            token = current_tenant.set(tenant)
+            try:
+                self._running[job_id] = asyncio.create_task(self._run(job_id))
+                await self._running[job_id]
+            except Exception:
+                logger.exception("Job %s crashed the worker loop", job_id)
+            finally:
+                current_tenant.reset(token)
+                self._running.pop(job_id, None)
+                self._active.pop(job_id, None)
+                self._scheduled.discard(job_id)
+                self._queue.task_done()
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT_SECONDS)
+            by_tenant: Dict[Any, list] = {}
+            for job_id, tenant in list(self._active.items()):
+                by_tenant.setdefault(tenant, []).append(job_id)
+            for tenant, job_ids in by_tenant.items():
+                token = current_tenant.set(tenant)
+                try:
+                    await self.db.jobs.update_many(
+                        {"id": {"$in": job_ids}, "status": {"$in": [JOB_QUEUED, JOB_RUNNING]}},
+                        {"$set": {"heartbeat_at": datetime.utcnow()}}
+                    )
+                except Exception:
+                    logger.exception("Could not record job heartbeats")
+                finally:
+                    current_tenant.reset(token)
+
+    async def claim_schedule(self, kind: str, interval_seconds: float) -> bool:
+        """Move the schedule of ``kind`` to its next run if it is due; True for the one caller that did"""
+        now = datetime.utcnow()
+        claim = {"next_run_at": now + timedelta(seconds=interval_seconds), "claimed_by": PROCESS_ID, "claimed_at": now}
+        result = await self.db.job_schedules.update_one({"_id": kind, "next_run_at": {"$lte": now}}, {"$set": claim})
+        if result.modified_count:
+            return True
+        if await self.db.job_schedules.find_one({"_id": kind}, {"_id": 1}):
+            return False
+        # A schedule that never ran is due now
+        try:
+            await self.db.job_schedules.insert_one({"_id": kind, **claim})
+        except DuplicateKeyError:
+            return False
+        return True
+
+    async def _scheduler(self):
+        poll_seconds = min(MAX_SCHEDULE_POLL_SECONDS, *(interval for _, interval, _ in self._schedules))
+        while True:
+            try:
+                tenants = await self.tenants.all() if self.tenants else [None]
+            except Exception:
+                logger.exception("Could not load tenants for scheduled jobs")
+                tenants = []
+            for tenant in tenants:
+                for kind, interval, params in self._schedules:
+                    try:
+                        if tenant is None:
+                            if await self.claim_schedule(kind, interval):
+                                self._scheduled.add((await self.submit(kind, params)).id)
+                        else:
+                            async with self.tenants.scope(tenant):
+                                if await self.claim_schedule(kind, interval):
+                                    self._scheduled.add((await self.submit(kind, params)).id)
+                    except Exception:
+                        logger.exception("Could not submit scheduled %s job", kind)
+            await asyncio.sleep(poll_seconds)
+
+    async def _run(self, job_id: str):
+        job = await self.get(job_id)
+        started_at = datetime.utcnow()
+        await self.db.jobs.update_one(
+            {"id": job.id}, {"$set": {"status": JOB_RUNNING, "started_at": started_at}}
+        )
+        job.status, job.started_at = JOB_RUNNING, started_at
+
+        runner = self.runners[job.kind]
+        try:
+            result = await runner(**bind_params(runner, job.params, job=job))
+            if isinstance(result, Path):
+                result_file = result
+            else:
+                result_file = self.result_path(job, ".json")
+                payload = json.dumps(jsonable_encoder(result))
+                await asyncio.to_thread(result_file.write_text, payload)
+        except Exception as exc:
+            logger.exception("Job %s (%s) failed", job.id, job.kind)
+            detail = exc.detail if isinstance(exc, HTTPException) else str(exc)
+            await self.db.jobs.update_one(
+                {"id": job.id},
+                {"$set": {"status": JOB_FAILED, "error": str(detail), "finished_at": datetime.utcnow()}}
+            )
+            return
+
+        await self.db.jobs.update_one(
+            {"id": job.id},
+            {"$set": {
+                "status": JOB_COMPLETED,
+                "result_file": result_file.name,
+                "result_media_type": media_type_for(result_file),
+                "finished_at": datetime.utcnow()
+            }}
+        )
+
+    def _purge_old_results(self):
+        cutoff = time.time() - self.retention_hours * 3600
+        for path in self.results_dir.iterdir():
+            if path.is_file() and path.stat().st_mtime < cutoff:
+                path.unlink(missing_ok=True)
+
+
+def bind_params(runner: Callable, params: Dict[str, Any], job: Optional[Job] = None) -> Dict[str, Any]:
+    """Build keyword arguments for ``runner`` from job parameters"""
+    unknown = set(params) - set(inspect.signature(runner).parameters)
+    if unknown:
+        raise HTTPException(status_code=422, detail=f"Unknown parameters: {', '.join(sorted(unknown))}")
+
+    kwargs = {}
+    for name, parameter in inspect.signature(runner).parameters.items():
+        annotation = parameter.annotation
+        if annotation is Job:
+            kwargs[name] = job
+            continue
+        if annotation is Response:
+            kwargs[name] = Response()
+            continue
+        if annotation is Request:
+            raise TypeError(f"Job runner {runner.__name__} cannot depend on the request")
+
+        if name not in params:
+            default = parameter.default
+            if isinstance(default, Param):
+                default = inspect.Parameter.empty if default.is_required() else default.default
+            if default is inspect.Parameter.empty:
+                raise HTTPException(status_code=422, detail=f"Missing parameter '{name}'")
+            kwargs[name] = default
+            continue
+
+        try:
+            kwargs[name] = TypeAdapter(annotation).validate_python(params[name])
+        except ValidationError as exc:
+            raise HTTPException(status_code=422, detail=f"Invalid parameter '{name}': {exc.errors()[0]['msg']}")
+    return kwargs
+
+
+def media_type_for(path: Path) -> str:
+    return {
+        ".json": "application/json",
+        ".parquet": "application/vnd.apache.parquet",
+        ".arrow": "application/vnd.apache.arrow.file",
+        ".csv": "text/csv",
+    }.get(path.suffix, "application/octet-stream")
+
+
+def job_settings_from_env() -> Dict[str, Any]:
+    return {
+        "results_dir": Path(os.environ.get("JOB_RESULTS_DIR", Path(__file__).parent / "job_results")),
+        "concurrency": int(os.environ.get("JOB_CONCURRENCY", "2")),
+        "max_queued": int(os.environ.get("JOB_MAX_QUEUED", "100")),
+        "retention_hours": int(os.environ.get("JOB_RETENTION_HOURS", "72")),
+        "drain_seconds": float(os.environ.get("JOB_DRAIN_SECONDS", "120")),
+    }
@@ -0,0 +1,187 @@
+"""Write-behind queue for the stock transaction ledger.
+
+Checkout no longer inserts ``stock_transactions`` one line at a time. Instead
+``StockLedger.record`` appends the entries to a local spill file (flushed and,
+by default, fsynced) and to an in-memory buffer. A background task writes the
+buffer through the stock transaction repository (see repositories.py) once it
+holds ``batch_size`` entries or every ``flush_seconds``, whichever comes first.
+
+Spill files are segments named ``ledger-<pid>-<n>.jsonl``. A flush rotates to
+a new segment and deletes the old ones once Mongo has acknowledged their
+entries. Each process holds a ``flock`` on its segments, so at startup a
+process can tell which segments a crashed process left behind. It replays
+those segments and deletes them. Entries keep their ``id`` and the ledger has
+a unique index on it, so an entry that is written twice is only stored once.
+"""
+import asyncio
+import fcntl
+import json
+import logging
+import os
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi.encoders import jsonable_encoder
+
+from database import Tenant, current_tenant
+
+logger = logging.getLogger(__name__)
+
+
+class StockLedger:
+    def __init__(self, transactions, spill_dir: Path, batch_size: int = 500, flush_seconds: float = 1.0, fsync: bool = True):
+        self.transactions = transactions
+        self.spill_dir = Path(spill_dir)
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.fsync = fsync
+        self._buffer: List[Tuple[Optional[Tenant], dict]] = []
+        self._segment = None
+        self._segment_number = 0
+        self._closed_segments = []
+        self._io_lock = asyncio.Lock()
+        self._flush_lock = asyncio.Lock()
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.flushed = 0
+        self.replayed = 0
+
+    async def start(self):
+        self.spill_dir.mkdir(parents=True, exist_ok=True)
+        self.replayed = await self.replay()
+        self._segment = self._open_segment()
+        self._task = asyncio.create_task(self._flusher())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception("Could not flush %d ledger entries at shutdown; they will be replayed", len(self._buffer))
+        if self._segment:
+            self._segment.close()
+            if not self._buffer:
+                Path(self._segment.name).unlink(missing_ok=True)
+            self._segment = None
+
+    async def record(self, transactions: List[dict]):
+        """Durably queue ledger entries; they reach Mongo within ``flush_seconds``"""
+        if not transactions:
+            return
+        tenant = current_tenant.get()
+        lines = "".join(
+            json.dumps({
+                "tenant": [tenant.id, tenant.db_name] if tenant else None,
+                "entry": jsonable_encoder(transaction),
+            }) + "\n"
+            for transaction in transactions
+        )
+        async with self._io_lock:
+            self._segment.write(lines)
+            self._segment.flush()
+            self._buffer.extend((tenant, transaction) for transaction in transactions)
+            if self.fsync:
+                await asyncio.to_thread(os.fsync, self._segment.fileno())
+        if len(self._buffer) >= self.batch_size:
+            self._wake.set()
+
+    async def flush(self) -> int:
+        """Write buffered entries to Mongo; returns how many were written"""
+        async with self._flush_lock:
+            async with self._io_lock:
+                if not self._buffer:
+                    return 0
+                entries, self._buffer = self._buffer, []
+                self._closed_segments.append(self._segment)
+                self._segment = self._open_segment()
+            try:
+                await self._insert(entries)
+            except Exception:
+                # Keep the entries (and their segments) for the next attempt
+                self._buffer[:0] = entries
+                raise
+            for segment in self._closed_segments:
+                segment.close()
+                Path(segment.name).unlink(missing_ok=True)
+            self._closed_segments = []
+            self.flushed += len(entries)
+            return len(entries)
+
+    async def replay(self) -> int:
+        """Insert the entries of segments left behind by processes that have exited"""
+        replayed = 0
+        for path in sorted(self.spill_dir.glob("ledger-*.jsonl")):
+            with open(path, "r+") as segment:
+                try:
+                    fcntl.flock(segment, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue  # still owned by a running process
+                entries = []
+                for line in segment:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        break  # torn write at crash time
+                    tenant = Tenant(*record["tenant"]) if record["tenant"] else None
+                    entry = record["entry"]
+                    entry["created_at"] = datetime.fromisoformat(entry["created_at"])
+                    entries.append((tenant, entry))
+                await self._insert(entries)
+            path.unlink(missing_ok=True)
+            if entries:
+                logger.info("Replayed %d stock ledger entries from %s", len(entries), path.name)
+            replayed += len(entries)
+        return replayed
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "buffered": len(self._buffer),
+            "pending_segments": len(self._closed_segments),
+            "flushed": self.flushed,
+            "replayed_at_startup": self.replayed,
+        }
+
+    def _open_segment(self):
+        self._segment_number += 1
+        path = self.spill_dir / f"ledger-{os.getpid()}-{self._segment_number}.jsonl"
+        segment = open(path, "a")
+        fcntl.flock(segment, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return segment
+
+    async def _insert(self, entries: List[Tuple[Optional[Tenant], dict]]):
+        by_tenant: Dict[Optional[Tenant], List[dict]] = {}
+        for tenant, entry in entries:
+            by_tenant.setdefault(tenant, []).append(entry)
+        for tenant, documents in by_tenant.items():
+            token = current_tenant.set(tenant)
+            try:
+                for start in range(0, len(documents), self.batch_size):
+                    await self.transactions.insert_many(documents[start:start + self.batch_size])
+            finally:
+                current_tenant.reset(token)
+
+    async def _flusher(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Could not flush the stock ledger, retrying in %gs", self.flush_seconds)
+                await asyncio.sleep(self.flush_seconds)
+
+
+def ledger_settings_from_env() -> Dict[str, Any]:
+    return {
+        "spill_dir": Path(os.environ.get("LEDGER_SPILL_DIR", Path(__file__).parent / "ledger_spill")),
+        "batch_size": int(os.environ.get("LEDGER_BATCH_SIZE", "500")),
+        "flush_seconds": float(os.environ.get("LEDGER_FLUSH_SECONDS", "1")),
+        "fsync": os.environ.get("LEDGER_FSYNC", "true").lower() == "true",
+    }
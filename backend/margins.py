@@ -0,0 +1,215 @@
+"""Cost snapshots on invoice lines and the margin report.
+
+When an invoice completes, each line records the item's ``cost_price``,
+``category`` and ``brand`` as they were at that moment, so later cost or
+catalogue changes do not rewrite past margins. The same completion adds the
+lines to ``margin_rollups``, one document per day, branch, item, category and
+brand::
+
+    {date, branch_id, item_id, category, brand, sku, name, quantity, revenue, cost, lines}
+
+The margin report groups those rollups by item, category, brand, branch or day,
+so a year of profitability reads at most one rollup per item per branch per
+day instead of every invoice line. Days are the invoice's ``created_at`` day,
+the same as the sales report. Amounts are summed in minor units (see money.py)
+and converted to currency units for the response. ``rebuild_margin_rollups`` recomputes the
+rollups from the invoices and the archive partitions. Lines completed before
+cost snapshots existed are costed at the item's current cost and counted as
+``estimated_lines``.
+"""
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from pymongo import UpdateOne
+
+from archive import invoice_sources
+from money import MONEY_SCALE, from_minor, stored_minor
+
+SNAPSHOT_FIELDS = {"_id": 0, "id": 1, "cost_price": 1, "category": 1, "brand": 1, "money_scale": 1}
+
+MARGIN_GROUPS = {
+    "item": {"item_id": "$item_id"},
+    "category": {"category": "$category"},
+    "brand": {"brand": "$brand"},
+    "branch": {"branch_id": "$branch_id"},
+    "day": {"date": "$date"},
+}
+
+WRITE_BATCH_SIZE = 1000
+
+
+def cost_snapshot(item: dict) -> dict:
+    """Snapshot fields of a stored item for an ``InvoiceItem``, cost in currency units"""
+    return {
+        "cost_price": from_minor(stored_minor(item, "cost_price")),
+        "category": item.get("category", ""),
+        "brand": item.get("brand", ""),
+    }
+
+
+async def snapshot_line_costs(db, lines: List[dict]) -> List[dict]:
+    """Stored lines with the current cost (minor units), category and brand of their items"""
+    item_ids = list({line["item_id"] for line in lines})
+    items = {
+        item["id"]: item
+        for item in await db.items.find({"id": {"$in": item_ids}}, SNAPSHOT_FIELDS).to_list(len(item_ids))
+    }
+    snapshots = []
+    for line in lines:
+        item = items.get(line["item_id"])
+        if item is None:
+            snapshots.append(line)  # deleted since it was added, keep what the line has
+            continue
+        snapshots.append({
+            **line,
+            "cost_price": stored_minor(item, "cost_price"),
+            "category": item.get("category", ""),
+            "brand": item.get("brand", ""),
+        })
+    return snapshots
+
+
+def _day(moment: datetime) -> datetime:
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _rollup_update(key: dict, sku: str, name: str, quantity: int, revenue: float, cost: float, lines: int,
+                   estimated_lines: int = 0) -> UpdateOne:
+    return UpdateOne(
+        key,
+        {
+            "$inc": {"quantity": quantity, "revenue": revenue, "cost": cost, "lines": lines,
+                     "estimated_lines": estimated_lines},
+            "$set": {"sku": sku, "name": name},
+            "$setOnInsert": {"money_scale": MONEY_SCALE},
+        },
+        upsert=True
+    )
+
+
+async def record_invoice_margin(db, invoice: dict):
+    """Add a completed invoice's lines to the margin rollups"""
+    date = _day(invoice["created_at"])
+    branch_id = invoice.get("branch_id", "main")
+    updates = [
+        _rollup_update(
+            {"date": date, "branch_id": branch_id, "item_id": line["item_id"],
+             "category": line.get("category", ""), "brand": line.get("brand", "")},
+            line["sku"], line["name"], line["quantity"], line["line_total"],
+            line["quantity"] * (line.get("cost_price") or 0), 1
+        )
+        for line in invoice["items"]
+    ]
+    if updates:
+        await db.margin_rollups.bulk_write(updates, ordered=False)
+
+
+async def margin_report(db, start: datetime, end: datetime, group_by: str, branch_id: str = "") -> Dict:
+    query = {"date": {"$gte": _day(start), "$lte": end}}
+    if branch_id:
+        query["branch_id"] = branch_id
+    group = {
+        "_id": MARGIN_GROUPS[group_by],
+        "quantity": {"$sum": "$quantity"},
+        "revenue": {"$sum": "$revenue"},
+        "cost": {"$sum": "$cost"},
+        "estimated_lines": {"$sum": "$estimated_lines"},
+    }
+    if group_by == "item":
+        group.update({"sku": {"$last": "$sku"}, "name": {"$last": "$name"}})
+    rows = await db.margin_rollups.aggregate([
+        {"$match": query},
+        {"$sort": {"date": 1}},
+        {"$group": group},
+    ], allowDiskUse=True).to_list(None)
+
+    if group_by == "day":
+        rows.sort(key=lambda row: row["_id"]["date"])
+    else:
+        rows.sort(key=lambda row: row["revenue"] - row["cost"], reverse=True)
+    revenue = sum(row["revenue"] for row in rows)
+    cost = sum(row["cost"] for row in rows)
+    return {
+        "group_by": group_by,
+        **_margin_figures(revenue, cost, "total_"),
+        "estimated_lines": sum(row["estimated_lines"] for row in rows),
+        "breakdown": [{**row.pop("_id"), **row, **_margin_figures(row["revenue"], row["cost"])} for row in rows],
+    }
+
+
+def _margin_figures(revenue: int, cost: int, prefix: str = "") -> Dict:
+    return {
+        f"{prefix}revenue": from_minor(revenue),
+        f"{prefix}cost": from_minor(cost),
+        f"{prefix}margin": from_minor(revenue - cost),
+        "margin_percent": round((revenue - cost) / revenue * 100, 2) if revenue else None,
+    }
+
+
+def _line_rollup_pipeline(match: dict) -> List[dict]:
+    return [
+        {"$match": match},
+        {"$unwind": "$items"},
+        {"$lookup": {"from": "items", "localField": "items.item_id", "foreignField": "id", "as": "current"}},
+        {"$project": {
+            "date": {"$dateFromParts": {
+                "year": {"$year": "$created_at"}, "month": {"$month": "$created_at"}, "day": {"$dayOfMonth": "$created_at"}
+            }},
+            "branch_id": {"$ifNull": ["$branch_id", "main"]},
+            "item_id": "$items.item_id",
+            "category": {"$ifNull": ["$items.category", {"$ifNull": [{"$arrayElemAt": ["$current.category", 0]}, ""]}]},
+            "brand": {"$ifNull": ["$items.brand", {"$ifNull": [{"$arrayElemAt": ["$current.brand", 0]}, ""]}]},
+            "sku": "$items.sku",
+            "name": "$items.name",
+            "quantity": "$items.quantity",
+            "revenue": "$items.line_total",
+            "cost": {"$multiply": [
+                "$items.quantity",
+                {"$ifNull": ["$items.cost_price", {"$ifNull": [{"$arrayElemAt": ["$current.cost_price", 0]}, 0]}]},
+            ]},
+            "estimated": {"$cond": [{"$eq": [{"$ifNull": ["$items.cost_price", None]}, None]}, 1, 0]},
+        }},
+        {"$group": {
+            "_id": {"date": "$date", "branch_id": "$branch_id", "item_id": "$item_id",
+                    "category": "$category", "brand": "$brand"},
+            "sku": {"$last": "$sku"},
+            "name": {"$last": "$name"},
+            "quantity": {"$sum": "$quantity"},
+            "revenue": {"$sum": "$revenue"},
+            "cost": {"$sum": "$cost"},
+            "lines": {"$sum": 1},
+            "estimated_lines": {"$sum": "$estimated"},
+        }},
+    ]
+
+
+async def rebuild_margin_rollups(db, start: Optional[datetime] = None, end: Optional[datetime] = None) -> Dict:
+    """Recompute margin rollups for a date range (all history by default) from the invoices"""
+    date_range = {}
+    if start:
+        date_range["$gte"] = _day(start)
+    if end:
+        date_range["$lte"] = end
+    await db.margin_rollups.delete_many({"date": date_range} if date_range else {})
+
+    match = {"status": "completed"}
+    if date_range:
+        match["created_at"] = date_range
+    rows = estimated = 0
+    for source in await invoice_sources(db, start, end):
+        cursor = source.aggregate(_line_rollup_pipeline(match), allowDiskUse=True)
+        updates = []
+        async for row in cursor:
+            updates.append(_rollup_update(
+                row["_id"], row["sku"], row["name"], row["quantity"], row["revenue"], row["cost"], row["lines"],
+                row["estimated_lines"]
+            ))
+            estimated += row["estimated_lines"]
+            if len(updates) >= WRITE_BATCH_SIZE:
+                await db.margin_rollups.bulk_write(updates, ordered=False)
+                rows += len(updates)
+                updates = []
+        if updates:
+            await db.margin_rollups.bulk_write(updates, ordered=False)
+            rows += len(updates)
+    return {"rollups_written": rows, "estimated_lines": estimated}
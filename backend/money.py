@@ -0,0 +1,179 @@
+"""Money stored as integer minor units.
+
+Prices and totals are kept in Mongo as integers of ``MONEY_MINOR_UNITS`` per
+unit of currency (paise or cents with the default of 100). Sums are then
+exact, and ``$sum`` can compute report totals inside Mongo. The API still
+takes and returns amounts in currency units. Models convert on the way in
+and out: ``Item(**document)`` and ``Invoice(**document)`` read stored
+documents, and ``item_document``/``invoice_document`` produce them. Amounts
+are rounded half up to the minor unit when they are stored.
+
+Every stored document carries ``money_scale``. Documents written before this
+change have no marker and hold floats. They are still read correctly, and
+``migrate_money`` converts them in place: items, hot and archived invoices and
+the invoice and margin rollups. Rollups written by this version set the
+marker when they are created. The migration runs when a process first
+provisions a tenant, before it serves the tenant's requests, and is recorded
+in ``migrations``. It can be run again with the ``maintenance/migrate-money``
+job to pick up documents written by older processes during a rolling deploy.
+Converted documents are skipped, so a rerun never scales a document twice.
+``MONEY_MINOR_UNITS`` must not change once documents are stored.
+
+To migrate a tenant database ahead of a deploy, run::
+
+    python money.py --db-name inventory_acme
+"""
+import os
+from datetime import datetime
+from decimal import ROUND_HALF_UP, Decimal
+from typing import Dict, Iterable, Optional
+
+from pymongo import UpdateOne
+
+MONEY_SCALE = int(os.environ.get("MONEY_MINOR_UNITS", "100"))
+
+ITEM_MONEY_FIELDS = ("cost_price", "selling_price")
+LINE_MONEY_FIELDS = ("unit_price", "line_total", "cost_price")
+INVOICE_MONEY_FIELDS = ("subtotal", "final_total")
+ROLLUP_MONEY_FIELDS = {"margin_rollups": ("revenue", "cost"), "invoice_rollups": ("revenue",)}
+
+MIGRATION_ID = "money-minor-units"
+MIGRATION_BATCH_SIZE = 500
+
+
+def to_minor(amount) -> Optional[int]:
+    if amount is None:
+        return None
+    return int((Decimal(str(amount)) * MONEY_SCALE).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def from_minor(value: Optional[int], scale: int = MONEY_SCALE) -> Optional[float]:
+    if value is None:
+        return None
+    return value / scale
+
+
+def stored_minor(document: dict, field: str) -> int:
+    """A money field of a stored document in minor units, whether or not it has been migrated"""
+    value = document.get(field) or 0
+    return value if document.get("money_scale") else to_minor(value)
+
+
+def _convert(document: dict, fields: Iterable[str], convert) -> dict:
+    return {**document, **{field: convert(document[field]) for field in fields if document.get(field) is not None}}
+
+
+def item_document(item: dict) -> dict:
+    return {**_convert(item, ITEM_MONEY_FIELDS, to_minor), "money_scale": MONEY_SCALE}
+
+
+def line_document(line: dict) -> dict:
+    return _convert(line, LINE_MONEY_FIELDS, to_minor)
+
+
+def invoice_document(invoice: dict) -> dict:
+    document = {**_convert(invoice, INVOICE_MONEY_FIELDS, to_minor), "money_scale": MONEY_SCALE}
+    if "items" in invoice:
+        document["items"] = [line_document(line) for line in invoice["items"]]
+    return document
+
+
+def item_from_document(document):
+    """Amounts of a stored item in currency units; anything else is returned unchanged"""
+    if not isinstance(document, dict) or not document.get("money_scale"):
+        return document
+    scale = document["money_scale"]
+    item = _convert(document, ITEM_MONEY_FIELDS, lambda value: from_minor(value, scale))
+    del item["money_scale"]
+    return item
+
+
+def invoice_from_document(document):
+    """Amounts of a stored invoice and its lines in currency units"""
+    if not isinstance(document, dict) or not document.get("money_scale"):
+        return document
+    scale = document["money_scale"]
+    invoice = _convert(document, INVOICE_MONEY_FIELDS, lambda value: from_minor(value, scale))
+    if "items" in invoice:
+        invoice["items"] = [
+            _convert(line, LINE_MONEY_FIELDS, lambda value: from_minor(value, scale)) for line in invoice["items"]
+        ]
+    del invoice["money_scale"]
+    return invoice
+
+
+def _migrated_invoice(document: dict) -> dict:
+    migrated = invoice_document(document)
+    return {field: migrated[field] for field in (*INVOICE_MONEY_FIELDS, "items", "money_scale") if field in migrated}
+
+
+async def _migrate_collection(collection, fields: tuple, migrate) -> int:
+    converted = 0
+    unconverted = {"money_scale": {"$exists": False}}
+    projection = {field: 1 for field in fields}
+    while True:
+        batch = await collection.find(unconverted, projection).limit(MIGRATION_BATCH_SIZE).to_list(MIGRATION_BATCH_SIZE)
+        if not batch:
+            return converted
+        # Guarded on the marker so a concurrent run cannot convert a document twice
+        result = await collection.bulk_write([
+            UpdateOne({"_id": document["_id"], **unconverted}, {"$set": migrate(document)})
+            for document in batch
+        ], ordered=False)
+        converted += result.modified_count
+
+
+async def migrate_money(db) -> Dict[str, int]:
+    """Convert stored amounts without a ``money_scale`` marker to minor units"""
+    # archive imports MONEY_SCALE from this module
+    from archive import ARCHIVE_PREFIX
+
+    converted = {
+        "items": await _migrate_collection(
+            db.items, ITEM_MONEY_FIELDS,
+            lambda document: {field: value for field, value in item_document(document).items() if field != "_id"}
+        )
+    }
+    partitions = await db.list_collection_names(filter={"name": {"$regex": f"^{ARCHIVE_PREFIX}"}})
+    for name in ["invoices", *sorted(partitions)]:
+        converted[name] = await _migrate_collection(db[name], (*INVOICE_MONEY_FIELDS, "items"), _migrated_invoice)
+    for name, fields in ROLLUP_MONEY_FIELDS.items():
+        converted[name] = await _migrate_collection(
+            db[name], fields,
+            lambda document, fields=fields: {
+                **{field: to_minor(document[field]) for field in fields if document.get(field) is not None},
+                "money_scale": MONEY_SCALE,
+            }
+        )
+    await db.migrations.update_one(
+        {"_id": MIGRATION_ID},
+        {"$set": {"money_scale": MONEY_SCALE, "completed_at": datetime.utcnow(), "converted": converted}},
+        upsert=True
+    )
+    return converted
+
+
+async def ensure_money_migrated(db):
+    if not await db.migrations.find_one({"_id": MIGRATION_ID}):
+        await migrate_money(db)
+
+
+if __name__ == "__main__":
+    import asyncio
+    from pathlib import Path
+
+    import typer
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    cli = typer.Typer(help="Convert stored amounts to integer minor units")
+
+    @cli.command()
+    def migrate(db_name: str = typer.Option(None, help="Database to migrate, defaults to DB_NAME")):
+        load_dotenv(Path(__file__).parent / '.env')
+        client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+        converted = asyncio.run(migrate_money(client[db_name or os.environ['DB_NAME']]))
+        for collection, count in converted.items():
+            typer.echo(f"{collection}: {count} documents converted")
+
+    cli()
@@ -0,0 +1,46 @@
+"""Run independent database queries concurrently.
+
+Handlers that need several unrelated results pass them to ``gather_queries``
+so the endpoint waits for the slowest query rather than the sum of all of
+them. Parallelism per call is bounded so one request cannot take over the
+connection pool, and each query has its own timeout.
+
+Queries are passed as zero-argument callables, because Motor starts an
+operation as soon as its method is called::
+
+    results = await gather_queries({
+        "items": lambda: db.items.count_documents({}),
+        "branches": lambda: db.branches.find().to_list(100),
+    })
+"""
+import asyncio
+import os
+from typing import Any, Awaitable, Callable, Dict
+
+from fastapi import HTTPException
+
+QUERY_PARALLELISM = int(os.environ.get("QUERY_PARALLELISM", "4"))
+QUERY_TIMEOUT_SECONDS = float(os.environ.get("QUERY_TIMEOUT_SECONDS", "15"))
+
+
+async def gather_queries(queries: Dict[str, Callable[[], Awaitable]], limit: int = QUERY_PARALLELISM,
+                         timeout: float = QUERY_TIMEOUT_SECONDS) -> Dict[str, Any]:
+    """Await every named query concurrently and return their results by name"""
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(name: str, query: Callable[[], Awaitable]):
+        async with semaphore:
+            try:
+                return await asyncio.wait_for(query(), timeout)
+            except asyncio.TimeoutError:
+                raise HTTPException(status_code=504, detail=f"Query '{name}' timed out after {timeout:g}s")
+
+    tasks = {name: asyncio.ensure_future(run(name, query)) for name, query in queries.items()}
+    try:
+        await asyncio.gather(*tasks.values())
+    except BaseException:
+        for task in tasks.values():
+            task.cancel()
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+        raise
+    return {name: task.result() for name, task in tasks.items()}
@@ -0,0 +1,104 @@
+"""Ordered change feed for integrations.
+
+Invoice completion, stock changes and item edits append compact events to the
+``events`` collection after the change itself is written::
+
+    {seq, type, entity_id, data, created_at}
+
+``seq`` comes from a counter in ``event_sequence`` and orders the feed. Events
+expire ``EVENT_RETENTION_DAYS`` after they were written (TTL index).
+Consumers read ``GET /api/events?after=<token>`` and pass the returned
+``next`` token on their following call. With ``wait`` the request is held open
+until events arrive or the wait ends.
+
+Sequence numbers are allocated before the insert, so a later event can become
+visible before an earlier one. The feed stops at such a gap and only skips it
+once the event after it is ``GAP_WAIT_SECONDS`` old (its writer failed), so a
+consumer never steps past an event that is still being written.
+"""
+import asyncio
+import os
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+from fastapi import HTTPException
+from pymongo import ReturnDocument
+
+EVENT_RETENTION_DAYS = int(os.environ.get("EVENT_RETENTION_DAYS", "7"))
+GAP_WAIT_SECONDS = 5
+POLL_SECONDS = 1.0
+
+EVENT_FIELDS = {"_id": 0, "seq": 1, "type": 1, "entity_id": 1, "data": 1, "created_at": 1}
+
+
+def event(event_type: str, entity_id: str, **data) -> dict:
+    return {"type": event_type, "entity_id": entity_id, "data": data}
+
+
+def parse_token(token: str) -> int:
+    if not token:
+        return 0
+    if not token.isdigit():
+        raise HTTPException(status_code=400, detail="Invalid event token")
+    return int(token)
+
+
+class EventFeed:
+    def __init__(self):
+        self._changed = asyncio.Event()
+
+    async def publish(self, db, events: List[dict]):
+        if not events:
+            return
+        counter = await db.event_sequence.find_one_and_update(
+            {"_id": "events"}, {"$inc": {"seq": len(events)}}, upsert=True, return_document=ReturnDocument.AFTER
+        )
+        first = counter["seq"] - len(events) + 1
+        created_at = datetime.utcnow()
+        await db.events.insert_many([
+            {**entry, "seq": first + offset, "created_at": created_at} for offset, entry in enumerate(events)
+        ])
+        # Wake long-polls waiting in this process; other processes poll
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def read(self, db, after: int, limit: int) -> Tuple[List[dict], int]:
+        """Events after ``after`` up to the first gap still being written, and the next token"""
+        events = await db.events.find({"seq": {"$gt": after}}, EVENT_FIELDS).sort("seq", 1).limit(limit).to_list(limit)
+        if after and (not events or events[0]["seq"] != after + 1):
+            await self._check_not_expired(db, after)
+
+        settled_before = datetime.utcnow() - timedelta(seconds=GAP_WAIT_SECONDS)
+        contiguous = []
+        expected = after + 1
+        for entry in events:
+            if entry["seq"] != expected and entry["created_at"] > settled_before:
+                break
+            contiguous.append(entry)
+            expected = entry["seq"] + 1
+        return contiguous, expected - 1
+
+    async def wait(self, db, after: int, limit: int, timeout: float) -> Tuple[List[dict], int]:
+        """Like ``read``, holding the request up to ``timeout`` seconds until there are events"""
+        deadline = asyncio.get_running_loop().time() + timeout
+        while True:
+            changed = self._changed
+            events, next_seq = await self.read(db, after, limit)
+            remaining = deadline - asyncio.get_running_loop().time()
+            if events or remaining <= 0:
+                return events, next_seq
+            try:
+                await asyncio.wait_for(changed.wait(), min(POLL_SECONDS, remaining))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _check_not_expired(self, db, after: int):
+        if await db.events.find_one({"seq": after}, {"_id": 1}):
+            return
+        oldest: Optional[dict] = await db.events.find_one({}, {"_id": 0, "seq": 1}, sort=[("seq", 1)])
+        counter = await db.event_sequence.find_one({"_id": "events"})
+        latest = counter["seq"] if counter else 0
+        if after > latest:
+            raise HTTPException(status_code=400, detail="Event token is ahead of the feed")
+        if (oldest and oldest["seq"] > after + 1) or (not oldest and after < latest):
+            raise HTTPException(status_code=410, detail="Events after this token have expired, resynchronise and start over")
@@ -0,0 +1,310 @@
+"""Opt-in request profiling: sampled stack profiles and span timings.
+
+A fraction of requests (``PROFILE_SAMPLE_RATE``) is profiled. With
+``PROFILE_ON_HEADER`` enabled, any request sent with ``X-Profile: 1`` is
+profiled too. Both are off by default, and unprofiled requests pay one
+context variable lookup per span.
+
+For each profiled request, a sampler thread looks at the request's task every
+``PROFILE_INTERVAL_MS`` milliseconds:
+
+* while the task is running on the event loop, the sample is the Python
+  stack of the loop thread, trimmed to the task. These samples make up the
+  CPU profile, e.g. Pydantic model construction or report loops
+* while the task is suspended, the sample is its chain of awaiting
+  coroutines, ending in what it waits for (a Mongo round trip waits on a
+  ``Future``). Together with the CPU samples they make up the wall profile
+
+``span(name)`` times a block of a handler (wall and thread CPU time) and
+``traced`` wraps every async method of an object, e.g. the repositories, in
+a span. Profiled responses carry the span totals in a ``Server-Timing``
+header. The spans of a block containing ``await`` also count CPU used by
+other requests meanwhile.
+
+The last ``PROFILE_MAX_PROFILES`` profiles are kept in memory per process.
+``flamegraph`` renders them as collapsed stacks (``frame;frame;... count``)
+for flamegraph.pl, speedscope or inferno.
+"""
+import asyncio
+import inspect
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+PROFILE_HEADER = b"x-profile"
+
+# Profile of the request being served, if it is sampled
+current_profile: ContextVar[Optional["RequestProfile"]] = ContextVar("current_profile", default=None)
+
+_labels: Dict[Any, str] = {}
+
+
+def _label(code) -> str:
+    label = _labels.get(code)
+    if label is None:
+        label = f"{getattr(code, 'co_qualname', code.co_name)} ({Path(code.co_filename).name}:{code.co_firstlineno})"
+        _labels[code] = label
+    return label
+
+
+def _awaiting(coroutine) -> tuple:
+    """Labels of a suspended coroutine and everything it awaits, outermost first"""
+    labels = []
+    while coroutine is not None:
+        frame = getattr(coroutine, "cr_frame", None) or getattr(coroutine, "gi_frame", None)
+        if frame is None:
+            break
+        labels.append(_label(frame.f_code))
+        awaited = getattr(coroutine, "cr_await", None) or getattr(coroutine, "gi_yieldfrom", None)
+        if awaited is not None and not hasattr(awaited, "cr_frame") and not hasattr(awaited, "gi_frame"):
+            labels.append(f"[await {type(awaited).__name__}]")
+            break
+        coroutine = awaited
+    return tuple(labels)
+
+
+def _running(frame, root) -> tuple:
+    """Labels of the loop thread's stack from the task's root coroutine down"""
+    labels = []
+    while frame is not None:
+        labels.append(_label(frame.f_code))
+        if frame is root:
+            return tuple(reversed(labels))
+        frame = frame.f_back
+    return ()
+
+
+class RequestProfile:
+    def __init__(self, method: str, path: str, task: asyncio.Task, loop, thread_id: int):
+        self.id = uuid.uuid4().hex[:12]
+        self.method = method
+        self.path = path
+        self.route = path
+        self.status: Optional[int] = None
+        self.started_at = datetime.utcnow()
+        self.task = task
+        self.loop = loop
+        self.thread_id = thread_id
+        self.wall_ms = 0.0
+        self.cpu_samples = 0
+        self.wait_samples = 0
+        self.stacks: Counter = Counter()
+        self.spans: List[Dict[str, Any]] = []
+        self._started = time.perf_counter()
+
+    def sample(self, frames: dict):
+        try:
+            root = self.task.get_coro().cr_frame
+            if asyncio.current_task(self.loop) is self.task:
+                stack = _running(frames.get(self.thread_id), root)
+                if stack:
+                    self.stacks["cpu", stack] += 1
+                    self.cpu_samples += 1
+            else:
+                stack = _awaiting(self.task.get_coro())
+                if stack:
+                    self.stacks["wait", stack] += 1
+                    self.wait_samples += 1
+        except (AttributeError, RuntimeError):
+            pass  # the task moved on while it was being sampled
+
+    def span_totals(self) -> Dict[str, float]:
+        totals: Dict[str, float] = {}
+        for recorded in self.spans:
+            totals[recorded["name"]] = totals.get(recorded["name"], 0) + recorded["wall_ms"]
+        return totals
+
+    def summary(self, interval_ms: float) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "route": self.route,
+            "status": self.status,
+            "started_at": self.started_at,
+            "wall_ms": round(self.wall_ms, 3),
+            "cpu_ms": round(self.cpu_samples * interval_ms, 3),
+            "samples": self.cpu_samples + self.wait_samples,
+            "span_totals_ms": {name: round(total, 3) for name, total in self.span_totals().items()},
+        }
+
+    def details(self, interval_ms: float) -> Dict[str, Any]:
+        return {
+            **self.summary(interval_ms),
+            "spans": self.spans,
+            "top_stacks": [
+                {"kind": kind, "samples": count, "stack": list(stack)}
+                for (kind, stack), count in self.stacks.most_common(20)
+            ],
+        }
+
+
+@contextmanager
+def span(name: str):
+    """Time a block of the current request, if it is being profiled"""
+    profile = current_profile.get()
+    if profile is None:
+        yield
+        return
+    started, cpu_started = time.perf_counter(), time.thread_time()
+    try:
+        yield
+    finally:
+        ended = time.perf_counter()
+        profile.spans.append({
+            "name": name,
+            "start_ms": round((started - profile._started) * 1000, 3),
+            "wall_ms": round((ended - started) * 1000, 3),
+            "cpu_ms": round((time.thread_time() - cpu_started) * 1000, 3),
+        })
+
+
+class traced:
+    """Wraps an object so each call of its async methods is a span named ``<prefix>.<method>``"""
+
+    def __init__(self, target, prefix: str):
+        self._target = target
+        self._prefix = prefix
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self._target, name)
+        if not inspect.iscoroutinefunction(attribute):
+            return attribute
+        label = f"{self._prefix}.{name}"
+
+        async def call(*args, **kwargs):
+            with span(label):
+                return await attribute(*args, **kwargs)
+        return call
+
+
+class Profiler:
+    def __init__(self, sample_rate: float = 0.0, on_header: bool = False, interval_ms: float = 5.0,
+                 max_profiles: int = 200):
+        self.sample_rate = sample_rate
+        self.on_header = on_header
+        self.interval_ms = interval_ms
+        self.profiles: "deque[RequestProfile]" = deque(maxlen=max_profiles)
+        self._active: Dict[str, RequestProfile] = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.sample_rate > 0 or self.on_header
+
+    def should_profile(self, scope) -> bool:
+        if self.on_header and dict(scope["headers"]).get(PROFILE_HEADER) == b"1":
+            return True
+        return random.random() < self.sample_rate
+
+    def begin(self, method: str, path: str) -> RequestProfile:
+        profile = RequestProfile(method, path, asyncio.current_task(), asyncio.get_running_loop(), threading.get_ident())
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._sample, name="profiler", daemon=True)
+                self._thread.start()
+            self._active[profile.id] = profile
+            self._wake.set()
+        return profile
+
+    def end(self, profile: RequestProfile):
+        profile.wall_ms = (time.perf_counter() - profile._started) * 1000
+        with self._lock:
+            self._active.pop(profile.id, None)
+        # Kept profiles must not hold on to the finished request
+        profile.task = profile.loop = None
+        self.profiles.append(profile)
+
+    def find(self, profile_id: str) -> Optional[RequestProfile]:
+        return next((profile for profile in self.profiles if profile.id == profile_id), None)
+
+    def flamegraph(self, kind: str = "wall", route: str = "") -> str:
+        """Collapsed stacks of the kept profiles, one root per route"""
+        stacks: Counter = Counter()
+        for profile in list(self.profiles):
+            if route and profile.route != route:
+                continue
+            for (sample_kind, stack), count in list(profile.stacks.items()):
+                if kind == "wall" or sample_kind == kind:
+                    stacks[(f"{profile.method} {profile.route}", *stack)] += count
+        return "".join(f"{';'.join(stack)} {count}\n" for stack, count in sorted(stacks.items()))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "sample_rate": self.sample_rate,
+            "on_header": self.on_header,
+            "interval_ms": self.interval_ms,
+            "in_flight": len(self._active),
+            "profiles": [profile.summary(self.interval_ms) for profile in reversed(self.profiles)],
+        }
+
+    def _sample(self):
+        interval = self.interval_ms / 1000
+        while True:
+            self._wake.wait()
+            time.sleep(interval)
+            with self._lock:
+                active = list(self._active.values())
+                if not active:
+                    self._wake.clear()
+                    continue
+            frames = sys._current_frames()
+            for profile in active:
+                profile.sample(frames)
+            del frames
+
+
+class ProfilingMiddleware:
+    def __init__(self, app, profiler: Profiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.profiler.enabled or not self.profiler.should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        profile = self.profiler.begin(scope["method"], scope["path"])
+        token = current_profile.set(profile)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                profile.status = message["status"]
+                server_timing = ", ".join([
+                    f"total;dur={(time.perf_counter() - profile._started) * 1000:.3f}",
+                    *(f'span{index};desc="{name}";dur={total:.3f}'
+                      for index, (name, total) in enumerate(profile.span_totals().items(), 1)),
+                ])
+                message["headers"] = [*message.get("headers", []), (b"server-timing", server_timing.encode()),
+                                      (b"x-profile-id", profile.id.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_profile.reset(token)
+            route = scope.get("route")
+            if route is not None and getattr(route, "path", None):
+                profile.route = route.path
+            self.profiler.end(profile)
+
+
+def profiler_settings_from_env() -> Dict[str, Any]:
+    return {
+        "sample_rate": float(os.environ.get("PROFILE_SAMPLE_RATE", "0")),
+        "on_header": os.environ.get("PROFILE_ON_HEADER", "false").lower() == "true",
+        "interval_ms": float(os.environ.get("PROFILE_INTERVAL_MS", "5")),
+        "max_profiles": int(os.environ.get("PROFILE_MAX_PROFILES", "200")),
+    }
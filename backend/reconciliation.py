@@ -0,0 +1,295 @@
+"""Incremental reconciliation of item stock against the stock ledger.
+
+``items.stock_quantity`` is changed in place, while every movement is also
+appended to ``stock_transactions`` (OUT for sales, IN for receipts,
+ADJUSTMENT with a signed quantity for corrections). The two can drift, e.g.
+through a stock edit made outside the API, so this job checks them without
+rescanning the ledger:
+
+* ``stock_checkpoints`` holds per item the stock the ledger implies
+  (``expected``), the last ledger entry folded into it and that entry's
+  ``created_at``
+* each run folds only the entries written since the previous run, in ``_id``
+  order and in batches. ``_id`` is assigned when the ledger flushes, so
+  entries flushed late (see ledger.py) are still picked up. The run stops at
+  a mark ``STOCK_RECONCILE_SETTLE_SECONDS`` in the past, leaving room for
+  buffered entries and clock skew between servers. Updates are guarded on
+  the checkpoint's last entry, so an interrupted run is simply repeated
+* items touched by those entries, changed since the last run or still
+  flagged are compared; ``full`` compares every item, for stock written
+  without bumping ``updated_at``. Entries written after the mark are counted as pending. Items changed after
+  the mark are deferred to the next run, because their entries may still be
+  in a ledger buffer. Items seen for the first time are checkpointed at
+  their current stock
+
+Only one run works at a time: a run takes a lease on the state document
+(``lease_owner``, ``lease_until``) and renews it with every batch. A run that
+finds the lease held by a live run is skipped, and a run that loses its lease
+(it stalled for longer than ``STOCK_RECONCILE_LEASE_SECONDS``) stops writing.
+
+A mismatch is flagged on the checkpoint (see ``/api/reports/stock-discrepancies``).
+With ``adjust`` on, a correcting ADJUSTMENT entry is written as well, so the
+ledger agrees with the counted stock again. The adjustment is folded by the
+next run like any other entry.
+"""
+import os
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Set
+
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+STOCK_RECONCILE_SETTLE_SECONDS = int(os.environ.get("STOCK_RECONCILE_SETTLE_SECONDS", "600"))
+STOCK_RECONCILE_BATCH_SIZE = int(os.environ.get("STOCK_RECONCILE_BATCH_SIZE", "5000"))
+STOCK_RECONCILE_ADJUST = os.environ.get("STOCK_RECONCILE_ADJUST", "false").lower() == "true"
+STOCK_RECONCILE_LEASE_SECONDS = int(os.environ.get("STOCK_RECONCILE_LEASE_SECONDS", "900"))
+
+STATE_ID = "stock-ledger"
+ITEM_BATCH_SIZE = 1000
+MAX_REPORTED = 100
+
+ITEM_FIELDS = {"_id": 0, "id": 1, "sku": 1, "name": 1, "stock_quantity": 1, "updated_at": 1}
+ENTRY_FIELDS = {"_id": 1, "item_id": 1, "transaction_type": 1, "quantity": 1, "created_at": 1}
+
+# OUT takes stock, IN adds it and ADJUSTMENT carries its own sign
+SIGNED_QUANTITY = {"$cond": [{"$eq": ["$transaction_type", "OUT"]}, {"$multiply": ["$quantity", -1]}, "$quantity"]}
+
+
+class LeaseLost(Exception):
+    """Another run took over the reconciliation lease"""
+
+
+def signed_quantity(entry: dict) -> int:
+    return -entry["quantity"] if entry["transaction_type"] == "OUT" else entry["quantity"]
+
+
+async def _take_lease(db, run_id: str, lease_seconds: int) -> Optional[dict]:
+    """Lease the reconciliation to ``run_id``; returns the state before, or None if a live run holds it"""
+    now = datetime.utcnow()
+    try:
+        state = await db.stock_reconciliation.find_one_and_update(
+            {"_id": STATE_ID, "lease_until": {"$not": {"$gt": now}}},
+            {"$set": {"lease_owner": run_id, "lease_until": now + timedelta(seconds=lease_seconds)}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return None  # the state exists and its lease is live
+    return state or {}
+
+
+async def _save_state(db, run_id: str, lease_seconds: int, fields: dict):
+    """Write run state under the lease, extending it"""
+    result = await db.stock_reconciliation.update_one(
+        {"_id": STATE_ID, "lease_owner": run_id},
+        {"$set": {**fields, "lease_until": datetime.utcnow() + timedelta(seconds=lease_seconds)}}
+    )
+    if not result.matched_count:
+        raise LeaseLost(run_id)
+
+
+async def _fold_entries(db, after: Optional[ObjectId], mark: ObjectId, batch_size: int, touched: Set[str],
+                        run_id: str, lease_seconds: int) -> int:
+    """Add ledger entries written after ``after`` up to ``mark`` to the item checkpoints"""
+    bounds = {"$lte": mark, **({"$gt": after} if after else {})}
+    folded = 0
+    while True:
+        batch = await db.stock_transactions.find({"_id": bounds}, ENTRY_FIELDS).sort("_id", 1).limit(
+            batch_size).to_list(batch_size)
+        if not batch:
+            return folded
+
+        item_ids = {entry["item_id"] for entry in batch}
+        checkpoints = {
+            checkpoint["item_id"]: checkpoint
+            for checkpoint in await db.stock_checkpoints.find(
+                {"item_id": {"$in": list(item_ids)}}, {"_id": 0, "item_id": 1, "last_entry_id": 1}
+            ).to_list(None)
+        }
+        moves: Dict[str, Dict[str, Any]] = {}
+        for entry in batch:
+            checkpoint = checkpoints.get(entry["item_id"])
+            # Items without a checkpoint are checkpointed at their current stock, which includes these
+            if checkpoint is None or entry["_id"] <= checkpoint["last_entry_id"]:
+                continue
+            move = moves.setdefault(entry["item_id"], {"delta": 0})
+            move["delta"] += signed_quantity(entry)
+            move["last_entry_id"] = entry["_id"]
+            move["last_created_at"] = entry.get("created_at")
+            folded += 1
+        if moves:
+            await db.stock_checkpoints.bulk_write([
+                UpdateOne(
+                    {"item_id": item_id, "last_entry_id": checkpoints[item_id]["last_entry_id"]},
+                    {"$inc": {"expected": move["delta"]},
+                     "$set": {"last_entry_id": move["last_entry_id"], "last_created_at": move["last_created_at"]}}
+                )
+                for item_id, move in moves.items()
+            ], ordered=False)
+
+        touched.update(item_ids)
+        bounds["$gt"] = batch[-1]["_id"]
+        await _save_state(db, run_id, lease_seconds, {"last_entry_id": batch[-1]["_id"]})
+
+
+async def _pending_after(db, mark: ObjectId) -> Dict[str, int]:
+    """Net movement per item of the entries written after ``mark``"""
+    rows = await db.stock_transactions.aggregate([
+        {"$match": {"_id": {"$gt": mark}}},
+        {"$group": {"_id": "$item_id", "quantity": {"$sum": SIGNED_QUANTITY}}},
+    ]).to_list(None)
+    return {row["_id"]: row["quantity"] for row in rows}
+
+
+async def _candidate_items(db, touched: Set[str], changed_since: Optional[datetime]):
+    """Batches of items to compare: all of them on the first run, afterwards touched or changed ones"""
+    if changed_since is None:
+        last_id = ""
+        while True:
+            batch = await db.items.find({"id": {"$gt": last_id}}, ITEM_FIELDS).sort("id", 1).limit(
+                ITEM_BATCH_SIZE).to_list(ITEM_BATCH_SIZE)
+            if not batch:
+                return
+            yield batch
+            last_id = batch[-1]["id"]
+
+    seen: Set[str] = set()
+    # Items changed after the cutoff are deferred, and fall in the next run's window
+    changed = db.items.find({"updated_at": {"$gt": changed_since}}, ITEM_FIELDS).batch_size(ITEM_BATCH_SIZE)
+    batch = []
+    async for item in changed:
+        seen.add(item["id"])
+        batch.append(item)
+        if len(batch) == ITEM_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+    remaining = sorted(touched - seen)
+    for start in range(0, len(remaining), ITEM_BATCH_SIZE):
+        ids = remaining[start:start + ITEM_BATCH_SIZE]
+        batch = await db.items.find({"id": {"$in": ids}}, ITEM_FIELDS).to_list(None)
+        if batch:
+            yield batch
+
+
+def _adjustment(item: dict, difference: int, run_id: str, now: datetime) -> dict:
+    return {
+        "_id": ObjectId(),
+        "id": str(uuid.uuid4()),
+        "item_id": item["id"],
+        "branch_id": "main",
+        "transaction_type": "ADJUSTMENT",
+        "quantity": difference,
+        "reference_type": "RECONCILIATION",
+        "reference_id": run_id,
+        "created_at": now,
+    }
+
+
+async def _compare(db, items: List[dict], pending: Dict[str, int], cutoff: datetime, mark: ObjectId,
+                   adjust: bool, run_id: str, result: Dict[str, Any]):
+    now = datetime.utcnow()
+    checkpoints = {
+        checkpoint["item_id"]: checkpoint
+        for checkpoint in await db.stock_checkpoints.find(
+            {"item_id": {"$in": [item["id"] for item in items]}}, {"_id": 0}
+        ).to_list(None)
+    }
+    updates, adjustments = [], []
+    for item in items:
+        if item.get("updated_at") and item["updated_at"] > cutoff:
+            result["deferred"] += 1
+            continue
+        stock = item.get("stock_quantity", 0)
+        checkpoint = checkpoints.get(item["id"])
+        if checkpoint is None:
+            updates.append(UpdateOne({"item_id": item["id"]}, {"$setOnInsert": {
+                "item_id": item["id"], "expected": stock - pending.get(item["id"], 0), "last_entry_id": mark,
+                "last_created_at": None, "status": "ok", "difference": 0, "checked_at": now,
+            }}, upsert=True))
+            result["checkpointed"] += 1
+            continue
+
+        result["checked"] += 1
+        difference = stock - checkpoint["expected"] - pending.get(item["id"], 0)
+        if difference == 0:
+            if checkpoint.get("status") != "ok":
+                updates.append(UpdateOne({"item_id": item["id"]}, {"$set": {"status": "ok", "difference": 0, "checked_at": now}}))
+            continue
+
+        result["mismatches"] += 1
+        if len(result["discrepancies"]) < MAX_REPORTED:
+            result["discrepancies"].append({
+                "item_id": item["id"], "sku": item.get("sku"), "name": item.get("name"), "stock_quantity": stock,
+                "expected": checkpoint["expected"] + pending.get(item["id"], 0), "difference": difference,
+            })
+        flagged = {"status": "adjusted" if adjust else "mismatch", "difference": difference,
+                   "sku": item.get("sku"), "name": item.get("name"), "detected_at": now, "checked_at": now}
+        if adjust:
+            adjustments.append(_adjustment(item, difference, run_id, now))
+            flagged["adjustment_id"] = adjustments[-1]["id"]
+        updates.append(UpdateOne({"item_id": item["id"]}, {"$set": flagged}))
+
+    # Adjustments first: if the run stops here, the next one folds them and finds no difference
+    if adjustments:
+        await db.stock_transactions.insert_many(adjustments, ordered=False)
+        result["adjusted"] += len(adjustments)
+    if updates:
+        await db.stock_checkpoints.bulk_write(updates, ordered=False)
+
+
+async def reconcile_stock(db, adjust: bool = STOCK_RECONCILE_ADJUST, settle_seconds: int = STOCK_RECONCILE_SETTLE_SECONDS,
+                          full: bool = False, batch_size: int = STOCK_RECONCILE_BATCH_SIZE,
+                          lease_seconds: int = STOCK_RECONCILE_LEASE_SECONDS) -> Dict[str, Any]:
+    """Fold new ledger entries into the item checkpoints and flag items whose stock disagrees"""
+    run_id = uuid.uuid4().hex[:12]
+    state = await _take_lease(db, run_id, lease_seconds)
+    if state is None:
+        return {"run_id": run_id, "skipped": True, "reason": "Another reconciliation is running"}
+    try:
+        return await _reconcile(db, state, run_id, adjust, settle_seconds, full, batch_size, lease_seconds)
+    finally:
+        await db.stock_reconciliation.update_one(
+            {"_id": STATE_ID, "lease_owner": run_id}, {"$set": {"lease_until": None}}
+        )
+
+
+async def _reconcile(db, state: dict, run_id: str, adjust: bool, settle_seconds: int, full: bool, batch_size: int,
+                     lease_seconds: int) -> Dict[str, Any]:
+    started = datetime.utcnow()
+    cutoff = started - timedelta(seconds=settle_seconds)
+    mark = ObjectId.from_datetime(cutoff)
+
+    touched: Set[str] = set()
+    entries = await _fold_entries(db, state.get("last_entry_id"), mark, batch_size, touched, run_id, lease_seconds)
+    pending = await _pending_after(db, mark)
+    flagged = await db.stock_checkpoints.find({"status": "mismatch"}, {"_id": 0, "item_id": 1}).to_list(None)
+    touched.update(checkpoint["item_id"] for checkpoint in flagged)
+
+    result = {"run_id": run_id, "cutoff": cutoff, "entries": entries, "checked": 0, "checkpointed": 0,
+              "deferred": 0, "mismatches": 0, "adjusted": 0, "discrepancies": []}
+    async for items in _candidate_items(db, touched, None if full else state.get("cutoff")):
+        await _save_state(db, run_id, lease_seconds, {})
+        await _compare(db, items, pending, cutoff, mark, adjust, run_id, result)
+
+    await _save_state(db, run_id, lease_seconds, {
+        "cutoff": cutoff,
+        "finished_at": datetime.utcnow(),
+        "last_run": {key: value for key, value in result.items() if key != "discrepancies"},
+    })
+    return result
+
+
+async def stock_discrepancies(db, limit: int = 500) -> List[dict]:
+    return await db.stock_checkpoints.find(
+        {"status": {"$in": ["mismatch", "adjusted"]}}, {"_id": 0, "last_entry_id": 0}
+    ).sort("detected_at", -1).limit(limit).to_list(limit)
+
+
+async def ensure_reconciliation_indexes(db):
+    await db.stock_checkpoints.create_index("item_id", unique=True)
+    await db.stock_checkpoints.create_index([("status", 1), ("detected_at", -1)])
+
@@ -0,0 +1,117 @@
+"""In-process cache for date-range report results.
+
+Entries are keyed by report name plus normalised parameters. Eviction is
+least-recently-used once ``max_entries`` is reached.
+
+Each worker process holds its own entries, so they are checked against a
+version stamp shared in Mongo (``report_cache_versions``). ``sync`` reads the
+stamp before a report is served and drops every local entry once it moved.
+The stamp is bumped when a change reaches a range that may be cached: an
+invoice completed with a ``created_at`` before today, archival, margin
+rebuilds and branch edits.
+
+Ranges reaching into today are not cached at all, because sales keep
+arriving there. Neither is anything computed within ``settle_seconds`` of
+the day changing or of a bump, since a lagging secondary may not show the
+change yet.
+"""
+import json
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Any, Optional
+
+STAMP_ID = "reports"
+
+
+@dataclass
+class CacheEntry:
+    report: str
+    value: Any
+    branch_id: str  # "" when the report covers every branch
+    start: datetime
+    end: datetime
+    version: int
+
+
+class ReportCache:
+    def __init__(self, max_entries: int = 256, settle_seconds: float = 120):
+        self.max_entries = max_entries
+        self.settle_seconds = settle_seconds
+        self.hits = 0
+        self.misses = 0
+        self.version = 0
+        self._settled = False
+        self._entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+
+    @staticmethod
+    def key(report: str, **params) -> str:
+        normalised = {
+            name: value.strip() if isinstance(value, str) else value
+            for name, value in params.items()
+        }
+        return f"{report}:{json.dumps(normalised, sort_keys=True, default=str)}"
+
+    def horizon(self) -> datetime:
+        """Ranges ending before this are cached; later days may still change"""
+        settled = datetime.utcnow() - timedelta(seconds=self.settle_seconds)
+        return settled.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    async def sync(self, db) -> int:
+        """Pick up the shared version stamp, dropping local entries if another process bumped it"""
+        stamp = await db.report_cache_versions.find_one({"_id": STAMP_ID}) or {}
+        version = stamp.get("version", 0)
+        if version != self.version:
+            self._entries.clear()
+            self.version = version
+        bumped_at = stamp.get("bumped_at")
+        self._settled = bumped_at is None or datetime.utcnow() - bumped_at > timedelta(seconds=self.settle_seconds)
+        return version
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None or entry.version != self.version:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry.value
+
+    def put(self, key: str, value: Any, report: str, start: datetime, end: datetime, version: int,
+            branch_id: str = ""):
+        """Cache ``value`` computed at ``version``, the one ``sync`` returned before computing it"""
+        if not self._settled or end >= self.horizon() or version != self.version:
+            return
+        self._entries[key] = CacheEntry(report=report, value=value, branch_id=branch_id, start=start, end=end,
+                                        version=version)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def bump(self, db):
+        """Invalidate every cached report, in every process"""
+        self._entries.clear()
+        await db.report_cache_versions.update_one(
+            {"_id": STAMP_ID}, {"$inc": {"version": 1}, "$set": {"bumped_at": datetime.utcnow()}}, upsert=True
+        )
+
+    async def invalidate(self, db, branch_id: str, when: datetime):
+        """Drop entries affected by an invoice completed for ``branch_id`` dated ``when``"""
+        stale = [
+            key for key, entry in self._entries.items()
+            if entry.start <= when <= entry.end and entry.branch_id in ("", branch_id)
+        ]
+        for key in stale:
+            del self._entries[key]
+        # Other processes may have cached the day of this invoice
+        if when < self.horizon():
+            await self.bump(db)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "version": self.version,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
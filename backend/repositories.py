@@ -0,0 +1,196 @@
+"""Storage of items, invoices, branches and stock transactions.
+
+The branch, item and invoice CRUD handlers, the receipt and low-stock reads
+and the stock ledger go through a repository per entity instead of writing
+Mongo queries themselves:
+
+* ``MongoRepositories``  - the Motor collections, the only backend the server
+  runs on
+* ``SqliteRepositories`` - the same interface on one embedded SQLite file (see
+  sqlite_repositories.py), used by the benchmark
+
+Running a shop on SQLite alone is not supported yet, so there is no setting
+to select a backend. Stock commits and reservations, carts, counters,
+reports, the archive, jobs, tenants and the event feed still use Mongo
+directly, and the server would split invoices and stock between the two
+stores.
+
+Repositories take and return stored documents: plain dicts without ``_id``,
+amounts in minor units (see money.py). Models convert them as before.
+``benchmarks/repositories.py`` runs the same workload against both backends.
+"""
+from typing import Iterable, List, Optional, Protocol
+
+from pymongo import DESCENDING
+from pymongo.errors import BulkWriteError
+
+DUPLICATE_KEY = 11000
+LOW_STOCK_QUERY = {"$expr": {"$lte": ["$stock_quantity", "$min_stock"]}}
+
+
+class ItemRepository(Protocol):
+    async def get(self, item_id: str, fields: Optional[Iterable[str]] = None) -> Optional[dict]: ...
+    async def list(self, search: str = "", limit: int = 100) -> List[dict]: ...
+    async def by_sku(self, sku: str, limit: int = 100) -> List[dict]: ...
+    async def low_stock(self, limit: int = 100) -> List[dict]: ...
+    async def count_low_stock(self) -> int: ...
+    async def insert(self, item: dict): ...
+    async def update(self, item_id: str, fields: dict) -> bool: ...
+    async def delete(self, item_id: str) -> bool: ...
+    async def count(self) -> int: ...
+
+
+class InvoiceRepository(Protocol):
+    async def get(self, invoice_id: str) -> Optional[dict]: ...
+    async def list(self, status: str = "", branch_id: str = "", limit: int = 50) -> List[dict]: ...
+    async def insert(self, invoice: dict): ...
+    async def update(self, invoice_id: str, fields: dict, status: Optional[str] = None) -> bool: ...
+    async def delete(self, invoice_id: str, status: Optional[str] = None) -> bool: ...
+    async def count(self, status: str = "", branch_id: str = "") -> int: ...
+
+
+class BranchRepository(Protocol):
+    async def get(self, branch_id: str) -> Optional[dict]: ...
+    async def list(self, limit: int = 100) -> List[dict]: ...
+    async def insert(self, branch: dict): ...
+    async def update(self, branch_id: str, fields: dict) -> bool: ...
+    async def delete(self, branch_id: str) -> bool: ...
+
+
+class StockTransactionRepository(Protocol):
+    async def insert_many(self, transactions: List[dict]) -> int: ...
+    async def for_item(self, item_id: str, limit: int = 100) -> List[dict]: ...
+
+
+def _projection(fields: Optional[Iterable[str]]) -> dict:
+    return {"_id": 0, **{field: 1 for field in fields or ()}}
+
+
+def _filters(**values) -> dict:
+    return {field: value for field, value in values.items() if value}
+
+
+class MongoItems:
+    def __init__(self, db):
+        self.db = db
+
+    async def get(self, item_id: str, fields: Optional[Iterable[str]] = None) -> Optional[dict]:
+        return await self.db.items.find_one({"id": item_id}, _projection(fields))
+
+    async def list(self, search: str = "", limit: int = 100) -> List[dict]:
+        query = {}
+        if search:
+            query["$or"] = [
+                {field: {"$regex": search, "$options": "i"}}
+                for field in ("sku", "name", "category", "sub_category", "brand")
+            ]
+        return await self.db.items.find(query, _projection(None)).limit(limit).to_list(limit)
+
+    async def by_sku(self, sku: str, limit: int = 100) -> List[dict]:
+        return await self.db.items.find({"sku": sku}, _projection(None)).to_list(limit)
+
+    async def low_stock(self, limit: int = 100) -> List[dict]:
+        return await self.db.items.find(LOW_STOCK_QUERY, _projection(None)).to_list(limit)
+
+    async def count_low_stock(self) -> int:
+        return await self.db.items.count_documents(LOW_STOCK_QUERY)
+
+    async def insert(self, item: dict):
+        # insert_one adds _id to the dict it is given
+        await self.db.items.insert_one(dict(item))
+
+    async def update(self, item_id: str, fields: dict) -> bool:
+        result = await self.db.items.update_one({"id": item_id}, {"$set": fields})
+        return result.matched_count > 0
+
+    async def delete(self, item_id: str) -> bool:
+        result = await self.db.items.delete_one({"id": item_id})
+        return result.deleted_count > 0
+
+    async def count(self) -> int:
+        return await self.db.items.count_documents({})
+
+
+class MongoInvoices:
+    def __init__(self, db):
+        self.db = db
+
+    async def get(self, invoice_id: str) -> Optional[dict]:
+        return await self.db.invoices.find_one({"id": invoice_id}, _projection(None))
+
+    async def list(self, status: str = "", branch_id: str = "", limit: int = 50) -> List[dict]:
+        return await self.db.invoices.find(_filters(status=status, branch_id=branch_id), _projection(None)).sort(
+            "created_at", DESCENDING).limit(limit).to_list(limit)
+
+    async def insert(self, invoice: dict):
+        await self.db.invoices.insert_one(dict(invoice))
+
+    async def update(self, invoice_id: str, fields: dict, status: Optional[str] = None) -> bool:
+        query = {"id": invoice_id, **({"status": status} if status else {})}
+        result = await self.db.invoices.update_one(query, {"$set": fields})
+        return result.matched_count > 0
+
+    async def delete(self, invoice_id: str, status: Optional[str] = None) -> bool:
+        query = {"id": invoice_id, **({"status": status} if status else {})}
+        result = await self.db.invoices.delete_one(query)
+        return result.deleted_count > 0
+
+    async def count(self, status: str = "", branch_id: str = "") -> int:
+        return await self.db.invoices.count_documents(_filters(status=status, branch_id=branch_id))
+
+
+class MongoBranches:
+    def __init__(self, db):
+        self.db = db
+
+    async def get(self, branch_id: str) -> Optional[dict]:
+        return await self.db.branches.find_one({"id": branch_id}, _projection(None))
+
+    async def list(self, limit: int = 100) -> List[dict]:
+        return await self.db.branches.find({}, _projection(None)).to_list(limit)
+
+    async def insert(self, branch: dict):
+        await self.db.branches.insert_one(dict(branch))
+
+    async def update(self, branch_id: str, fields: dict) -> bool:
+        result = await self.db.branches.update_one({"id": branch_id}, {"$set": fields})
+        return result.matched_count > 0
+
+    async def delete(self, branch_id: str) -> bool:
+        result = await self.db.branches.delete_one({"id": branch_id})
+        return result.deleted_count > 0
+
+
+class MongoStockTransactions:
+    def __init__(self, db):
+        self.db = db
+
+    async def insert_many(self, transactions: List[dict]) -> int:
+        """Insert transactions, skipping ones already stored (a replayed ledger segment)"""
+        if not transactions:
+            return 0
+        try:
+            result = await self.db.stock_transactions.insert_many(
+                [dict(transaction) for transaction in transactions], ordered=False
+            )
+        except BulkWriteError as exc:
+            if any(error["code"] != DUPLICATE_KEY for error in exc.details["writeErrors"]):
+                raise
+            return exc.details["nInserted"]
+        return len(result.inserted_ids)
+
+    async def for_item(self, item_id: str, limit: int = 100) -> List[dict]:
+        return await self.db.stock_transactions.find({"item_id": item_id}, _projection(None)).sort(
+            "created_at", DESCENDING).limit(limit).to_list(limit)
+
+
+class MongoRepositories:
+    def __init__(self, db):
+        self.items: ItemRepository = MongoItems(db)
+        self.invoices: InvoiceRepository = MongoInvoices(db)
+        self.branches: BranchRepository = MongoBranches(db)
+        self.stock_transactions: StockTransactionRepository = MongoStockTransactions(db)
+
+    async def close(self):
+        pass
+
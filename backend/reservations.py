@@ -0,0 +1,226 @@
+"""Stock reservations and the available-to-promise (ATP) figure.
+
+``stock_reservations`` holds one document per (invoice, item) for stock parked
+in ongoing invoices::
+
+    {invoice_id, item_id, branch_id, quantity, expires_at}
+
+Each item carries ``reserved_quantity``, the sum of its reservations, kept up
+to date with ``$inc`` whenever a reservation changes, along with the item's
+``updated_at``. Available-to-promise is
+``stock_quantity - reserved_quantity``, so checking availability reads one
+item by its index and reserving or selling stock is a single conditional
+update on the item that cannot take it below what is promised elsewhere.
+
+Expired reservations are released by ``sweep_expired_reservations`` (a
+scheduled job, and on demand when a check comes up short); the TTL index on
+``expires_at`` only removes leftovers a day later. If the counters ever drift,
+``rebuild_reserved_quantities`` recomputes them from the reservations.
+"""
+import os
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+from pymongo.errors import DuplicateKeyError
+
+RESERVATION_MINUTES = float(os.environ.get("CART_RESERVATION_MINUTES", "30"))
+# Expired reservations are removed by the TTL index this long after expiring,
+# leaving the sweeper time to release them from the item counters first
+RESERVATION_TTL_GRACE_SECONDS = 24 * 3600
+
+RESERVED = {"$ifNull": ["$reserved_quantity", 0]}
+
+
+def _reserve(amount: int) -> dict:
+    """Update moving an item's reservations by ``amount``; ATP changes, so catalogue deltas and ETags must see it"""
+    return {"$inc": {"reserved_quantity": amount}, "$set": {"updated_at": datetime.utcnow()}}
+
+
+def reservation_expiry() -> datetime:
+    return datetime.utcnow() + timedelta(minutes=RESERVATION_MINUTES)
+
+
+def available_to_promise(item: dict) -> int:
+    return item["stock_quantity"] - item.get("reserved_quantity", 0)
+
+
+def _atp_at_least(quantity: int, own_reserved: int = 0) -> dict:
+    """Match items whose stock covers ``quantity`` beyond what others have reserved"""
+    return {"$expr": {"$gte": [
+        {"$subtract": ["$stock_quantity", {"$subtract": [RESERVED, own_reserved]}]}, quantity
+    ]}}
+
+
+async def insufficient_stock(db, item_id: str, own_reserved: int = 0) -> HTTPException:
+    item = await db.items.find_one({"id": item_id}, {"_id": 0, "name": 1, "stock_quantity": 1, "reserved_quantity": 1})
+    if not item:
+        return HTTPException(status_code=404, detail=f"Item {item_id} not found")
+    available = available_to_promise(item) + own_reserved
+    return HTTPException(status_code=400, detail=f"Insufficient stock for {item['name']}. Available: {max(available, 0)}")
+
+
+async def _take_reserved(db, item_id: str, amount: int) -> bool:
+    """Add ``amount`` to an item's reservations if its available stock covers it"""
+    result = await db.items.update_one({"id": item_id, **_atp_at_least(amount)}, _reserve(amount))
+    if result.matched_count:
+        return True
+    # Expired reservations may still be counted; release them and try once more
+    if await sweep_expired_reservations(db, item_id):
+        result = await db.items.update_one({"id": item_id, **_atp_at_least(amount)}, _reserve(amount))
+    return bool(result.matched_count)
+
+
+async def set_reservation(db, invoice_id: str, branch_id: str, item_id: str, quantity: int,
+                          expires_at: Optional[datetime] = None, enforce: bool = True) -> int:
+    """Make the invoice's reservation of ``item_id`` exactly ``quantity``; returns the previous quantity.
+
+    With ``enforce`` a growing reservation must fit in the available stock.
+    """
+    expires_at = expires_at or reservation_expiry()
+    current = await db.stock_reservations.find_one({"invoice_id": invoice_id, "item_id": item_id})
+    previous = current["quantity"] if current else 0
+    delta = quantity - previous
+    if current is None and quantity == 0:
+        return 0
+
+    if enforce and delta > 0:
+        if not await _take_reserved(db, item_id, delta):
+            raise await insufficient_stock(db, item_id, previous)
+    elif delta:
+        await db.items.update_one({"id": item_id}, _reserve(delta))
+
+    # Guarded on the previous quantity so a concurrent change or sweep is not double counted
+    try:
+        if current is None:
+            await db.stock_reservations.insert_one({
+                "invoice_id": invoice_id, "item_id": item_id, "branch_id": branch_id,
+                "quantity": quantity, "expires_at": expires_at
+            })
+            changed = True
+        elif quantity == 0:
+            changed = (await db.stock_reservations.delete_one({"_id": current["_id"], "quantity": previous})).deleted_count
+        else:
+            changed = (await db.stock_reservations.update_one(
+                {"_id": current["_id"], "quantity": previous},
+                {"$set": {"quantity": quantity, "expires_at": expires_at}}
+            )).matched_count
+    except DuplicateKeyError:
+        changed = False
+    if not changed:
+        if delta:
+            await db.items.update_one({"id": item_id}, _reserve(-delta))
+        raise HTTPException(status_code=409, detail="Reservation was changed by another request, please retry")
+    return previous
+
+
+async def reserve_invoice(db, invoice_id: str, branch_id: str, quantities: Dict[str, int]) -> datetime:
+    """Make the invoice's reservations match ``quantities``, all or nothing"""
+    expires_at = reservation_expiry()
+    held = {
+        reservation["item_id"]: reservation["quantity"]
+        for reservation in await db.stock_reservations.find({"invoice_id": invoice_id}).to_list(None)
+    }
+    targets = {**dict.fromkeys(held, 0), **quantities}
+
+    # Shrink first so growing lines can use what this invoice gives back
+    changed: List[Tuple[str, int]] = []
+    try:
+        for item_id, quantity in sorted(targets.items(), key=lambda target: target[1] - held.get(target[0], 0)):
+            previous = await set_reservation(db, invoice_id, branch_id, item_id, quantity, expires_at)
+            changed.append((item_id, previous))
+    except HTTPException:
+        for item_id, previous in reversed(changed):
+            await set_reservation(db, invoice_id, branch_id, item_id, previous, expires_at, enforce=False)
+        raise
+    await extend_reservations(db, invoice_id, expires_at)
+    return expires_at
+
+
+async def extend_reservations(db, invoice_id: str, expires_at: Optional[datetime] = None) -> datetime:
+    expires_at = expires_at or reservation_expiry()
+    await db.stock_reservations.update_many({"invoice_id": invoice_id}, {"$set": {"expires_at": expires_at}})
+    return expires_at
+
+
+async def release_reservations(db, invoice_id: str, item_id: Optional[str] = None):
+    query = {"invoice_id": invoice_id}
+    if item_id:
+        query["item_id"] = item_id
+    while True:
+        reservation = await db.stock_reservations.find_one_and_delete(query)
+        if reservation is None:
+            return
+        await db.items.update_one({"id": reservation["item_id"]}, _reserve(-reservation["quantity"]))
+
+
+async def commit_stock(db, invoice_id: str, quantities: Dict[str, int]) -> Dict[str, int]:
+    """Take sold stock off the items, consuming the invoice's reservations.
+
+    Each item must cover its quantity beyond what other invoices have
+    reserved. All or nothing: if one item is short, stock already taken is
+    put back and the invoice keeps its reservations.
+    """
+    committed: List[Tuple[str, int, Optional[dict]]] = []
+    try:
+        for item_id, quantity in quantities.items():
+            reservation = await db.stock_reservations.find_one_and_delete({"invoice_id": invoice_id, "item_id": item_id})
+            own_reserved = reservation["quantity"] if reservation else 0
+            result = await db.items.update_one(
+                {"id": item_id, **_atp_at_least(quantity, own_reserved)},
+                {"$inc": {"stock_quantity": -quantity, "reserved_quantity": -own_reserved},
+                 "$set": {"updated_at": datetime.utcnow()}}
+            )
+            if not result.matched_count:
+                if reservation:
+                    await db.stock_reservations.insert_one(reservation)
+                raise await insufficient_stock(db, item_id, own_reserved)
+            committed.append((item_id, quantity, reservation))
+    except Exception:
+        for item_id, quantity, reservation in reversed(committed):
+            own_reserved = reservation["quantity"] if reservation else 0
+            # A new updated_at so catalogue deltas and ETags pick up the restored stock
+            await db.items.update_one(
+                {"id": item_id},
+                {"$inc": {"stock_quantity": quantity, "reserved_quantity": own_reserved},
+                 "$set": {"updated_at": datetime.utcnow()}}
+            )
+            if reservation:
+                await db.stock_reservations.insert_one(reservation)
+        raise
+    return quantities
+
+
+async def sweep_expired_reservations(db, item_id: Optional[str] = None) -> int:
+    """Release expired reservations from the item counters"""
+    query = {"expires_at": {"$lte": datetime.utcnow()}}
+    if item_id:
+        query["item_id"] = item_id
+    released = 0
+    while True:
+        reservation = await db.stock_reservations.find_one_and_delete(query)
+        if reservation is None:
+            return released
+        await db.items.update_one({"id": reservation["item_id"]}, _reserve(-reservation["quantity"]))
+        released += 1
+
+
+async def rebuild_reserved_quantities(db) -> int:
+    """Recompute every item's ``reserved_quantity`` from the active reservations"""
+    await sweep_expired_reservations(db)
+    totals = await db.stock_reservations.aggregate([
+        {"$group": {"_id": "$item_id", "quantity": {"$sum": "$quantity"}}}
+    ]).to_list(None)
+    now = datetime.utcnow()
+    await db.items.update_many({"reserved_quantity": {"$ne": 0}}, {"$set": {"reserved_quantity": 0, "updated_at": now}})
+    for total in totals:
+        await db.items.update_one({"id": total["_id"]}, {"$set": {"reserved_quantity": total["quantity"], "updated_at": now}})
+    return len(totals)
+
+
+def invoice_quantities(lines: List[dict]) -> Dict[str, int]:
+    """Total quantity per item across an invoice's lines"""
+    quantities: Dict[str, int] = {}
+    for line in lines:
+        quantities[line["item_id"]] = quantities.get(line["item_id"], 0) + line["quantity"]
+    return quantities
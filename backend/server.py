@@ -1,31 +1,190 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Query
+from fastapi import FastAPI, APIRouter, HTTPException, Query, Request, Response
+from fastapi.responses import FileResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from contextlib import asynccontextmanager
+import asyncio
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, model_validator
 from typing import List, Optional
+import gzip
+import time
 import uuid
 from datetime import datetime, timedelta
 from decimal import Decimal
+from database import Database, DatabaseProxy, DatabaseSettings, current_tenant_id
+from tenants import TENANT_ID_PATTERN, TenantLocal, TenantMiddleware, TenantRegistry
+from jobs import Job, JobCreate, JobManager, JOB_COMPLETED, job_settings_from_env
+from report_cache import ReportCache
+from exports import EXPORT_DATASETS, EXPORT_FORMATS, export_invoices
+from archive import aggregate_invoices, archive_completed_invoices, archived_invoice_count, find_invoice
+from http_caching import (
+    IMMUTABLE, REVALIDATE, VERSION_FIELDS, VERSION_PROJECTION, cache_headers, content_etag, is_conditional, is_not_modified,
+    not_modified, version_etag
+)
+from coalescing import SingleFlight
+from orchestration import gather_queries
+from counters import (
+    ensure_counters_seeded, increment_invoice_count, invoice_counts, move_invoice_count, rebuild_invoice_counters
+)
+from compression import NegotiatedEncodingMiddleware, accepts_encoding
+from admission import AdmissionController, AdmissionMiddleware, admission_settings_from_env, offload
+from profiling import Profiler, ProfilingMiddleware, profiler_settings_from_env, span, traced
+from catalogue import CatalogueSnapshots, TOMBSTONE_RETENTION_DAYS, build_delta, delta_expired
+from ledger import StockLedger, ledger_settings_from_env
+from repositories import MongoRepositories
+from outbox import EVENT_RETENTION_DAYS, EventFeed, event, parse_token
+from reconciliation import (
+    STOCK_RECONCILE_ADJUST, STOCK_RECONCILE_SETTLE_SECONDS, ensure_reconciliation_indexes, reconcile_stock, stock_discrepancies
+)
+from forecasting import (
+    FORECAST_APPLY_MIN_STOCK, FORECAST_HISTORY_DAYS, FORECAST_LEAD_TIME_DAYS, FORECAST_SERVICE_LEVEL, current_forecast_run,
+    forecast_demand
+)
+from invoice_search import ensure_search_indexes, ensure_search_keys, search_invoices, search_keys, search_query
+from margins import MARGIN_GROUPS, cost_snapshot, margin_report, rebuild_margin_rollups, record_invoice_margin, snapshot_line_costs
+from money import (
+    ITEM_MONEY_FIELDS, ensure_money_migrated, from_minor, invoice_document, invoice_from_document, item_document,
+    item_from_document, line_document, migrate_money, stored_minor, to_minor
+)
+from cart import ItemCache, add_line, remove_line, set_line_quantity
+from reservations import (
+    RESERVATION_TTL_GRACE_SECONDS, available_to_promise, commit_stock, invoice_quantities, rebuild_reserved_quantities,
+    release_reservations, reserve_invoice, sweep_expired_reservations
+)
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+# MongoDB connection, opened by the application lifespan
+database = Database(DatabaseSettings.from_env())
+db = DatabaseProxy(database)
+# Heavy report reads, routed by MONGO_REPORT_READ_PREFERENCE
+report_db = DatabaseProxy(database, role="reports")
+
+# Tenant registry; db and report_db resolve to the current tenant's database
+tenants = TenantRegistry(database, base_domain=os.environ.get("TENANT_BASE_DOMAIN", ""))
+
+# Items, invoices, branches and stock transactions of the current tenant; each call is a profiling span
+repositories = MongoRepositories(db)
+for name in ("items", "invoices", "branches", "stock_transactions"):
+    setattr(repositories, name, traced(getattr(repositories, name), name))
+
+# Background jobs for long-running reports and exports
+job_manager = JobManager(db, tenants=tenants, **job_settings_from_env())
+
+# Completed invoices older than this are moved to the archive partitions
+INVOICE_ARCHIVE_AFTER_DAYS = int(os.environ.get("INVOICE_ARCHIVE_AFTER_DAYS", "365"))
+INVOICE_ARCHIVE_INTERVAL_HOURS = float(os.environ.get("INVOICE_ARCHIVE_INTERVAL_HOURS", "0"))
+
+# Cached results of date-range reports, invalidated when invoices complete
+report_cache = TenantLocal(lambda: ReportCache(
+    max_entries=int(os.environ.get("REPORT_CACHE_MAX_ENTRIES", "256")),
+    settle_seconds=float(os.environ.get("REPORT_CACHE_SETTLE_SECONDS", "120"))
+))
+
+# Dashboard low stock count outside exact mode is refreshed at most this often
+LOW_STOCK_COUNT_TTL_SECONDS = float(os.environ.get("LOW_STOCK_COUNT_TTL_SECONDS", "60"))
+low_stock_counts = {}
+
+# Identical concurrent reads of hot endpoints share one query
+single_flight = SingleFlight()
+
+# Encoded catalogue snapshot for billing tills, rebuilt when the catalogue changes
+catalogue_snapshots = TenantLocal(CatalogueSnapshots)
+
+# Item data used to price parked cart lines
+item_cache = TenantLocal(ItemCache)
+
+# Stock transactions are written behind the request, spilled to disk until flushed
+stock_ledger = StockLedger(repositories.stock_transactions, **ledger_settings_from_env())
+
+# Change feed of invoice, stock and item events for integrations
+event_feed = EventFeed()
+
+# Per route class concurrency limits; reports are shed first under load
+admission = AdmissionController(**admission_settings_from_env())
+
+# Sampled request profiles, off unless PROFILE_SAMPLE_RATE or PROFILE_ON_HEADER is set
+profiler = Profiler(**profiler_settings_from_env())
+
+# Reorder points are recomputed from sales history this often (0 disables)
+FORECAST_INTERVAL_HOURS = float(os.environ.get("FORECAST_INTERVAL_HOURS", "24"))
+
+# Item stock is checked against the stock ledger this often (0 disables)
+STOCK_RECONCILE_INTERVAL_HOURS = float(os.environ.get("STOCK_RECONCILE_INTERVAL_HOURS", "24"))
+
+# Expired stock reservations are released from the item counters this often
+RESERVATION_SWEEP_MINUTES = float(os.environ.get("RESERVATION_SWEEP_MINUTES", "5"))
+
+# Completions still unfinished after this long are settled by the recovery job,
+# which runs this often (0 disables)
+INVOICE_COMPLETION_TIMEOUT_SECONDS = float(os.environ.get("INVOICE_COMPLETION_TIMEOUT_SECONDS", "300"))
+INVOICE_COMPLETION_SWEEP_MINUTES = float(os.environ.get("INVOICE_COMPLETION_SWEEP_MINUTES", "5"))
+
+@tenants.on_provision
+async def ensure_indexes():
+    await db.items.create_index("id", unique=True)
+    await db.stock_transactions.create_index("id", unique=True)
+    await db.stock_transactions.create_index([("transaction_type", 1), ("created_at", 1)])
+    await db.demand_forecasts.create_index([("item_id", 1), ("branch_id", 1)])
+    await db.margin_rollups.create_index(
+        [("date", 1), ("branch_id", 1), ("item_id", 1), ("category", 1), ("brand", 1)], unique=True
+    )
+    await db.events.create_index("seq", unique=True)
+    await db.events.create_index("created_at", expireAfterSeconds=EVENT_RETENTION_DAYS * 86400)
+    await db.items.create_index("updated_at")
+    await db.item_tombstones.create_index("deleted_at", expireAfterSeconds=TOMBSTONE_RETENTION_DAYS * 86400)
+    await db.invoice_counters.create_index("branch_id", unique=True)
+    await ensure_search_indexes(db)
+    await ensure_reconciliation_indexes(db)
+    await db.stock_reservations.create_index([("invoice_id", 1), ("item_id", 1)], unique=True)
+    await db.stock_reservations.create_index([("item_id", 1), ("expires_at", 1)])
+    await db.stock_reservations.create_index("expires_at", expireAfterSeconds=RESERVATION_TTL_GRACE_SECONDS)
+
+@tenants.on_provision
+async def ensure_money_minor_units():
+    # Writes add minor units to stored amounts, so nothing is served before stored floats are converted
+    await ensure_money_migrated(db)
+
+# Backfills scan whole collections, so they run as a job rather than at startup
+BACKFILL_CHECK_HOURS = float(os.environ.get("BACKFILL_CHECK_HOURS", "24"))
+
+# Readiness probe pings Mongo with this timeout
+READINESS_TIMEOUT_SECONDS = float(os.environ.get("READINESS_TIMEOUT_SECONDS", "2"))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.ready = False
+    database.connect()
+    await tenants.collection.create_index("id", unique=True)
+    await tenants.collection.create_index("db_name", unique=True)
+    async with tenants.scope(tenants.default):
+        pass
+    await stock_ledger.start()
+    await job_manager.start()
+    await admission.start()
+    app.state.ready = True
+    yield
+    app.state.ready = False
+    await admission.stop()
+    await job_manager.stop()
+    await stock_ledger.stop()
+    database.close()
 
 # Create the main app without a prefix
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
 # Models
+class TenantCreate(BaseModel):
+    id: str
+    db_name: str = ""
+
 class Branch(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     name: str
@@ -50,9 +209,20 @@ class Item(BaseModel):
     cost_price: float
     selling_price: float
     stock_quantity: int = 0
+    reserved_quantity: int = 0  # held by ongoing invoices, see reservations.py
     min_stock: int = 5
+    suggested_min_stock: Optional[int] = None  # reorder point from forecasting.py
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
+    
+    # Stored documents hold amounts in minor units, see money.py
+    @model_validator(mode="before")
+    @classmethod
+    def from_document(cls, data):
+        return item_from_document(data)
+    
+    def document(self) -> dict:
+        return item_document(self.dict())
 
 class ItemCreate(BaseModel):
     sku: str
@@ -83,6 +253,10 @@ class InvoiceItem(BaseModel):
     quantity: int
     unit_price: float
     line_total: float
+    # Snapshot of the item when the invoice completed, see margins.py
+    cost_price: Optional[float] = None
+    category: str = ""
+    brand: str = ""
 
 class Invoice(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -98,6 +272,14 @@ class Invoice(BaseModel):
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
     created_by: str = "system"
+    
+    @model_validator(mode="before")
+    @classmethod
+    def from_document(cls, data):
+        return invoice_from_document(data)
+    
+    def document(self) -> dict:
+        return invoice_document(self.dict())
 
 class InvoiceCreate(BaseModel):
     branch_id: str = "main"
@@ -113,6 +295,23 @@ class InvoiceUpdate(BaseModel):
     items: Optional[List[dict]] = None  # {item_id, quantity, selected_price}
     payment_mode: Optional[str] = None
 
+class CartLine(BaseModel):
+    item_id: str
+    quantity: int = Field(gt=0)
+    selected_price: Optional[float] = None
+
+class CartLineUpdate(BaseModel):
+    quantity: int = Field(ge=0)  # 0 removes the line
+    selected_price: Optional[float] = None
+
+class CartUpdate(BaseModel):
+    invoice_id: str
+    line: Optional[InvoiceItem] = None  # None once the line is removed
+    subtotal: float
+    final_total: float
+    updated_at: datetime
+    reserved_until: Optional[datetime] = None
+
 class StockTransaction(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     item_id: str
@@ -123,41 +322,68 @@ class StockTransaction(BaseModel):
     reference_id: str
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
+# Health Probes
+@api_router.get("/health/live")
+async def liveness():
+    """The process is up and serving requests"""
+    return {"status": "ok"}
+
+@api_router.get("/health/ready")
+async def readiness(request: Request, response: Response):
+    """Startup has finished and Mongo answers; load balancers route traffic only once this passes"""
+    if not getattr(request.app.state, "ready", False):
+        response.status_code = 503
+        return {"status": "starting"}
+    try:
+        await asyncio.wait_for(db.command("ping"), READINESS_TIMEOUT_SECONDS)
+    except Exception as e:
+        response.status_code = 503
+        return {"status": "unavailable", "detail": str(e)}
+    return {"status": "ready"}
+
 # Branch Management Routes
 @api_router.post("/branches", response_model=Branch)
 async def create_branch(branch: BranchCreate):
     branch_dict = branch.dict()
     branch_obj = Branch(**branch_dict)
-    await db.branches.insert_one(branch_obj.dict())
+    await repositories.branches.insert(branch_obj.dict())
+    await report_cache.bump(db)
     return branch_obj
 
 @api_router.get("/branches", response_model=List[Branch])
-async def get_branches():
-    branches = await db.branches.find().to_list(100)
+async def get_branches(request: Request, response: Response):
+    branches = await repositories.branches.list()
+    headers = cache_headers(content_etag(branches))
+    if is_not_modified(request, headers["ETag"]):
+        return not_modified(headers)
+    response.headers.update(headers)
     return [Branch(**branch) for branch in branches]
 
 @api_router.get("/branches/{branch_id}", response_model=Branch)
-async def get_branch(branch_id: str):
-    branch = await db.branches.find_one({"id": branch_id})
+async def get_branch(branch_id: str, request: Request, response: Response):
+    branch = await repositories.branches.get(branch_id)
     if not branch:
         raise HTTPException(status_code=404, detail="Branch not found")
+    headers = cache_headers(content_etag(branch))
+    if is_not_modified(request, headers["ETag"]):
+        return not_modified(headers)
+    response.headers.update(headers)
     return Branch(**branch)
 
 @api_router.put("/branches/{branch_id}", response_model=Branch)
 async def update_branch(branch_id: str, branch_update: BranchCreate):
-    branch = await db.branches.find_one({"id": branch_id})
-    if not branch:
+    if not await repositories.branches.update(branch_id, branch_update.dict()):
         raise HTTPException(status_code=404, detail="Branch not found")
     
-    await db.branches.update_one({"id": branch_id}, {"$set": branch_update.dict()})
-    updated_branch = await db.branches.find_one({"id": branch_id})
+    await report_cache.bump(db)
+    updated_branch = await repositories.branches.get(branch_id)
     return Branch(**updated_branch)
 
 @api_router.delete("/branches/{branch_id}")
 async def delete_branch(branch_id: str):
-    result = await db.branches.delete_one({"id": branch_id})
-    if result.deleted_count == 0:
+    if not await repositories.branches.delete(branch_id):
         raise HTTPException(status_code=404, detail="Branch not found")
+    await report_cache.bump(db)
     return {"message": "Branch deleted successfully"}
 
 # Item Management Routes
@@ -166,66 +392,180 @@ async def create_item(item: ItemCreate):
     # Allow multiple items with same SKU but different prices
     item_dict = item.dict()
     item_obj = Item(**item_dict)
-    await db.items.insert_one(item_obj.dict())
+    await repositories.items.insert(item_obj.document())
+    await event_feed.publish(db, [event(
+        "item.created", item_obj.id, sku=item_obj.sku, name=item_obj.name,
+        selling_price=item_obj.selling_price, stock_quantity=item_obj.stock_quantity
+    )])
     return item_obj
 
 @api_router.get("/items", response_model=List[Item])
 async def get_items(search: str = Query("", description="Search by SKU, name, or category")):
-    if search:
-        query = {
-            "$or": [
-                {"sku": {"$regex": search, "$options": "i"}},
-                {"name": {"$regex": search, "$options": "i"}},
-                {"category": {"$regex": search, "$options": "i"}},
-                {"sub_category": {"$regex": search, "$options": "i"}},
-                {"brand": {"$regex": search, "$options": "i"}}
-            ]
-        }
-    else:
-        query = {}
-    
-    items = await db.items.find(query).limit(100).to_list(100)
+    items = await repositories.items.list(search)
     return [Item(**item) for item in items]
 
 @api_router.get("/items/by-sku/{sku}")
 async def get_items_by_sku(sku: str):
     """Get all price variants for a specific SKU"""
-    items = await db.items.find({"sku": sku}).to_list(100)
+    items = await repositories.items.by_sku(sku)
+    return [Item(**item) for item in items]
+
+@api_router.get("/items/low-stock")
+@single_flight.coalesce()
+async def get_low_stock_items():
+    items = await repositories.items.low_stock()
     return [Item(**item) for item in items]
 
 @api_router.get("/items/{item_id}", response_model=Item)
-async def get_item(item_id: str):
-    item = await db.items.find_one({"id": item_id})
+async def get_item(item_id: str, request: Request, response: Response):
+    # Answer revalidations from the version fields alone, before loading the item
+    if is_conditional(request):
+        version = await repositories.items.get(item_id, VERSION_FIELDS)
+        if version:
+            headers = cache_headers(version_etag(version), version["updated_at"])
+            if is_not_modified(request, headers["ETag"], version["updated_at"]):
+                return not_modified(headers)
+    
+    item = await repositories.items.get(item_id)
     if not item:
         raise HTTPException(status_code=404, detail="Item not found")
+    response.headers.update(cache_headers(version_etag(item), item["updated_at"]))
     return Item(**item)
 
+@api_router.get("/items/{item_id}/availability")
+async def get_item_availability(item_id: str):
+    """Stock available to promise: on hand less what ongoing invoices have reserved"""
+    item = await repositories.items.get(item_id, ("id", "stock_quantity", "reserved_quantity"))
+    if not item:
+        raise HTTPException(status_code=404, detail="Item not found")
+    return {
+        "item_id": item["id"],
+        "stock_quantity": item["stock_quantity"],
+        "reserved_quantity": item.get("reserved_quantity", 0),
+        "available_quantity": available_to_promise(item)
+    }
+
+@api_router.get("/items/{item_id}/forecast")
+async def get_item_forecast(item_id: str):
+    """Daily demand and reorder point per branch from the latest forecast run"""
+    query = {"item_id": item_id}
+    run_id = await current_forecast_run(db)
+    if run_id:
+        query["run_id"] = run_id
+    return await db.demand_forecasts.find(query, {"_id": 0, "run_id": 0}).to_list(100)
+
 @api_router.put("/items/{item_id}", response_model=Item)
 async def update_item(item_id: str, item_update: ItemUpdate):
-    item = await db.items.find_one({"id": item_id})
+    item = await repositories.items.get(item_id)
     if not item:
         raise HTTPException(status_code=404, detail="Item not found")
     
     update_data = {k: v for k, v in item_update.dict().items() if v is not None}
     update_data["updated_at"] = datetime.utcnow()
     
-    await db.items.update_one({"id": item_id}, {"$set": update_data})
-    updated_item = await db.items.find_one({"id": item_id})
+    # Amounts are rewritten together so the document keeps a single money scale
+    current = item_from_document(item)
+    stored = item_document({**{field: current[field] for field in ITEM_MONEY_FIELDS if field in current}, **update_data})
+    await repositories.items.update(item_id, stored)
+    item_cache.invalidate(item_id)
+    
+    changes = {k: v for k, v in update_data.items() if k != "updated_at" and current.get(k) != v}
+    events = [event("item.updated", item_id, **changes)] if changes else []
+    if "stock_quantity" in changes:
+        events.append(event(
+            "stock.changed", item_id, stock_quantity=changes["stock_quantity"],
+            delta=changes["stock_quantity"] - item["stock_quantity"], reference_type="ADJUSTMENT"
+        ))
+        # Keeps the ledger in step with the stock, see reconciliation.py
+        await stock_ledger.record([StockTransaction(
+            item_id=item_id,
+            transaction_type="ADJUSTMENT",
+            quantity=changes["stock_quantity"] - item["stock_quantity"],
+            reference_type="ADJUSTMENT",
+            reference_id=item_id
+        ).dict()])
+    await event_feed.publish(db, events)
+    
+    updated_item = await repositories.items.get(item_id)
     return Item(**updated_item)
 
 @api_router.delete("/items/{item_id}")
 async def delete_item(item_id: str):
-    result = await db.items.delete_one({"id": item_id})
-    if result.deleted_count == 0:
+    if not await repositories.items.delete(item_id):
         raise HTTPException(status_code=404, detail="Item not found")
+    await db.item_tombstones.insert_one({"id": item_id, "deleted_at": datetime.utcnow()})
+    item_cache.invalidate(item_id)
+    await event_feed.publish(db, [event("item.deleted", item_id)])
     return {"message": "Item deleted successfully"}
 
+# Catalogue Sync Routes
+def catalogue_response(request: Request, body: bytes, headers: dict) -> Response:
+    headers["Vary"] = "Accept-Encoding"
+    if accepts_encoding(request.headers.get("accept-encoding", ""), "gzip"):
+        headers["Content-Encoding"] = "gzip"
+    else:
+        body = gzip.decompress(body)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+@api_router.get("/catalogue/snapshot")
+async def get_catalogue_snapshot(request: Request):
+    """Full catalogue in columnar layout with the fields billing needs"""
+    version, body = await catalogue_snapshots.get(db)
+    etag = f'"catalogue-{version}"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    return catalogue_response(request, body, {"ETag": etag})
+
+@api_router.get("/catalogue/delta")
+async def get_catalogue_delta(request: Request, since: int = Query(..., ge=0, description="Catalogue version held by the client")):
+    """Items changed or removed since a catalogue version"""
+    if delta_expired(since):
+        raise HTTPException(status_code=410, detail="Catalogue version is too old, download a new snapshot")
+    body = await build_delta(db, since)
+    return catalogue_response(request, body, {"Cache-Control": "no-store"})
+
 # Invoice Management Routes
+async def record_invoice_stock_out(invoice: dict):
+    """Queue a stock transaction for each line of a completed invoice"""
+    stock_transactions = []
+    for index, line in enumerate(invoice["items"]):
+        item_cache.invalidate(line["item_id"])
+        stock_transaction = StockTransaction(
+            # Derived from the invoice line, so recording a completion twice stores each entry once
+            id=str(uuid.uuid5(uuid.NAMESPACE_URL, f"invoice/{invoice['id']}/{index}")),
+            item_id=line["item_id"],
+            branch_id=invoice.get("branch_id", "main"),
+            transaction_type="OUT",
+            quantity=line["quantity"],
+            reference_type="INVOICE",
+            reference_id=invoice["invoice_number"]
+        )
+        stock_transactions.append(stock_transaction.dict())
+    await stock_ledger.record(stock_transactions)
+
+async def publish_sale_events(invoice: dict):
+    """Announce a completed invoice and the stock it took"""
+    events = [event(
+        "invoice.completed", invoice["id"], invoice_number=invoice["invoice_number"],
+        branch_id=invoice.get("branch_id", "main"), final_total=from_minor(stored_minor(invoice, "final_total")),
+        line_count=len(invoice["items"])
+    )]
+    events += [
+        event("stock.changed", item_id, delta=-quantity, reference_type="INVOICE", reference_id=invoice["invoice_number"])
+        for item_id, quantity in invoice_quantities(invoice["items"]).items()
+    ]
+    await event_feed.publish(db, events)
+
 @api_router.post("/invoices", response_model=Invoice)
 async def create_invoice(invoice_data: InvoiceCreate):
     # Generate invoice number with branch prefix
     branch_prefix = invoice_data.branch_id.upper()[:3]
-    count = await db.invoices.count_documents({"branch_id": invoice_data.branch_id})
+    with span("invoice number"):
+        counts = await gather_queries({
+            "hot": lambda: repositories.invoices.count(branch_id=invoice_data.branch_id),
+            "archived": lambda: archived_invoice_count(db, invoice_data.branch_id)
+        })
+    count = counts["hot"] + counts["archived"]
     invoice_number = f"{branch_prefix}-{count + 1:06d}"
     
     invoice_items = []
@@ -233,64 +573,70 @@ async def create_invoice(invoice_data: InvoiceCreate):
     
     # Process each item
     for item_data in invoice_data.items:
-        item = await db.items.find_one({"id": item_data["item_id"]})
+        item = await repositories.items.get(item_data["item_id"])
         if not item:
             raise HTTPException(status_code=404, detail=f"Item {item_data['item_id']} not found")
         
-        # Check stock availability
-        if item["stock_quantity"] < item_data["quantity"]:
-            raise HTTPException(status_code=400, detail=f"Insufficient stock for {item['name']}. Available: {item['stock_quantity']}")
+        # Check stock availability, less what ongoing invoices have reserved
+        if available_to_promise(item) < item_data["quantity"]:
+            raise HTTPException(status_code=400, detail=f"Insufficient stock for {item['name']}. Available: {max(available_to_promise(item), 0)}")
         
-        # Use selected price if provided, otherwise use item's selling price
-        unit_price = item_data.get("selected_price", item["selling_price"])
+        # Use selected price if provided, otherwise use item's selling price, in minor units
+        selected_price = item_data.get("selected_price")
+        unit_price = stored_minor(item, "selling_price") if selected_price is None else to_minor(selected_price)
         quantity = item_data["quantity"]
         line_total = quantity * unit_price
         
-        invoice_item = InvoiceItem(
-            item_id=item["id"],
-            sku=item["sku"],
-            name=item["name"],
-            quantity=quantity,
-            unit_price=unit_price,
-            line_total=line_total
-        )
-        
-        invoice_items.append(invoice_item)
-        subtotal += line_total
-        
-        # Update stock only if invoice is completed
-        if invoice_data.status == "completed":
-            new_stock = item["stock_quantity"] - quantity
-            await db.items.update_one(
-                {"id": item["id"]},
-                {"$set": {"stock_quantity": new_stock, "updated_at": datetime.utcnow()}}
-            )
-            
-            # Record stock transaction
-            stock_transaction = StockTransaction(
+        with span("model InvoiceItem"):
+            invoice_item = InvoiceItem(
                 item_id=item["id"],
-                branch_id=invoice_data.branch_id,
-                transaction_type="OUT",
+                sku=item["sku"],
+                name=item["name"],
                 quantity=quantity,
-                reference_type="INVOICE",
-                reference_id=invoice_number
+                unit_price=from_minor(unit_price),
+                line_total=from_minor(line_total),
+                **cost_snapshot(item)
             )
-            await db.stock_transactions.insert_one(stock_transaction.dict())
+        
+        invoice_items.append(invoice_item)
+        subtotal += line_total
     
     # Create invoice
-    invoice = Invoice(
-        invoice_number=invoice_number,
-        branch_id=invoice_data.branch_id,
-        customer_name=invoice_data.customer_name,
-        customer_phone=invoice_data.customer_phone,
-        items=invoice_items,
-        subtotal=subtotal,
-        final_total=subtotal,  # No GST calculations
-        payment_mode=invoice_data.payment_mode,
-        status=invoice_data.status
-    )
+    with span("model Invoice"):
+        invoice = Invoice(
+            invoice_number=invoice_number,
+            branch_id=invoice_data.branch_id,
+            customer_name=invoice_data.customer_name,
+            customer_phone=invoice_data.customer_phone,
+            items=invoice_items,
+            subtotal=from_minor(subtotal),
+            final_total=from_minor(subtotal),  # No GST calculations
+            payment_mode=invoice_data.payment_mode,
+            status=invoice_data.status
+        )
     
-    await db.invoices.insert_one(invoice.dict())
+    # Completed invoices take their stock now, ongoing ones reserve it
+    quantities = invoice_quantities([line.dict() for line in invoice_items])
+    if invoice.status == "completed":
+        with span("commit stock"):
+            await commit_stock(db, invoice.id, quantities)
+        with span("ledger record"):
+            await record_invoice_stock_out(invoice.dict())
+    else:
+        with span("reserve stock"):
+            await reserve_invoice(db, invoice.id, invoice.branch_id, quantities)
+    
+    with span("invoice document"):
+        document = {**invoice.document(), **search_keys(invoice.customer_name, invoice.customer_phone)}
+    await repositories.invoices.insert(document)
+    with span("invoice counters"):
+        await increment_invoice_count(db, invoice.branch_id, invoice.status)
+    if invoice.status == "completed":
+        with span("margin rollups"):
+            await record_invoice_margin(db, document)
+        await report_cache.invalidate(db, invoice.branch_id, invoice.created_at)
+        with span("sale events"):
+            await publish_sale_events(document)
     return invoice
 
 @api_router.get("/invoices", response_model=List[Invoice])
@@ -299,36 +645,70 @@ async def get_invoices(
     status: str = Query("", description="Filter by status"),
     branch_id: str = Query("", description="Filter by branch")
 ):
-    query = {}
-    if status:
-        query["status"] = status
-    if branch_id:
-        query["branch_id"] = branch_id
-    
-    invoices = await db.invoices.find(query).sort("created_at", -1).limit(limit).to_list(limit)
+    invoices = await repositories.invoices.list(status, branch_id, limit)
     return [Invoice(**invoice) for invoice in invoices]
 
 @api_router.get("/invoices/ongoing", response_model=List[Invoice])
+@single_flight.coalesce()
 async def get_ongoing_invoices(branch_id: str = Query("", description="Filter by branch")):
     """Get all ongoing invoices"""
-    query = {"status": "ongoing"}
-    if branch_id:
-        query["branch_id"] = branch_id
-    
-    invoices = await db.invoices.find(query).sort("created_at", -1).to_list(100)
+    invoices = await repositories.invoices.list("ongoing", branch_id, 100)
     return [Invoice(**invoice) for invoice in invoices]
 
+@api_router.get("/invoices/search")
+async def search_invoice_summaries(
+    number: str = Query("", description="Invoice number prefix, e.g. MAI-0001"),
+    phone: str = Query("", description="Customer phone prefix; spaces and symbols are ignored"),
+    name: str = Query("", description="Customer name prefix, case-insensitive"),
+    start_date: str = Query("", description="Created on or after, YYYY-MM-DD"),
+    end_date: str = Query("", description="Created on or before, YYYY-MM-DD"),
+    min_total: Optional[float] = Query(None, ge=0),
+    max_total: Optional[float] = Query(None, ge=0),
+    status: str = Query("", description="Filter by status"),
+    branch_id: str = Query("", description="Filter by branch"),
+    limit: int = Query(25, ge=1, le=100),
+    after: str = Query("", description="The next token of the previous page")
+):
+    """Find invoices by number, customer or amount, newest first, one page at a time"""
+    try:
+        start_dt = datetime.strptime(start_date, "%Y-%m-%d") if start_date else None
+        end_dt = datetime.strptime(end_date, "%Y-%m-%d").replace(hour=23, minute=59, second=59) if end_date else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD")
+    
+    query = search_query(number, phone, name, start_dt, end_dt, min_total, max_total, status, branch_id, after)
+    return await search_invoices(db, query, start_dt, end_dt, limit, include_archive=status in ("", "completed"))
+
+def invoice_cache_headers(invoice: dict) -> dict:
+    cache_control = IMMUTABLE if invoice["status"] == "completed" else REVALIDATE
+    return cache_headers(version_etag(invoice), invoice["updated_at"], cache_control)
+
+async def check_invoice_not_modified(request: Request, invoice_id: str) -> Optional[Response]:
+    if not is_conditional(request):
+        return None
+    version = await find_invoice(db, invoice_id, VERSION_PROJECTION)
+    if version:
+        headers = invoice_cache_headers(version)
+        if is_not_modified(request, headers["ETag"], version["updated_at"]):
+            return not_modified(headers)
+    return None
+
 @api_router.get("/invoices/{invoice_id}", response_model=Invoice)
-async def get_invoice(invoice_id: str):
-    invoice = await db.invoices.find_one({"id": invoice_id})
+async def get_invoice(invoice_id: str, request: Request, response: Response):
+    cached = await check_invoice_not_modified(request, invoice_id)
+    if cached:
+        return cached
+    
+    invoice = await find_invoice(db, invoice_id)
     if not invoice:
         raise HTTPException(status_code=404, detail="Invoice not found")
+    response.headers.update(invoice_cache_headers(invoice))
     return Invoice(**invoice)
 
 @api_router.put("/invoices/{invoice_id}", response_model=Invoice)
 async def update_ongoing_invoice(invoice_id: str, invoice_update: InvoiceUpdate):
     """Update ongoing invoice details"""
-    invoice = await db.invoices.find_one({"id": invoice_id})
+    invoice = await repositories.invoices.get(invoice_id)
     if not invoice:
         raise HTTPException(status_code=404, detail="Invoice not found")
     
@@ -344,6 +724,11 @@ async def update_ongoing_invoice(invoice_id: str, invoice_update: InvoiceUpdate)
         update_data["customer_phone"] = invoice_update.customer_phone
     if invoice_update.payment_mode is not None:
         update_data["payment_mode"] = invoice_update.payment_mode
+    if "customer_name" in update_data or "customer_phone" in update_data:
+        update_data.update(search_keys(
+            update_data.get("customer_name", invoice.get("customer_name", "")),
+            update_data.get("customer_phone", invoice.get("customer_phone", ""))
+        ))
     
     # Update items if provided
     if invoice_update.items is not None:
@@ -351,15 +736,12 @@ async def update_ongoing_invoice(invoice_id: str, invoice_update: InvoiceUpdate)
         subtotal = 0
         
         for item_data in invoice_update.items:
-            item = await db.items.find_one({"id": item_data["item_id"]})
+            item = await repositories.items.get(item_data["item_id"])
             if not item:
                 raise HTTPException(status_code=404, detail=f"Item {item_data['item_id']} not found")
             
-            # Check stock availability
-            if item["stock_quantity"] < item_data["quantity"]:
-                raise HTTPException(status_code=400, detail=f"Insufficient stock for {item['name']}. Available: {item['stock_quantity']}")
-            
-            unit_price = item_data.get("selected_price", item["selling_price"])
+            selected_price = item_data.get("selected_price")
+            unit_price = stored_minor(item, "selling_price") if selected_price is None else to_minor(selected_price)
             quantity = item_data["quantity"]
             line_total = quantity * unit_price
             
@@ -368,81 +750,151 @@ async def update_ongoing_invoice(invoice_id: str, invoice_update: InvoiceUpdate)
                 sku=item["sku"],
                 name=item["name"],
                 quantity=quantity,
-                unit_price=unit_price,
-                line_total=line_total
+                unit_price=from_minor(unit_price),
+                line_total=from_minor(line_total)
             )
             
             invoice_items.append(invoice_item)
             subtotal += line_total
         
-        update_data["items"] = [item.dict() for item in invoice_items]
+        # Stored in minor units, like the rest of the invoice
+        update_data["items"] = [line_document(item.dict()) for item in invoice_items]
         update_data["subtotal"] = subtotal
         update_data["final_total"] = subtotal
+        
+        # Reserve the new quantities, checked against what other invoices hold
+        await reserve_invoice(db, invoice_id, invoice.get("branch_id", "main"), invoice_quantities(update_data["items"]))
     
     update_data["updated_at"] = datetime.utcnow()
     
-    await db.invoices.update_one({"id": invoice_id}, {"$set": update_data})
-    updated_invoice = await db.invoices.find_one({"id": invoice_id})
+    # The invoice may have been completed or deleted meanwhile; what was just reserved goes back
+    if not await repositories.invoices.update(invoice_id, update_data, status="ongoing"):
+        if invoice_update.items is not None:
+            await release_reservations(db, invoice_id)
+        raise HTTPException(status_code=409, detail="Invoice is no longer ongoing")
+    updated_invoice = await repositories.invoices.get(invoice_id)
     return Invoice(**updated_invoice)
 
+async def finish_completion(invoice: dict) -> bool:
+    """Steps of a completion after its stock was taken; safe to repeat until the invoice is completed"""
+    with span("ledger record"):
+        await record_invoice_stock_out(invoice)
+    
+    # Update invoice status, capturing each line's cost at the time of sale
+    with span("line costs"):
+        invoice["items"] = await snapshot_line_costs(db, invoice["items"])
+    if not await repositories.invoices.update(
+        invoice["id"], {"status": "completed", "items": invoice["items"], "updated_at": datetime.utcnow()},
+        status="completing"
+    ):
+        return False
+    with span("invoice counters"):
+        await move_invoice_count(db, invoice.get("branch_id", "main"), "ongoing", "completed")
+    with span("margin rollups"):
+        await record_invoice_margin(db, invoice)
+    with span("sale events"):
+        await publish_sale_events(invoice)
+    await report_cache.invalidate(db, invoice.get("branch_id", "main"), invoice["created_at"])
+    return True
+
 @api_router.put("/invoices/{invoice_id}/complete")
 async def complete_invoice(invoice_id: str):
     """Convert ongoing invoice to completed and update stock"""
-    invoice = await db.invoices.find_one({"id": invoice_id})
+    invoice = await repositories.invoices.get(invoice_id)
     if not invoice:
         raise HTTPException(status_code=404, detail="Invoice not found")
     
     if invoice["status"] != "ongoing":
         raise HTTPException(status_code=400, detail="Invoice is not ongoing")
     
-    # Update stock for all items in the invoice
-    for item_data in invoice["items"]:
-        item = await db.items.find_one({"id": item_data["item_id"]})
-        if item:
-            new_stock = item["stock_quantity"] - item_data["quantity"]
-            await db.items.update_one(
-                {"id": item["id"]},
-                {"$set": {"stock_quantity": new_stock, "updated_at": datetime.utcnow()}}
-            )
-            
-            # Record stock transaction
-            stock_transaction = StockTransaction(
-                item_id=item["id"],
-                branch_id=invoice.get("branch_id", "main"),
-                transaction_type="OUT",
-                quantity=item_data["quantity"],
-                reference_type="INVOICE",
-                reference_id=invoice["invoice_number"]
-            )
-            await db.stock_transactions.insert_one(stock_transaction.dict())
+    # Claim the invoice so a second completion cannot take the stock twice.
+    # Completions stuck in this state are picked up by recover_completions.
+    claim = {"status": "completing", "completing_at": datetime.utcnow()}
+    if not await repositories.invoices.update(invoice_id, claim, status="ongoing"):
+        raise HTTPException(status_code=400, detail="Invoice is not ongoing")
     
-    # Update invoice status
-    await db.invoices.update_one(
-        {"id": invoice_id},
-        {"$set": {"status": "completed", "updated_at": datetime.utcnow()}}
-    )
+    # Take the stock, consuming this invoice's reservations
+    try:
+        with span("commit stock"):
+            await commit_stock(db, invoice_id, invoice_quantities(invoice["items"]))
+    except Exception:
+        await repositories.invoices.update(invoice_id, {"status": "ongoing", "completing_at": None})
+        raise
+    await repositories.invoices.update(invoice_id, {"stock_committed_at": datetime.utcnow()}, status="completing")
+    await finish_completion(invoice)
     
     return {"message": "Invoice completed successfully"}
 
+async def recover_completions(timeout_seconds: float = INVOICE_COMPLETION_TIMEOUT_SECONDS) -> dict:
+    """Settle invoices left in "completing" by a completion that failed or died part way.
+
+    Ones whose stock was taken are completed; the rest go back to ongoing with
+    their reservations taken again where stock allows.
+    """
+    recovered = {"completed": 0, "reopened": 0}
+    while True:
+        # Moving completing_at forward claims the invoice against a concurrent sweep
+        now = datetime.utcnow()
+        invoice = await db.invoices.find_one_and_update(
+            {"status": "completing", "completing_at": {"$not": {"$gt": now - timedelta(seconds=timeout_seconds)}}},
+            {"$set": {"completing_at": now}},
+            projection={"_id": 0}
+        )
+        if invoice is None:
+            return recovered
+        if invoice.get("stock_committed_at"):
+            recovered["completed"] += await finish_completion(invoice)
+            continue
+        
+        # The stock may have been taken in part; reconciliation flags any item left out of step
+        logger.warning("Invoice %s stopped before its stock was committed, reopening it", invoice["id"])
+        if await repositories.invoices.update(invoice["id"], {"status": "ongoing", "completing_at": None}, status="completing"):
+            try:
+                await reserve_invoice(db, invoice["id"], invoice.get("branch_id", "main"), invoice_quantities(invoice["items"]))
+            except HTTPException:
+                pass
+            recovered["reopened"] += 1
+
 @api_router.delete("/invoices/{invoice_id}")
 async def delete_invoice(invoice_id: str):
     """Delete ongoing invoice (only ongoing invoices can be deleted)"""
-    invoice = await db.invoices.find_one({"id": invoice_id})
+    invoice = await repositories.invoices.get(invoice_id)
     if not invoice:
         raise HTTPException(status_code=404, detail="Invoice not found")
     
     if invoice["status"] != "ongoing":
         raise HTTPException(status_code=400, detail="Only ongoing invoices can be deleted")
     
-    result = await db.invoices.delete_one({"id": invoice_id})
+    # Guarded on the status, as a completion may have claimed the invoice since it was read
+    if not await repositories.invoices.delete(invoice_id, status="ongoing"):
+        raise HTTPException(status_code=409, detail="Invoice is no longer ongoing")
+    await increment_invoice_count(db, invoice.get("branch_id", "main"), "ongoing", -1)
+    await release_reservations(db, invoice_id)
     return {"message": "Invoice deleted successfully"}
 
+# Parked Cart Line Routes
+@api_router.post("/invoices/{invoice_id}/lines", response_model=CartUpdate)
+async def add_cart_line(invoice_id: str, line: CartLine):
+    """Add an item to an ongoing invoice, merging with its existing line"""
+    return await add_line(db, item_cache.current(), invoice_id, line.item_id, line.quantity, line.selected_price)
+
+@api_router.patch("/invoices/{invoice_id}/lines/{item_id}", response_model=CartUpdate)
+async def update_cart_line(invoice_id: str, item_id: str, line_update: CartLineUpdate):
+    """Change the quantity or price of one line of an ongoing invoice"""
+    return await set_line_quantity(db, item_cache.current(), invoice_id, item_id, line_update.quantity, line_update.selected_price)
+
+@api_router.delete("/invoices/{invoice_id}/lines/{item_id}", response_model=CartUpdate)
+async def remove_cart_line(invoice_id: str, item_id: str):
+    """Remove one line from an ongoing invoice"""
+    return await remove_line(db, invoice_id, item_id)
+
 # Reports Routes
 @api_router.get("/reports/sales")
 async def get_sales_report(
     start_date: str = Query(..., description="Start date in YYYY-MM-DD format"),
     end_date: str = Query(..., description="End date in YYYY-MM-DD format"),
-    branch_id: str = Query("", description="Filter by branch")
+    branch_id: str = Query("", description="Filter by branch"),
+    response: Response = None
 ):
     """Get sales report for date range"""
     try:
@@ -451,6 +903,13 @@ async def get_sales_report(
     except ValueError:
         raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD")
     
+    cache_key = ReportCache.key("sales", start=start_dt, end=end_dt, branch_id=branch_id)
+    version = await report_cache.sync(db)
+    cached = report_cache.get(cache_key)
+    response.headers["X-Cache"] = "HIT" if cached is not None else "MISS"
+    if cached is not None:
+        return cached
+    
     query = {
         "status": "completed",
         "created_at": {"$gte": start_dt, "$lte": end_dt}
@@ -458,60 +917,106 @@ async def get_sales_report(
     if branch_id:
         query["branch_id"] = branch_id
     
-    invoices = await db.invoices.find(query).to_list(1000)
-    
-    total_sales = len(invoices)
-    total_revenue = sum(invoice.get("final_total", 0) for invoice in invoices)
-    
-    # Group by date
+    # Summed per day inside Mongo in minor units; a day can span the hot and archived invoices
+    with span("aggregate invoices"):
+        days = await aggregate_invoices(report_db, [
+            {"$match": query},
+            {"$group": {
+                "_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}},
+                "count": {"$sum": 1},
+                "revenue": {"$sum": "$final_total"}
+            }}
+        ], start_dt, end_dt)
     daily_sales = {}
-    for invoice in invoices:
-        date_key = invoice["created_at"].strftime("%Y-%m-%d")
-        if date_key not in daily_sales:
-            daily_sales[date_key] = {"count": 0, "revenue": 0}
-        daily_sales[date_key]["count"] += 1
-        daily_sales[date_key]["revenue"] += invoice.get("final_total", 0)
+    for day in sorted(days, key=lambda day: day["_id"]):
+        totals = daily_sales.setdefault(day["_id"], {"count": 0, "revenue": 0})
+        totals["count"] += day["count"]
+        totals["revenue"] += day["revenue"]
     
-    return {
+    total_sales = sum(totals["count"] for totals in daily_sales.values())
+    total_revenue = sum(totals["revenue"] for totals in daily_sales.values())
+    for totals in daily_sales.values():
+        totals["revenue"] = from_minor(totals["revenue"])
+    
+    report = {
         "period": f"{start_date} to {end_date}",
         "total_sales": total_sales,
-        "total_revenue": total_revenue,
-        "average_sale": total_revenue / total_sales if total_sales > 0 else 0,
+        "total_revenue": from_minor(total_revenue),
+        "average_sale": from_minor(total_revenue) / total_sales if total_sales > 0 else 0,
         "daily_breakdown": daily_sales
     }
+    report_cache.put(cache_key, report, "sales", start_dt, end_dt, version, branch_id=branch_id.strip())
+    return report
 
-@api_router.get("/reports/inventory")
-async def get_inventory_report():
-    """Get current inventory status report"""
-    items = await db.items.find().to_list(1000)
+@api_router.get("/reports/margin")
+async def get_margin_report(
+    start_date: str = Query(..., description="Start date in YYYY-MM-DD format"),
+    end_date: str = Query(..., description="End date in YYYY-MM-DD format"),
+    group_by: str = Query("item", description="item, category, brand, branch or day"),
+    branch_id: str = Query("", description="Filter by branch"),
+    response: Response = None
+):
+    """Revenue, cost and margin from the cost recorded on each line at the time of sale"""
+    try:
+        start_dt = datetime.strptime(start_date, "%Y-%m-%d")
+        end_dt = datetime.strptime(end_date, "%Y-%m-%d").replace(hour=23, minute=59, second=59)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD")
+    if group_by not in MARGIN_GROUPS:
+        raise HTTPException(status_code=400, detail=f"group_by must be one of: {', '.join(MARGIN_GROUPS)}")
     
-    total_items = len(items)
-    total_stock_value = sum(item["stock_quantity"] * item["cost_price"] for item in items)
-    low_stock_items = [item for item in items if item["stock_quantity"] <= item["min_stock"]]
+    cache_key = ReportCache.key("margin", start=start_dt, end=end_dt, group_by=group_by, branch_id=branch_id)
+    version = await report_cache.sync(db)
+    cached = report_cache.get(cache_key)
+    response.headers["X-Cache"] = "HIT" if cached is not None else "MISS"
+    if cached is not None:
+        return cached
+    
+    report = await margin_report(report_db, start_dt, end_dt, group_by, branch_id.strip())
+    report["period"] = f"{start_date} to {end_date}"
+    report_cache.put(cache_key, report, "margin", start_dt, end_dt, version, branch_id=branch_id.strip())
+    return report
+
+def inventory_summary(items: List[dict]) -> dict:
+    """Stock value and category breakdown of ``items``, run off the event loop"""
+    total_stock_value = sum(item["stock_quantity"] * stored_minor(item, "cost_price") for item in items)
+    low_stock_items = [item_from_document(item) for item in items if item["stock_quantity"] <= item["min_stock"]]
     
-    # Category wise breakdown
+    # Category wise breakdown, values summed in minor units
     category_breakdown = {}
     for item in items:
         category = item.get("category", "Uncategorized")
+        value = item["stock_quantity"] * stored_minor(item, "cost_price")
         if category not in category_breakdown:
             category_breakdown[category] = {"count": 0, "stock_value": 0, "items": []}
         category_breakdown[category]["count"] += 1
-        category_breakdown[category]["stock_value"] += item["stock_quantity"] * item["cost_price"]
+        category_breakdown[category]["stock_value"] += value
         category_breakdown[category]["items"].append({
             "name": item["name"],
             "sku": item["sku"],
             "stock": item["stock_quantity"],
-            "value": item["stock_quantity"] * item["cost_price"]
+            "value": from_minor(value)
         })
+    for breakdown in category_breakdown.values():
+        breakdown["stock_value"] = from_minor(breakdown["stock_value"])
     
     return {
-        "total_items": total_items,
-        "total_stock_value": total_stock_value,
+        "total_items": len(items),
+        "total_stock_value": from_minor(total_stock_value),
         "low_stock_count": len(low_stock_items),
         "low_stock_items": low_stock_items,
         "category_breakdown": category_breakdown
     }
 
+@api_router.get("/reports/inventory")
+@single_flight.coalesce()
+async def get_inventory_report():
+    """Get current inventory status report"""
+    with span("load items"):
+        items = await report_db.items.find({}, {"_id": 0}).to_list(1000)
+    with span("inventory summary"):
+        return await offload(inventory_summary, items)
+
 @api_router.get("/reports/top-selling")
 async def get_top_selling_report(
     days: int = Query(30, description="Number of days to analyze"),
@@ -527,22 +1032,25 @@ async def get_top_selling_report(
     if branch_id:
         query["branch_id"] = branch_id
     
-    invoices = await db.invoices.find(query).to_list(1000)
-    
-    # Aggregate item sales
+    # Aggregate item sales inside Mongo, merging items sold in both hot and archived invoices
+    sold = await aggregate_invoices(report_db, [
+        {"$match": query},
+        {"$unwind": "$items"},
+        {"$group": {
+            "_id": "$items.item_id",
+            "name": {"$last": "$items.name"},
+            "sku": {"$last": "$items.sku"},
+            "quantity_sold": {"$sum": "$items.quantity"},
+            "revenue": {"$sum": "$items.line_total"}
+        }}
+    ], start_date, None)
     item_sales = {}
-    for invoice in invoices:
-        for item in invoice.get("items", []):
-            item_id = item["item_id"]
-            if item_id not in item_sales:
-                item_sales[item_id] = {
-                    "name": item["name"],
-                    "sku": item["sku"],
-                    "quantity_sold": 0,
-                    "revenue": 0
-                }
-            item_sales[item_id]["quantity_sold"] += item["quantity"]
-            item_sales[item_id]["revenue"] += item["line_total"]
+    for item in sold:
+        sales = item_sales.setdefault(item["_id"], {"name": item["name"], "sku": item["sku"], "quantity_sold": 0, "revenue": 0})
+        sales["quantity_sold"] += item["quantity_sold"]
+        sales["revenue"] += item["revenue"]
+    for sales in item_sales.values():
+        sales["revenue"] = from_minor(sales["revenue"])
     
     # Sort by quantity sold
     top_items = sorted(item_sales.values(), key=lambda x: x["quantity_sold"], reverse=True)
@@ -556,7 +1064,8 @@ async def get_top_selling_report(
 @api_router.get("/reports/branch-comparison")
 async def get_branch_comparison_report(
     start_date: str = Query(..., description="Start date in YYYY-MM-DD format"),
-    end_date: str = Query(..., description="End date in YYYY-MM-DD format")
+    end_date: str = Query(..., description="End date in YYYY-MM-DD format"),
+    response: Response = None
 ):
     """Compare performance across branches"""
     try:
@@ -565,58 +1074,307 @@ async def get_branch_comparison_report(
     except ValueError:
         raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD")
     
+    cache_key = ReportCache.key("branch-comparison", start=start_dt, end=end_dt)
+    version = await report_cache.sync(db)
+    cached = report_cache.get(cache_key)
+    response.headers["X-Cache"] = "HIT" if cached is not None else "MISS"
+    if cached is not None:
+        return cached
+    
     query = {
         "status": "completed",
         "created_at": {"$gte": start_dt, "$lte": end_dt}
     }
     
-    invoices = await db.invoices.find(query).to_list(1000)
-    branches = await db.branches.find().to_list(100)
+    results = await gather_queries({
+        "totals": lambda: aggregate_invoices(report_db, [
+            {"$match": query},
+            {"$group": {
+                "_id": {"$ifNull": ["$branch_id", "main"]},
+                "sales_count": {"$sum": 1},
+                "revenue": {"$sum": "$final_total"},
+                "items_sold": {"$sum": {"$sum": "$items.quantity"}}
+            }}
+        ], start_dt, end_dt),
+        "branches": lambda: report_db.branches.find().to_list(100)
+    })
+    totals, branches = results["totals"], results["branches"]
     
     # Create branch lookup
     branch_lookup = {branch["id"]: branch["name"] for branch in branches}
     branch_lookup["main"] = "Main Branch"  # Default branch
     
-    # Aggregate by branch
+    # Merge the per-collection totals by branch
     branch_stats = {}
-    for invoice in invoices:
-        branch_id = invoice.get("branch_id", "main")
-        branch_name = branch_lookup.get(branch_id, f"Branch {branch_id}")
-        
+    for total in totals:
+        branch_id = total["_id"]
         if branch_id not in branch_stats:
             branch_stats[branch_id] = {
-                "name": branch_name,
+                "name": branch_lookup.get(branch_id, f"Branch {branch_id}"),
                 "sales_count": 0,
                 "revenue": 0,
                 "items_sold": 0
             }
         
-        branch_stats[branch_id]["sales_count"] += 1
-        branch_stats[branch_id]["revenue"] += invoice.get("final_total", 0)
-        branch_stats[branch_id]["items_sold"] += sum(item["quantity"] for item in invoice.get("items", []))
+        branch_stats[branch_id]["sales_count"] += total["sales_count"]
+        branch_stats[branch_id]["revenue"] += total["revenue"]
+        branch_stats[branch_id]["items_sold"] += total["items_sold"]
     
     # Calculate averages
     for stats in branch_stats.values():
+        stats["revenue"] = from_minor(stats["revenue"])
         stats["average_sale"] = stats["revenue"] / stats["sales_count"] if stats["sales_count"] > 0 else 0
     
-    return {
+    report = {
         "period": f"{start_date} to {end_date}",
         "branch_performance": branch_stats
     }
+    report_cache.put(cache_key, report, "branch-comparison", start_dt, end_dt, version)
+    return report
+
+# Background Job Routes
+@api_router.post("/jobs", response_model=Job, status_code=202)
+async def submit_job(job_data: JobCreate, response: Response):
+    """Queue a report or export to run in the background"""
+    job = await job_manager.submit(job_data.kind, job_data.params)
+    response.headers["Location"] = f"/api/jobs/{job.id}"
+    return job
+
+@api_router.get("/jobs/{job_id}", response_model=Job)
+async def get_job(job_id: str):
+    return await job_manager.get(job_id)
+
+@api_router.get("/jobs/{job_id}/download")
+async def download_job_result(job_id: str):
+    job = await job_manager.get(job_id)
+    if job.status != JOB_COMPLETED:
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}")
+    
+    path = job_manager.results_dir / job.result_file
+    if not path.exists():
+        raise HTTPException(status_code=410, detail="Job result has expired")
+    return FileResponse(path, media_type=job.result_media_type, filename=f"{job.kind.replace('/', '-')}-{job.id}{path.suffix}")
+
+# Columnar Exports
+async def run_invoice_export(
+    job: Job,
+    start_date: str,
+    end_date: str,
+    dataset: str = "invoices",
+    format: str = "parquet",
+    branch_id: str = ""
+):
+    try:
+        start_dt = datetime.strptime(start_date, "%Y-%m-%d")
+        end_dt = datetime.strptime(end_date, "%Y-%m-%d").replace(hour=23, minute=59, second=59)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD")
+    
+    path = job_manager.result_path(job, EXPORT_FORMATS[format])
+    await export_invoices(report_db, path, start_dt, end_dt, dataset=dataset, file_format=format, branch_id=branch_id)
+    return path
+
+@api_router.post("/exports/invoices", response_model=Job, status_code=202)
+async def submit_invoice_export(
+    response: Response,
+    start_date: str = Query(..., description="Start date in YYYY-MM-DD format"),
+    end_date: str = Query(..., description="End date in YYYY-MM-DD format"),
+    dataset: str = Query("invoices", description="'invoices' for headers or 'lines' for invoice items"),
+    format: str = Query("parquet", description="'parquet' or 'arrow'"),
+    branch_id: str = Query("", description="Filter by branch")
+):
+    """Export completed invoices for a date range to a Parquet or Arrow file"""
+    if dataset not in EXPORT_DATASETS:
+        raise HTTPException(status_code=400, detail=f"Dataset must be one of: {', '.join(EXPORT_DATASETS)}")
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Format must be one of: {', '.join(EXPORT_FORMATS)}")
+    
+    job = await job_manager.submit("exports/invoices", {
+        "start_date": start_date,
+        "end_date": end_date,
+        "dataset": dataset,
+        "format": format,
+        "branch_id": branch_id
+    })
+    response.headers["Location"] = f"/api/jobs/{job.id}"
+    return job
+
+# Invoice Archival
+async def run_invoice_archival(older_than_days: int = INVOICE_ARCHIVE_AFTER_DAYS):
+    result = await archive_completed_invoices(db, older_than_days)
+    await ensure_search_indexes(db)  # a new yearly partition may have been created
+    if result["archived"]:
+        # Reports computed mid-run may have seen a batch both in invoices and in its partition
+        await report_cache.bump(db)
+    return result
+
+@api_router.post("/admin/archive-invoices", response_model=Job, status_code=202)
+async def submit_invoice_archival(
+    response: Response,
+    older_than_days: int = Query(INVOICE_ARCHIVE_AFTER_DAYS, ge=1, description="Archive completed invoices older than this")
+):
+    """Move old completed invoices out of the hot collection"""
+    job = await job_manager.submit("maintenance/archive-invoices", {"older_than_days": older_than_days})
+    response.headers["Location"] = f"/api/jobs/{job.id}"
+    return job
+
+# Margin Rollups
+async def run_margin_rebuild(start_date: str = "", end_date: str = ""):
+    start_dt = datetime.strptime(start_date, "%Y-%m-%d") if start_date else None
+    end_dt = datetime.strptime(end_date, "%Y-%m-%d").replace(hour=23, minute=59, second=59) if end_date else None
+    result = await rebuild_margin_rollups(db, start_dt, end_dt)
+    await report_cache.bump(db)
+    return result
+
+@api_router.post("/admin/rebuild-margins", response_model=Job, status_code=202)
+async def submit_margin_rebuild(
+    response: Response,
+    start_date: str = Query("", description="First day to rebuild in YYYY-MM-DD format, all history if empty"),
+    end_date: str = Query("", description="Last day to rebuild in YYYY-MM-DD format, up to today if empty")
+):
+    """Recompute the margin rollups from completed and archived invoices"""
+    try:
+        for value in (start_date, end_date):
+            if value:
+                datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD")
+    job = await job_manager.submit("maintenance/rebuild-margins", {"start_date": start_date, "end_date": end_date})
+    response.headers["Location"] = f"/api/jobs/{job.id}"
+    return job
+
+# Money Migration
+async def run_money_migration():
+    return await migrate_money(db)
+
+@api_router.post("/admin/migrate-money", response_model=Job, status_code=202)
+async def submit_money_migration(response: Response):
+    """Convert amounts still stored as floats, e.g. written by an older process, to minor units"""
+    job = await job_manager.submit("maintenance/migrate-money", {})
+    response.headers["Location"] = f"/api/jobs/{job.id}"
+    return job
+
+# One-off Backfills
+async def run_backfills():
+    """Counter seeding and search key migrations; each is skipped once its marker exists"""
+    await ensure_counters_seeded(db)
+    await ensure_search_keys(db)
+    return {"completed": True}
+
+# Demand Forecasting
+async def run_demand_forecast(
+    history_days: int = FORECAST_HISTORY_DAYS,
+    lead_time_days: float = FORECAST_LEAD_TIME_DAYS,
+    service_level: float = FORECAST_SERVICE_LEVEL,
+    apply: bool = FORECAST_APPLY_MIN_STOCK
+):
+    return await forecast_demand(db, history_days, lead_time_days, service_level, apply, event_feed)
+
+@api_router.post("/admin/forecast-demand", response_model=Job, status_code=202)
+async def submit_demand_forecast(
+    response: Response,
+    history_days: int = Query(FORECAST_HISTORY_DAYS, ge=7, le=1095, description="Days of sales history to use"),
+    lead_time_days: float = Query(FORECAST_LEAD_TIME_DAYS, gt=0, description="Days between reordering and receiving stock"),
+    service_level: float = Query(FORECAST_SERVICE_LEVEL, gt=0.5, lt=1, description="Probability of not running out before stock arrives"),
+    apply: bool = Query(FORECAST_APPLY_MIN_STOCK, description="Also overwrite min_stock, not only suggested_min_stock")
+):
+    """Recompute reorder points from sales history and update suggested minimum stock"""
+    job = await job_manager.submit("maintenance/forecast-demand", {
+        "history_days": history_days,
+        "lead_time_days": lead_time_days,
+        "service_level": service_level,
+        "apply": apply
+    })
+    response.headers["Location"] = f"/api/jobs/{job.id}"
+    return job
+
+# Stock Reconciliation
+async def run_stock_reconciliation(
+    adjust: bool = STOCK_RECONCILE_ADJUST,
+    settle_seconds: int = STOCK_RECONCILE_SETTLE_SECONDS,
+    full: bool = False
+):
+    return await reconcile_stock(db, adjust, settle_seconds, full)
+
+@api_router.post("/admin/reconcile-stock", response_model=Job, status_code=202)
+async def submit_stock_reconciliation(
+    response: Response,
+    adjust: bool = Query(STOCK_RECONCILE_ADJUST, description="Write ADJUSTMENT entries so the ledger matches item stock"),
+    settle_seconds: int = Query(STOCK_RECONCILE_SETTLE_SECONDS, ge=0, description="Leave out stock changed this recently"),
+    full: bool = Query(False, description="Compare every item, not only ones changed since the last run")
+):
+    """Check item stock against the ledger entries written since the last run"""
+    job = await job_manager.submit("maintenance/reconcile-stock", {
+        "adjust": adjust,
+        "settle_seconds": settle_seconds,
+        "full": full
+    })
+    response.headers["Location"] = f"/api/jobs/{job.id}"
+    return job
+
+@api_router.get("/reports/stock-discrepancies")
+async def get_stock_discrepancies(limit: int = Query(500, ge=1, le=5000)):
+    """Items whose stock disagreed with the ledger at the last reconciliation, newest first"""
+    return await stock_discrepancies(db, limit)
+
+# Stock Reservation Expiry
+async def run_reservation_sweep():
+    return {"released": await sweep_expired_reservations(db)}
+
+# Interrupted Invoice Completions
+async def run_completion_recovery(timeout_seconds: float = INVOICE_COMPLETION_TIMEOUT_SECONDS):
+    return await recover_completions(timeout_seconds)
+
+job_manager.register("exports/invoices", run_invoice_export)
+job_manager.register("maintenance/archive-invoices", run_invoice_archival)
+if INVOICE_ARCHIVE_INTERVAL_HOURS > 0:
+    job_manager.schedule("maintenance/archive-invoices", INVOICE_ARCHIVE_INTERVAL_HOURS * 3600)
+job_manager.register("maintenance/rebuild-margins", run_margin_rebuild)
+job_manager.register("maintenance/migrate-money", run_money_migration)
+job_manager.register("maintenance/backfills", run_backfills)
+if BACKFILL_CHECK_HOURS > 0:
+    # A schedule that never ran is due at once, so a new tenant or deployment is backfilled shortly after start
+    job_manager.schedule("maintenance/backfills", BACKFILL_CHECK_HOURS * 3600)
+job_manager.register("maintenance/forecast-demand", run_demand_forecast)
+if FORECAST_INTERVAL_HOURS > 0:
+    job_manager.schedule("maintenance/forecast-demand", FORECAST_INTERVAL_HOURS * 3600)
+job_manager.register("maintenance/reconcile-stock", run_stock_reconciliation)
+if STOCK_RECONCILE_INTERVAL_HOURS > 0:
+    job_manager.schedule("maintenance/reconcile-stock", STOCK_RECONCILE_INTERVAL_HOURS * 3600)
+job_manager.register("maintenance/expire-reservations", run_reservation_sweep)
+if RESERVATION_SWEEP_MINUTES > 0:
+    job_manager.schedule("maintenance/expire-reservations", RESERVATION_SWEEP_MINUTES * 60)
+job_manager.register("maintenance/recover-completions", run_completion_recovery)
+if INVOICE_COMPLETION_SWEEP_MINUTES > 0:
+    job_manager.schedule("maintenance/recover-completions", INVOICE_COMPLETION_SWEEP_MINUTES * 60)
+job_manager.register("reports/sales", get_sales_report)
+job_manager.register("reports/inventory", get_inventory_report)
+job_manager.register("reports/top-selling", get_top_selling_report)
+job_manager.register("reports/branch-comparison", get_branch_comparison_report)
+job_manager.register("reports/margin", get_margin_report)
+
+@api_router.get("/reports/cache/stats")
+async def get_report_cache_stats():
+    return report_cache.stats()
 
 # Thermal Receipt Generation
 @api_router.get("/invoices/{invoice_id}/thermal-receipt")
-async def get_thermal_receipt(invoice_id: str):
-    invoice = await db.invoices.find_one({"id": invoice_id})
+async def get_thermal_receipt(invoice_id: str, request: Request, response: Response):
+    cached = await check_invoice_not_modified(request, invoice_id)
+    if cached:
+        return cached
+    
+    invoice = await find_invoice(db, invoice_id)
     if not invoice:
         raise HTTPException(status_code=404, detail="Invoice not found")
+    response.headers.update(invoice_cache_headers(invoice))
     
     invoice_obj = Invoice(**invoice)
     
     # Get branch name
     branch_name = "Main Branch"
     if invoice_obj.branch_id != "main":
-        branch = await db.branches.find_one({"id": invoice_obj.branch_id})
+        branch = await repositories.branches.get(invoice_obj.branch_id)
         if branch:
             branch_name = branch["name"]
     
@@ -654,45 +1412,149 @@ async def get_thermal_receipt(invoice_id: str):
     return {"receipt": "\n".join(receipt_lines)}
 
 # Dashboard and Reports
+async def count_low_stock_items(exact: bool) -> int:
+    """Low stock needs a collection scan, so outside exact mode reuse a recent count"""
+    low_stock_count = low_stock_counts.setdefault(current_tenant_id(), {"count": 0, "counted_at": float("-inf")})
+    if exact or time.monotonic() - low_stock_count["counted_at"] > LOW_STOCK_COUNT_TTL_SECONDS:
+        low_stock_count["count"] = await repositories.items.count_low_stock()
+        low_stock_count["counted_at"] = time.monotonic()
+    return low_stock_count["count"]
+
 @api_router.get("/dashboard/stats")
-async def get_dashboard_stats(branch_id: str = Query("", description="Filter by branch")):
+@single_flight.coalesce()
+async def get_dashboard_stats(
+    branch_id: str = Query("", description="Filter by branch"),
+    exact: bool = Query(False, description="Count documents instead of using estimates and maintained counters")
+):
     # Build query for branch filtering
     branch_query = {}
     if branch_id:
         branch_query["branch_id"] = branch_id
     
-    # Get basic statistics
-    total_items = await db.items.count_documents({})
-    total_invoices = await db.invoices.count_documents({"status": "completed", **branch_query})
-    ongoing_invoices = await db.invoices.count_documents({"status": "ongoing", **branch_query})
-    low_stock_items = await db.items.count_documents({"$expr": {"$lte": ["$stock_quantity", "$min_stock"]}})
-    
     # Today's sales (only completed invoices)
     today_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
-    today_sales = await db.invoices.find({
-        "created_at": {"$gte": today_start},
-        "status": "completed",
-        **branch_query
-    }).to_list(1000)
-    today_revenue = sum(invoice.get("final_total", 0) for invoice in today_sales)
+    
+    # Get basic statistics, all queries are independent
+    queries = {
+        "low_stock_items": lambda: count_low_stock_items(exact),
+        "today_sales": lambda: db.invoices.aggregate([
+            {"$match": {"created_at": {"$gte": today_start}, "status": "completed", **branch_query}},
+            {"$group": {"_id": None, "count": {"$sum": 1}, "revenue": {"$sum": "$final_total"}}}
+        ]).to_list(1)
+    }
+    if exact:
+        queries.update({
+            "total_items": lambda: db.items.count_documents({}),
+            "total_invoices": lambda: db.invoices.count_documents({"status": "completed", **branch_query}),
+            "archived_invoices": lambda: archived_invoice_count(db, branch_id),
+            "ongoing_invoices": lambda: db.invoices.count_documents({"status": "ongoing", **branch_query})
+        })
+    else:
+        queries.update({
+            "total_items": lambda: db.items.estimated_document_count(),
+            "invoice_counts": lambda: invoice_counts(db, branch_id)
+        })
+    stats = await gather_queries(queries, limit=6)
+    
+    if exact:
+        total_invoices = stats["total_invoices"] + stats["archived_invoices"]
+        ongoing_invoices = stats["ongoing_invoices"]
+    else:
+        total_invoices = stats["invoice_counts"]["completed"]
+        ongoing_invoices = stats["invoice_counts"]["ongoing"]
+    today_sales = stats["today_sales"][0] if stats["today_sales"] else {"count": 0, "revenue": 0}
     
     return {
-        "total_items": total_items,
+        "total_items": stats["total_items"],
         "total_invoices": total_invoices,
         "ongoing_invoices": ongoing_invoices,
-        "low_stock_items": low_stock_items,
-        "today_invoices": len(today_sales),
-        "today_revenue": today_revenue
+        "low_stock_items": stats["low_stock_items"],
+        "today_invoices": today_sales["count"],
+        "today_revenue": from_minor(today_sales["revenue"]),
+        "exact": exact
     }
 
-@api_router.get("/items/low-stock")
-async def get_low_stock_items():
-    items = await db.items.find({"$expr": {"$lte": ["$stock_quantity", "$min_stock"]}}).to_list(100)
-    return [Item(**item) for item in items]
+# Change Feed Routes
+@api_router.get("/events")
+async def get_events(
+    after: str = Query("", description="Token returned by the previous call; empty to start from the oldest event"),
+    limit: int = Query(100, ge=1, le=1000),
+    wait: float = Query(0, ge=0, le=60, description="Seconds to wait for new events when there are none")
+):
+    """Invoice, stock and item changes in order, resumable from a token"""
+    events, next_seq = await event_feed.wait(db, parse_token(after), limit, wait)
+    return {"events": events, "next": str(next_seq)}
+
+# Tenant Management Routes
+@api_router.get("/admin/tenants")
+async def get_tenants():
+    return [{"id": tenant.id, "db_name": tenant.db_name} for tenant in await tenants.all()]
+
+@api_router.post("/admin/tenants")
+async def register_tenant(tenant_data: TenantCreate):
+    """Register a tenant and provision its database"""
+    if not TENANT_ID_PATTERN.match(tenant_data.id) or tenant_data.id == tenants.default.id:
+        raise HTTPException(status_code=400, detail="Tenant id must be lowercase letters, digits and dashes")
+    db_name = tenant_data.db_name or f"{database.settings.db_name}_{tenant_data.id}"
+    tenant = await tenants.register(tenant_data.id, db_name)
+    return {"id": tenant.id, "db_name": tenant.db_name}
+
+@api_router.post("/admin/rebuild-counters")
+async def rebuild_counters():
+    """Recount invoices per branch and status to repair the dashboard counters"""
+    return await rebuild_invoice_counters(db)
+
+@api_router.post("/admin/rebuild-reservations")
+async def rebuild_reservations():
+    """Recompute reserved quantities of all items from the active reservations"""
+    return {"items_with_reservations": await rebuild_reserved_quantities(db)}
+
+@api_router.get("/metrics/ledger")
+async def get_ledger_metrics():
+    """Stock transactions waiting to be written and written so far by this process"""
+    return stock_ledger.stats()
+
+@api_router.get("/metrics/coalescing")
+async def get_coalescing_metrics():
+    """How many reads were served by another request's in-flight query"""
+    return single_flight.stats()
+
+@api_router.get("/admin/profiles")
+async def get_profiles():
+    """Recently sampled request profiles of this process, newest first"""
+    return profiler.stats()
+
+@api_router.get("/admin/profiles/flamegraph")
+async def download_flamegraph(
+    kind: str = Query("wall", pattern="^(wall|cpu)$", description="wall: running and waiting samples, cpu: running only"),
+    route: str = Query("", description="Only profiles of this route, e.g. /api/invoices")
+):
+    """Collapsed stacks of the sampled profiles, for flamegraph.pl or speedscope"""
+    return Response(
+        content=profiler.flamegraph(kind, route),
+        media_type="text/plain",
+        headers={"Content-Disposition": f'attachment; filename="profile-{kind}.folded"'}
+    )
+
+@api_router.get("/admin/profiles/{profile_id}")
+async def get_profile(profile_id: str):
+    """Spans and hottest stacks of one sampled request"""
+    profile = profiler.find(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return profile.details(profiler.interval_ms)
+
+@api_router.get("/metrics/admission")
+async def get_admission_metrics():
+    """Requests in flight, queued and turned away per route class"""
+    return admission.stats()
 
 # Include the router in the main app
 app.include_router(api_router)
 
+# Innermost, so requests turned away still get CORS headers
+app.add_middleware(AdmissionMiddleware, controller=admission)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -701,13 +1563,21 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.add_middleware(TenantMiddleware, registry=tenants)
+
+app.add_middleware(
+    NegotiatedEncodingMiddleware,
+    minimum_size=int(os.environ.get("COMPRESSION_MIN_SIZE", "1024")),
+    gzip_level=int(os.environ.get("COMPRESSION_GZIP_LEVEL", "6")),
+    brotli_quality=int(os.environ.get("COMPRESSION_BROTLI_QUALITY", "4")),
+)
+
+# Outermost, so profiles include compression and the admission queue
+app.add_middleware(ProfilingMiddleware, profiler=profiler)
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
-logger = logging.getLogger(__name__)
-
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+logger = logging.getLogger(__name__)
\ No newline at end of file
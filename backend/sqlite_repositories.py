@@ -0,0 +1,394 @@
+"""Embedded SQLite storage for items, invoices, branches and stock transactions.
+
+Implements the repositories of repositories.py on one local database file:
+
+* documents are stored whole as JSON, with the fields that are filtered or
+  sorted on copied into indexed columns; datetimes round-trip as
+  ``{"$date": ...}`` the way Mongo extended JSON writes them
+* the database runs in WAL mode with ``synchronous=NORMAL``, so readers never
+  wait for a writer and a commit does not fsync. A power cut can lose the last
+  few commits but never corrupts the file
+* every statement is fixed SQL text with parameters, so the connection's
+  statement cache prepares each one once
+* one connection is used from a single worker thread, so queries never block
+  the event loop. Read-modify-write updates run in one ``BEGIN IMMEDIATE``
+  transaction, which also serialises them against other processes
+
+The server does not run on this backend yet (see repositories.py); it is
+exercised by ``benchmarks/repositories.py`` and the repository tests.
+
+Settings are read from the environment:
+
+==========================  ==============================================
+SQLITE_PATH                 database file (backend/inventory.sqlite3)
+SQLITE_SYNCHRONOUS          NORMAL, or FULL to fsync every commit
+SQLITE_CACHE_SIZE_KIB       page cache per connection (65536)
+SQLITE_MMAP_SIZE_MIB        file size read through mmap (256)
+==========================  ==============================================
+"""
+import asyncio
+import json
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    id TEXT PRIMARY KEY,
+    sku TEXT NOT NULL,
+    search TEXT NOT NULL,
+    stock_quantity INTEGER NOT NULL,
+    min_stock INTEGER NOT NULL,
+    document TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS items_sku ON items (sku);
+CREATE INDEX IF NOT EXISTS items_stock_margin ON items (stock_quantity - min_stock);
+
+CREATE TABLE IF NOT EXISTS invoices (
+    id TEXT PRIMARY KEY,
+    invoice_number TEXT NOT NULL,
+    branch_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    document TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS invoices_created ON invoices (created_at DESC);
+CREATE INDEX IF NOT EXISTS invoices_status_created ON invoices (status, created_at DESC);
+CREATE INDEX IF NOT EXISTS invoices_branch_created ON invoices (branch_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS invoices_branch_status_created ON invoices (branch_id, status, created_at DESC);
+CREATE INDEX IF NOT EXISTS invoices_number ON invoices (invoice_number);
+
+CREATE TABLE IF NOT EXISTS branches (
+    id TEXT PRIMARY KEY,
+    document TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS stock_transactions (
+    id TEXT PRIMARY KEY,
+    item_id TEXT NOT NULL,
+    transaction_type TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    document TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS stock_transactions_item_created ON stock_transactions (item_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS stock_transactions_type_created ON stock_transactions (transaction_type, created_at);
+"""
+
+ITEM_SEARCH_FIELDS = ("sku", "name", "category", "sub_category", "brand")
+
+# Separates the searchable fields so a search term cannot match across two of them
+SEARCH_SEPARATOR = "\x1f"
+
+
+def _timestamp(value: Optional[datetime]) -> str:
+    return value.isoformat(timespec="microseconds") if value else ""
+
+
+def _default(value):
+    if isinstance(value, datetime):
+        return {"$date": _timestamp(value)}
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def _object_hook(value: dict):
+    if len(value) == 1 and "$date" in value:
+        return datetime.fromisoformat(value["$date"])
+    return value
+
+
+def encode(document: dict) -> str:
+    return json.dumps({key: value for key, value in document.items() if key != "_id"},
+                      default=_default, separators=(",", ":"))
+
+
+def decode(text: str) -> dict:
+    return json.loads(text, object_hook=_object_hook)
+
+
+def _like(term: str) -> str:
+    escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+class SqliteStore:
+    """One connection, used only from the store's worker thread"""
+
+    def __init__(self, path: Path, synchronous: str = "NORMAL", cache_size_kib: int = 65536, mmap_size_mib: int = 256):
+        self.path = Path(path)
+        self.synchronous = synchronous
+        self.cache_size_kib = cache_size_kib
+        self.mmap_size_mib = mmap_size_mib
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._connection: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # Autocommit; writes open their own transactions
+            connection = sqlite3.connect(self.path, isolation_level=None, cached_statements=256)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(f"PRAGMA synchronous={self.synchronous}")
+            connection.execute("PRAGMA busy_timeout=5000")
+            connection.execute("PRAGMA temp_store=MEMORY")
+            connection.execute(f"PRAGMA cache_size=-{self.cache_size_kib}")
+            connection.execute(f"PRAGMA mmap_size={self.mmap_size_mib * 1024 * 1024}")
+            connection.executescript(SCHEMA)
+            self._connection = connection
+        return self._connection
+
+    async def run(self, function: Callable[[sqlite3.Connection], Any]):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, lambda: function(self._connect()))
+
+    async def fetch(self, sql: str, parameters: tuple = ()) -> List[dict]:
+        rows = await self.run(lambda connection: connection.execute(sql, parameters).fetchall())
+        return [decode(row[0]) for row in rows]
+
+    async def scalar(self, sql: str, parameters: tuple = ()):
+        return await self.run(lambda connection: connection.execute(sql, parameters).fetchone()[0])
+
+    async def close(self):
+        def close(connection: sqlite3.Connection):
+            connection.execute("PRAGMA optimize")
+            connection.close()
+            self._connection = None
+
+        if self._connection is not None:
+            await self.run(close)
+        self._executor.shutdown()
+
+
+class _Table:
+    """Whole documents in ``document`` plus the ``columns`` extracted from them"""
+
+    def __init__(self, store: SqliteStore, name: str, columns: Dict[str, Callable[[dict], Any]]):
+        self.store = store
+        self.columns = columns
+        names = ", ".join([*columns, "document"])
+        self.insert_sql = f"INSERT INTO {name} ({names}) VALUES ({', '.join('?' * (len(columns) + 1))})"
+        self.insert_ignore_sql = self.insert_sql.replace("INSERT", "INSERT OR IGNORE", 1)
+        self.update_sql = f"UPDATE {name} SET {', '.join(f'{column} = ?' for column in columns)}, document = ? WHERE id = ?"
+        self.get_sql = f"SELECT document FROM {name} WHERE id = ?"
+        self.delete_sql = f"DELETE FROM {name} WHERE id = ?"
+
+    def row(self, document: dict) -> tuple:
+        return (*(column(document) for column in self.columns.values()), encode(document))
+
+    async def get(self, key: str) -> Optional[dict]:
+        found = await self.store.fetch(self.get_sql, (key,))
+        return found[0] if found else None
+
+    async def insert(self, document: dict):
+        row = self.row(document)
+        await self.store.run(lambda connection: connection.execute(self.insert_sql, row))
+
+    async def insert_many(self, documents: List[dict], ignore_existing: bool = False) -> int:
+        rows = [self.row(document) for document in documents]
+        sql = self.insert_ignore_sql if ignore_existing else self.insert_sql
+
+        def insert(connection: sqlite3.Connection) -> int:
+            before = connection.total_changes
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.executemany(sql, rows)
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+            return connection.total_changes - before
+
+        return await self.store.run(insert)
+
+    async def update(self, key: str, fields: dict, guard: Optional[Callable[[dict], bool]] = None) -> bool:
+        def update(connection: sqlite3.Connection) -> bool:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                found = connection.execute(self.get_sql, (key,)).fetchone()
+                current = decode(found[0]) if found else None
+                if current is None or (guard and not guard(current)):
+                    connection.execute("ROLLBACK")
+                    return False
+                connection.execute(self.update_sql, (*self.row({**current, **fields}), key))
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+            return True
+
+        return await self.store.run(update)
+
+    async def delete(self, key: str) -> bool:
+        deleted = await self.store.run(lambda connection: connection.execute(self.delete_sql, (key,)).rowcount)
+        return deleted > 0
+
+
+class SqliteItems:
+    LIST_SQL = "SELECT document FROM items LIMIT ?"
+    SEARCH_SQL = "SELECT document FROM items WHERE search LIKE ? ESCAPE '\\' LIMIT ?"
+    BY_SKU_SQL = "SELECT document FROM items WHERE sku = ? LIMIT ?"
+    LOW_STOCK_SQL = "SELECT document FROM items WHERE stock_quantity - min_stock <= 0 LIMIT ?"
+    COUNT_LOW_STOCK_SQL = "SELECT count(*) FROM items WHERE stock_quantity - min_stock <= 0"
+    COUNT_SQL = "SELECT count(*) FROM items"
+
+    def __init__(self, store: SqliteStore):
+        self.store = store
+        self.table = _Table(store, "items", {
+            "id": lambda item: item["id"],
+            "sku": lambda item: item.get("sku", ""),
+            "search": lambda item: SEARCH_SEPARATOR.join(str(item.get(field) or "") for field in ITEM_SEARCH_FIELDS),
+            "stock_quantity": lambda item: item.get("stock_quantity", 0),
+            "min_stock": lambda item: item.get("min_stock", 0),
+        })
+
+    async def get(self, item_id: str, fields: Optional[Iterable[str]] = None) -> Optional[dict]:
+        item = await self.table.get(item_id)
+        if item is None or fields is None:
+            return item
+        return {field: item[field] for field in fields if field in item}
+
+    async def list(self, search: str = "", limit: int = 100) -> List[dict]:
+        if search:
+            return await self.store.fetch(self.SEARCH_SQL, (_like(search), limit))
+        return await self.store.fetch(self.LIST_SQL, (limit,))
+
+    async def by_sku(self, sku: str, limit: int = 100) -> List[dict]:
+        return await self.store.fetch(self.BY_SKU_SQL, (sku, limit))
+
+    async def low_stock(self, limit: int = 100) -> List[dict]:
+        return await self.store.fetch(self.LOW_STOCK_SQL, (limit,))
+
+    async def count_low_stock(self) -> int:
+        return await self.store.scalar(self.COUNT_LOW_STOCK_SQL)
+
+    async def insert(self, item: dict):
+        await self.table.insert(item)
+
+    async def update(self, item_id: str, fields: dict) -> bool:
+        return await self.table.update(item_id, fields)
+
+    async def delete(self, item_id: str) -> bool:
+        return await self.table.delete(item_id)
+
+    async def count(self) -> int:
+        return await self.store.scalar(self.COUNT_SQL)
+
+
+class SqliteInvoices:
+    # One statement per combination of filters, so each can use its own index
+    LIST_SQL = {
+        (False, False): "SELECT document FROM invoices ORDER BY created_at DESC LIMIT ?",
+        (True, False): "SELECT document FROM invoices WHERE status = ? ORDER BY created_at DESC LIMIT ?",
+        (False, True): "SELECT document FROM invoices WHERE branch_id = ? ORDER BY created_at DESC LIMIT ?",
+        (True, True): "SELECT document FROM invoices WHERE status = ? AND branch_id = ? ORDER BY created_at DESC LIMIT ?",
+    }
+    COUNT_SQL = {
+        (False, False): "SELECT count(*) FROM invoices",
+        (True, False): "SELECT count(*) FROM invoices WHERE status = ?",
+        (False, True): "SELECT count(*) FROM invoices WHERE branch_id = ?",
+        (True, True): "SELECT count(*) FROM invoices WHERE status = ? AND branch_id = ?",
+    }
+    DELETE_WITH_STATUS_SQL = "DELETE FROM invoices WHERE id = ? AND status = ?"
+
+    def __init__(self, store: SqliteStore):
+        self.store = store
+        self.table = _Table(store, "invoices", {
+            "id": lambda invoice: invoice["id"],
+            "invoice_number": lambda invoice: invoice.get("invoice_number", ""),
+            "branch_id": lambda invoice: invoice.get("branch_id", "main"),
+            "status": lambda invoice: invoice.get("status", ""),
+            "created_at": lambda invoice: _timestamp(invoice.get("created_at")),
+        })
+
+    async def get(self, invoice_id: str) -> Optional[dict]:
+        return await self.table.get(invoice_id)
+
+    async def list(self, status: str = "", branch_id: str = "", limit: int = 50) -> List[dict]:
+        filters = tuple(value for value in (status, branch_id) if value)
+        return await self.store.fetch(self.LIST_SQL[bool(status), bool(branch_id)], (*filters, limit))
+
+    async def insert(self, invoice: dict):
+        await self.table.insert(invoice)
+
+    async def update(self, invoice_id: str, fields: dict, status: Optional[str] = None) -> bool:
+        guard = (lambda invoice: invoice.get("status") == status) if status else None
+        return await self.table.update(invoice_id, fields, guard)
+
+    async def delete(self, invoice_id: str, status: Optional[str] = None) -> bool:
+        if not status:
+            return await self.table.delete(invoice_id)
+        deleted = await self.store.run(
+            lambda connection: connection.execute(self.DELETE_WITH_STATUS_SQL, (invoice_id, status)).rowcount
+        )
+        return deleted > 0
+
+    async def count(self, status: str = "", branch_id: str = "") -> int:
+        filters = tuple(value for value in (status, branch_id) if value)
+        return await self.store.scalar(self.COUNT_SQL[bool(status), bool(branch_id)], filters)
+
+
+class SqliteBranches:
+    LIST_SQL = "SELECT document FROM branches LIMIT ?"
+
+    def __init__(self, store: SqliteStore):
+        self.store = store
+        self.table = _Table(store, "branches", {"id": lambda branch: branch["id"]})
+
+    async def get(self, branch_id: str) -> Optional[dict]:
+        return await self.table.get(branch_id)
+
+    async def list(self, limit: int = 100) -> List[dict]:
+        return await self.store.fetch(self.LIST_SQL, (limit,))
+
+    async def insert(self, branch: dict):
+        await self.table.insert(branch)
+
+    async def update(self, branch_id: str, fields: dict) -> bool:
+        return await self.table.update(branch_id, fields)
+
+    async def delete(self, branch_id: str) -> bool:
+        return await self.table.delete(branch_id)
+
+
+class SqliteStockTransactions:
+    FOR_ITEM_SQL = "SELECT document FROM stock_transactions WHERE item_id = ? ORDER BY created_at DESC LIMIT ?"
+
+    def __init__(self, store: SqliteStore):
+        self.store = store
+        self.table = _Table(store, "stock_transactions", {
+            "id": lambda transaction: transaction["id"],
+            "item_id": lambda transaction: transaction["item_id"],
+            "transaction_type": lambda transaction: transaction["transaction_type"],
+            "created_at": lambda transaction: _timestamp(transaction.get("created_at")),
+        })
+
+    async def insert_many(self, transactions: List[dict]) -> int:
+        """Insert transactions, skipping ones already stored (a replayed ledger segment)"""
+        if not transactions:
+            return 0
+        return await self.table.insert_many(transactions, ignore_existing=True)
+
+    async def for_item(self, item_id: str, limit: int = 100) -> List[dict]:
+        return await self.store.fetch(self.FOR_ITEM_SQL, (item_id, limit))
+
+
+class SqliteRepositories:
+    def __init__(self, path: Path, **settings):
+        self.store = SqliteStore(path, **settings)
+        self.items = SqliteItems(self.store)
+        self.invoices = SqliteInvoices(self.store)
+        self.branches = SqliteBranches(self.store)
+        self.stock_transactions = SqliteStockTransactions(self.store)
+
+    async def close(self):
+        await self.store.close()
+
+
+def sqlite_settings_from_env() -> Dict[str, Any]:
+    return {
+        "path": Path(os.environ.get("SQLITE_PATH", Path(__file__).parent / "inventory.sqlite3")),
+        "synchronous": os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL").upper(),
+        "cache_size_kib": int(os.environ.get("SQLITE_CACHE_SIZE_KIB", "65536")),
+        "mmap_size_mib": int(os.environ.get("SQLITE_MMAP_SIZE_MIB", "256")),
+    }
@@ -0,0 +1,175 @@
+"""Multi-tenant routing.
+
+Each tenant (shop chain) lives in its own Mongo database; all tenants share
+the process-wide Motor client. Requests name their tenant with the
+``X-Tenant-ID`` header or, when ``TENANT_BASE_DOMAIN`` is set, with the
+subdomain (``acme.pos.example.com`` -> ``acme``). Requests naming no tenant
+are served from the default tenant, the ``DB_NAME`` database, which also
+holds the ``tenants`` registry.
+
+The first time a process serves a tenant it runs the registered provisioners
+(index creation) for that tenant's database. Each tenant is
+provisioned under its own lock, so a slow one does not hold up the others.
+
+A database belongs to one tenant only: registration refuses the default
+database, MongoDB's own databases and databases already mapped to another
+tenant.
+"""
+import asyncio
+import re
+import time
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from fastapi import HTTPException
+from pymongo.errors import DuplicateKeyError
+from starlette.datastructures import Headers
+from starlette.responses import JSONResponse
+
+from database import DEFAULT_TENANT_ID, Database, Tenant, current_tenant, current_tenant_id
+
+TENANT_ID_PATTERN = re.compile(r"^[a-z0-9][a-z0-9-]{0,62}$")
+TENANT_HEADER = "x-tenant-id"
+DB_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,63}$")
+RESERVED_DB_NAMES = {"admin", "config", "local"}
+
+
+class TenantRegistry:
+    def __init__(self, database: Database, refresh_seconds: float = 60, base_domain: str = ""):
+        self.database = database
+        self.refresh_seconds = refresh_seconds
+        self.base_domain = base_domain.lower().lstrip(".")
+        self.default = Tenant(DEFAULT_TENANT_ID, database.settings.db_name)
+        self._tenants: Dict[str, Tenant] = {}
+        self._loaded_at = float("-inf")
+        self._provisioners: List[Callable[[], Awaitable]] = []
+        self._provisioned = set()
+        self._provision_locks: Dict[str, asyncio.Lock] = {}
+
+    @property
+    def collection(self):
+        return self.database.get(db_name=self.default.db_name).tenants
+
+    def on_provision(self, provisioner: Callable[[], Awaitable]):
+        """Register a coroutine run once per process for each tenant, inside its scope"""
+        self._provisioners.append(provisioner)
+        return provisioner
+
+    async def refresh(self):
+        tenants = await self.collection.find({}, {"_id": 0, "id": 1, "db_name": 1}).to_list(None)
+        self._tenants = {tenant["id"]: Tenant(tenant["id"], tenant["db_name"]) for tenant in tenants}
+        self._loaded_at = time.monotonic()
+
+    async def lookup(self, tenant_id: str) -> Optional[Tenant]:
+        if tenant_id == DEFAULT_TENANT_ID:
+            return self.default
+        # Unknown ids trigger at most one reload every few seconds
+        stale_after = self.refresh_seconds if tenant_id in self._tenants else min(self.refresh_seconds, 5)
+        if time.monotonic() - self._loaded_at > stale_after:
+            await self.refresh()
+        return self._tenants.get(tenant_id)
+
+    async def all(self) -> List[Tenant]:
+        await self.refresh()
+        return [self.default, *self._tenants.values()]
+
+    async def register(self, tenant_id: str, db_name: str) -> Tenant:
+        """Map ``tenant_id`` to ``db_name`` and provision it; registering the same mapping again is a no-op"""
+        if not DB_NAME_PATTERN.match(db_name) or db_name.lower() in RESERVED_DB_NAMES:
+            raise HTTPException(status_code=400, detail="Database name must be letters, digits, '_' and '-', at most 63")
+        if db_name.lower() == self.default.db_name.lower():
+            raise HTTPException(status_code=409, detail="Database is the default tenant's")
+        await self.refresh()
+        existing = self._tenants.get(tenant_id)
+        if existing and existing.db_name != db_name:
+            raise HTTPException(status_code=409, detail=f"Tenant '{tenant_id}' already uses database '{existing.db_name}'")
+        # Database names are case-insensitively unique within a MongoDB server
+        owner = next((tenant for tenant in self._tenants.values()
+                      if tenant.db_name.lower() == db_name.lower() and tenant.id != tenant_id), None)
+        if owner:
+            raise HTTPException(status_code=409, detail=f"Database '{db_name}' belongs to tenant '{owner.id}'")
+        try:
+            await self.collection.update_one(
+                {"id": tenant_id}, {"$setOnInsert": {"id": tenant_id, "db_name": db_name}}, upsert=True
+            )
+        except DuplicateKeyError:
+            # Registered for another tenant meanwhile (db_name is unique, see ensure_indexes)
+            raise HTTPException(status_code=409, detail=f"Database '{db_name}' belongs to another tenant")
+        await self.refresh()
+        tenant = self._tenants[tenant_id]
+        async with self.scope(tenant):
+            pass
+        return tenant
+
+    def tenant_id_from(self, headers: Headers) -> Optional[str]:
+        tenant_id = headers.get(TENANT_HEADER)
+        if tenant_id:
+            return tenant_id.strip().lower()
+        if self.base_domain:
+            host = headers.get("host", "").split(":")[0].lower()
+            if host.endswith(f".{self.base_domain}"):
+                return host[:-len(self.base_domain) - 1].split(".")[-1]
+        return None
+
+    @asynccontextmanager
+    async def scope(self, tenant: Tenant):
+        """Serve the enclosed block from ``tenant``'s database"""
+        token = current_tenant.set(tenant)
+        try:
+            if tenant.id not in self._provisioned:
+                async with self._provision_locks.setdefault(tenant.id, asyncio.Lock()):
+                    if tenant.id not in self._provisioned:
+                        for provisioner in self._provisioners:
+                            await provisioner()
+                        self._provisioned.add(tenant.id)
+            yield tenant
+        finally:
+            current_tenant.reset(token)
+
+
+class TenantMiddleware:
+    def __init__(self, app, registry: TenantRegistry):
+        self.app = app
+        self.registry = registry
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        tenant_id = self.registry.tenant_id_from(Headers(scope=scope))
+        if tenant_id is None:
+            tenant = self.registry.default
+        else:
+            tenant = await self.registry.lookup(tenant_id)
+            if tenant is None:
+                response = JSONResponse({"detail": f"Unknown tenant '{tenant_id}'"}, status_code=404)
+                await response(scope, receive, send)
+                return
+
+        async with self.registry.scope(tenant):
+            await self.app(scope, receive, send)
+
+
+class TenantLocal:
+    """One lazily created instance per tenant, used through attribute access.
+
+    Wraps in-process caches so each tenant gets its own, e.g.
+    ``report_cache = TenantLocal(ReportCache)`` and then ``report_cache.get(key)``.
+    """
+
+    def __init__(self, factory: Callable[[], object]):
+        self._factory = factory
+        self._instances: Dict[str, object] = {}
+
+    def current(self):
+        tenant_id = current_tenant_id()
+        instance = self._instances.get(tenant_id)
+        if instance is None:
+            instance = self._instances[tenant_id] = self._factory()
+        return instance
+
+    def __getattr__(self, name: str):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.current(), name)
@@ -1,10 +1,19 @@
-import React, { useState, useEffect } from "react";
+import React, { useState, useEffect, useRef } from "react";
 import "./App.css";
 import axios from "axios";
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
 
+const CATALOGUE_STORAGE_KEY = "billing-catalogue";
+const CATALOGUE_REFRESH_MS = 30000;
+
+// Catalogue payloads hold one array per field; turn them back into item objects
+const rowsFromColumns = ({ fields, columns }) =>
+  columns[fields[0]].map((_, row) =>
+    Object.fromEntries(fields.map(field => [field, columns[field][row]]))
+  );
+
 // Components
 const Dashboard = ({ onNavigate, ongoingInvoices, setOngoingInvoices }) => {
   const [stats, setStats] = useState({});
@@ -234,9 +243,12 @@ const CreateInvoice = ({ onNavigate, ongoingInvoices, setOngoingInvoices }) => {
   });
   const [paymentMode, setPaymentMode] = useState("Cash");
   const [isCreating, setIsCreating] = useState(false);
+  const catalogue = useRef(null);
 
   useEffect(() => {
-    fetchItems();
+    syncCatalogue();
+    const timer = setInterval(syncCatalogue, CATALOGUE_REFRESH_MS);
+    return () => clearInterval(timer);
   }, []);
 
   useEffect(() => {
@@ -263,12 +275,48 @@ const CreateInvoice = ({ onNavigate, ongoingInvoices, setOngoingInvoices }) => {
     }
   }, [searchTerm, items]);
 
-  const fetchItems = async () => {
+  // Keep the full catalogue locally: one snapshot, then deltas since the held version
+  const syncCatalogue = async () => {
     try {
-      const response = await axios.get(`${API}/items`);
-      setItems(response.data);
+      const restored = !catalogue.current;
+      if (restored) {
+        const stored = localStorage.getItem(CATALOGUE_STORAGE_KEY);
+        catalogue.current = stored ? JSON.parse(stored) : null;
+      }
+
+      if (catalogue.current) {
+        const response = await axios.get(`${API}/catalogue/delta`, {
+          params: { since: catalogue.current.version }
+        });
+        const changed = rowsFromColumns(response.data);
+        changed.forEach(item => { catalogue.current.items[item.id] = item; });
+        response.data.removed.forEach(id => { delete catalogue.current.items[id]; });
+        catalogue.current.version = response.data.version;
+        if (!restored && changed.length === 0 && response.data.removed.length === 0) {
+          return;
+        }
+      } else {
+        const response = await axios.get(`${API}/catalogue/snapshot`);
+        catalogue.current = {
+          version: response.data.version,
+          items: Object.fromEntries(rowsFromColumns(response.data).map(item => [item.id, item]))
+        };
+      }
+
+      setItems(Object.values(catalogue.current.items));
+      try {
+        localStorage.setItem(CATALOGUE_STORAGE_KEY, JSON.stringify(catalogue.current));
+      } catch (error) {
+        console.warn("Catalogue too large to keep in local storage:", error);
+      }
     } catch (error) {
-      console.error("Error fetching items:", error);
+      if (error.response && error.response.status === 410) {
+        // Our version is older than the server keeps deletions for, start over
+        catalogue.current = null;
+        localStorage.removeItem(CATALOGUE_STORAGE_KEY);
+        return syncCatalogue();
+      }
+      console.error("Error syncing catalogue:", error);
     }
   };
 
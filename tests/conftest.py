@@ -0,0 +1,61 @@
+"""Shared fixtures for the backend unit tests.
+
+Modules under backend/ import each other as siblings, the way uvicorn runs
+them, so the directory is put on ``sys.path``. Async tests run on asyncio
+through the anyio pytest plugin.
+
+``db`` is a scratch database: on the MongoDB at ``TEST_MONGO_URL`` when that
+is set (dropped afterwards), otherwise an in-memory mongomock database.
+``app_db`` points the server module at it, for tests that call handlers.
+"""
+import os
+import sys
+import uuid
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+async def db():
+    if os.environ.get("TEST_MONGO_URL"):
+        from motor.motor_asyncio import AsyncIOMotorClient
+
+        client = AsyncIOMotorClient(os.environ["TEST_MONGO_URL"])
+        database = client[f"inventory_test_{uuid.uuid4().hex[:8]}"]
+        try:
+            yield database
+        finally:
+            await client.drop_database(database.name)
+            client.close()
+        return
+
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    yield mongomock_motor.AsyncMongoMockClient()[f"inventory_test_{uuid.uuid4().hex[:8]}"]
+
+
+@pytest.fixture
+async def app_db(db, tmp_path, monkeypatch):
+    """The server's database handle pointed at ``db``, with a stock ledger of its own"""
+    import server
+    from database import DatabaseSettings
+    from ledger import StockLedger
+
+    monkeypatch.setattr(server.database, "settings", DatabaseSettings(mongo_url="", db_name=db.name))
+    monkeypatch.setattr(server.database, "client", db.client)
+    monkeypatch.setattr(server.database, "_databases", {})
+    # Per-tenant caches outlive a test; every test gets a new database under the same tenant
+    monkeypatch.setattr(server, "low_stock_counts", {})
+    await db.stock_transactions.create_index("id", unique=True)
+    ledger = StockLedger(server.repositories.stock_transactions, tmp_path, fsync=False)
+    await ledger.start()
+    monkeypatch.setattr(server, "stock_ledger", ledger)
+    yield db
+    await ledger.stop()
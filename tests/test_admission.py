@@ -0,0 +1,128 @@
+import asyncio
+
+import pytest
+
+from admission import AdmissionController, AdmissionMiddleware, RouteClass
+
+pytestmark = pytest.mark.anyio
+
+
+def route_class(concurrency=1, queue_size=2, max_wait=1.0, sheddable=False, name="lookup"):
+    return RouteClass(name, concurrency, queue_size, max_wait, sheddable)
+
+
+async def queued(route: RouteClass) -> asyncio.Task:
+    task = asyncio.create_task(route.acquire())
+    await asyncio.sleep(0)
+    return task
+
+
+async def test_slots_are_handed_to_waiters_in_arrival_order():
+    route = route_class(queue_size=2)
+    assert await route.acquire()
+    first, second = await queued(route), await queued(route)
+
+    route.release()
+    assert await first
+
+    assert not second.done()
+    assert (route.in_flight, route.waiting) == (1, 1)
+    route.release()
+    assert await second
+    route.release()
+    assert route.in_flight == 0
+
+
+async def test_full_queue_is_rejected_at_once():
+    route = route_class(queue_size=1)
+    await route.acquire()
+    waiting = await queued(route)
+
+    assert not await route.acquire()
+    assert route.rejected == 1
+    waiting.cancel()
+
+
+async def test_waiting_too_long_is_rejected_and_leaves_the_queue():
+    route = route_class(max_wait=0.01)
+    await route.acquire()
+
+    assert not await route.acquire()
+    assert (route.waiting, route.rejected, route.in_flight) == (0, 1, 1)
+
+
+async def test_cancelled_waiter_leaves_the_queue():
+    route = route_class()
+    await route.acquire()
+    waiting = await queued(route)
+
+    waiting.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiting
+
+    assert route.waiting == 0
+    route.release()
+    assert route.in_flight == 0
+
+
+async def test_slot_handed_to_a_cancelled_waiter_passes_on():
+    route = route_class()
+    await route.acquire()
+    first, second = await queued(route), await queued(route)
+
+    # Cancelled, then handed the slot before it gets to run
+    first.cancel()
+    route.release()
+    with pytest.raises(asyncio.CancelledError):
+        await first
+
+    assert await second
+    assert (route.in_flight, route.waiting) == (1, 0)
+    route.release()
+    assert route.in_flight == 0
+
+
+async def test_sheddable_classes_are_turned_away_while_checkout_queues():
+    checkout = route_class(name="checkout")
+    report = route_class(name="report", sheddable=True)
+    controller = AdmissionController({"checkout": checkout, "lookup": route_class(), "report": report})
+    await checkout.acquire()
+    waiting = await queued(checkout)
+
+    assert controller.under_pressure()
+    assert not await controller.admit(report)
+    assert report.shed == 1
+    waiting.cancel()
+
+
+def test_requests_are_classified_by_route():
+    controller = AdmissionController({name: route_class(name=name) for name in ("checkout", "lookup", "report")})
+
+    assert controller.classify("POST", "/api/invoices/x/complete").name == "checkout"
+    assert controller.classify("GET", "/api/invoices/x").name == "lookup"
+    assert controller.classify("GET", "/api/reports/sales").name == "report"
+    assert controller.classify("GET", "/api/health/live") is None
+    assert controller.classify("GET", "/api/admin/profiles/flamegraph") is None
+
+
+async def test_diagnostics_are_served_while_the_loop_lags():
+    report = route_class(name="report", sheddable=True)
+    controller = AdmissionController({"checkout": route_class(), "lookup": route_class(), "report": report})
+    controller.loop_lag = 1.0
+    statuses = []
+
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"{}"})
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            statuses.append(message["status"])
+
+    middleware = AdmissionMiddleware(app, controller)
+    for path in ("/api/admin/profiles", "/api/admin/profiles/flamegraph", "/api/admin/profiles/abc",
+                 "/api/metrics/admission", "/api/reports/sales"):
+        await middleware({"type": "http", "method": "GET", "path": path, "headers": []}, None, send)
+
+    assert statuses == [200, 200, 200, 200, 503]
+    assert report.shed == 1
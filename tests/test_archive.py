@@ -0,0 +1,102 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import archive
+from archive import aggregate_invoices, archive_completed_invoices, archived_invoice_count, find_invoice
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture(autouse=True)
+def fresh_partitions():
+    # Known partitions are cached per tenant; every test gets a new database
+    archive._known_partitions.clear()
+
+
+def invoice(number: int, days_ago: int, branch_id: str = "main", status: str = "completed") -> dict:
+    return {
+        "id": f"invoice-{number}", "invoice_number": f"MAI-{number:06d}", "branch_id": branch_id,
+        "items": [{"item_id": "item-1", "quantity": 2}], "final_total": 1000, "status": status,
+        "created_at": datetime.utcnow() - timedelta(days=days_ago),
+    }
+
+
+class CountingDeletes:
+    """Records the hot plus archived invoice count whenever archival deletes a batch"""
+
+    def __init__(self, db):
+        self._db = db
+        self.counts = []
+
+    def __getattr__(self, name):
+        collection = getattr(self._db, name)
+        if name != "invoices":
+            return collection
+        watcher = self
+
+        class Invoices:
+            def __getattr__(self, attribute):
+                return getattr(collection, attribute)
+
+            async def delete_many(self, query):
+                hot = await collection.count_documents({})
+                watcher.counts.append(hot + await archived_invoice_count(watcher._db))
+                return await collection.delete_many(query)
+        return Invoices()
+
+    def __getitem__(self, name):
+        return self._db[name]
+
+
+async def test_old_completed_invoices_move_to_yearly_partitions(db):
+    await db.invoices.insert_many([invoice(1, 400), invoice(2, 200), invoice(3, 1), invoice(4, 400, status="ongoing")])
+
+    result = await archive_completed_invoices(db, older_than_days=30)
+
+    assert result["archived"] == 2
+    assert sorted(invoice["id"] for invoice in await db.invoices.find().to_list(None)) == ["invoice-3", "invoice-4"]
+    archived = await find_invoice(db, "invoice-1")
+    assert archived["invoice_number"] == "MAI-000001"
+    assert await archived_invoice_count(db, "main") == 2
+
+
+async def test_invoices_stay_counted_while_batches_move(db):
+    await db.invoices.insert_many([invoice(number, 100 + number, branch_id="north") for number in range(5)])
+    watched = CountingDeletes(db)
+
+    await archive_completed_invoices(watched, older_than_days=30, batch_size=2)
+
+    assert watched.counts and min(watched.counts) >= 5
+    assert await db.invoices.count_documents({}) == 0
+    assert await archived_invoice_count(db, "north") == 5
+
+
+async def test_rerun_after_interruption_does_not_double_count(db):
+    await db.invoices.insert_many([invoice(1, 100), invoice(2, 100)])
+    await archive_completed_invoices(db, older_than_days=30)
+    # An interrupted run left a copy of an archived invoice behind
+    await db.invoices.insert_one(invoice(1, 100))
+
+    await archive_completed_invoices(db, older_than_days=30)
+
+    assert await archived_invoice_count(db, "main") == 2
+    assert await db.invoices.count_documents({}) == 0
+
+
+async def test_other_workers_see_a_new_partition_at_once(db, monkeypatch):
+    await db.invoices.insert_many([invoice(1, 400), invoice(2, 400)])
+    revenue = [{"$match": {"status": "completed"}}, {"$group": {"_id": None, "total": {"$sum": "$final_total"}}}]
+    since = datetime.utcnow() - timedelta(days=800)
+
+    # A worker that loaded the partition list before anything was archived
+    reader = {}
+    monkeypatch.setattr(archive, "_known_partitions", reader)
+    before = await aggregate_invoices(db, revenue, since, datetime.utcnow())
+    # Another worker archives into a partition the first has never seen
+    monkeypatch.setattr(archive, "_known_partitions", {})
+    await archive_completed_invoices(db, older_than_days=30)
+    monkeypatch.setattr(archive, "_known_partitions", reader)
+    after = await aggregate_invoices(db, revenue, since, datetime.utcnow())
+
+    assert sum(row["total"] for row in before) == sum(row["total"] for row in after) == 2000
@@ -0,0 +1,95 @@
+import pytest
+
+from cart import ItemCache, add_line, remove_line, set_line_quantity
+from money import MONEY_SCALE
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture(autouse=True)
+def returned_by_id(monkeypatch):
+    """mongomock re-reads a ReturnDocument.AFTER result by the filter unless ``_id`` is projected,
+    so guarded updates would find nothing; MongoDB returns the updated document"""
+    collection = pytest.importorskip("mongomock.collection").Collection
+    find_and_modify = collection._find_and_modify
+
+    def by_id(self, query, projection=None, *args, **kwargs):
+        if isinstance(projection, dict) and projection.get("_id") == 0:
+            document = find_and_modify(self, query, {**projection, "_id": 1}, *args, **kwargs)
+            if document:
+                document.pop("_id", None)
+            return document
+        return find_and_modify(self, query, projection, *args, **kwargs)
+
+    monkeypatch.setattr(collection, "_find_and_modify", by_id)
+
+
+def line(item_id, quantity, unit_price):
+    return {"item_id": item_id, "sku": item_id.upper(), "name": item_id, "quantity": quantity,
+            "unit_price": unit_price, "line_total": quantity * unit_price}
+
+
+async def make_cart(db, lines):
+    total = sum(cart_line["line_total"] for cart_line in lines)
+    await db.invoices.insert_one({"id": "inv", "branch_id": "main", "status": "ongoing", "items": lines,
+                                  "subtotal": total, "final_total": total, "money_scale": MONEY_SCALE})
+    for item_id in {cart_line["item_id"] for cart_line in lines}:
+        quantity = sum(cart_line["quantity"] for cart_line in lines if cart_line["item_id"] == item_id)
+        await db.stock_reservations.insert_one({"invoice_id": "inv", "item_id": item_id, "branch_id": "main",
+                                                "quantity": quantity, "expires_at": None})
+
+
+async def test_removing_an_item_removes_all_of_its_lines(db):
+    await db.items.insert_many([
+        {"id": "pen", "name": "Pen", "stock_quantity": 10, "reserved_quantity": 5},
+        {"id": "ink", "name": "Ink", "stock_quantity": 10, "reserved_quantity": 1},
+    ])
+    await make_cart(db, [line("pen", 2, 100), line("ink", 1, 300), line("pen", 3, 90)])
+
+    result = await remove_line(db, "inv", "pen")
+
+    invoice = await db.invoices.find_one({"id": "inv"})
+    assert [cart_line["item_id"] for cart_line in invoice["items"]] == ["ink"]
+    assert invoice["subtotal"] == invoice["final_total"] == 300
+    assert result["final_total"] == 3
+    assert (await db.items.find_one({"id": "pen"}))["reserved_quantity"] == 0
+    assert await db.stock_reservations.count_documents({"item_id": "pen"}) == 0
+
+
+async def test_editing_a_duplicated_item_keeps_the_other_lines_reserved(db):
+    await db.items.insert_one({"id": "pen", "name": "Pen", "stock_quantity": 10, "reserved_quantity": 5})
+    await make_cart(db, [line("pen", 2, 100), line("pen", 3, 90)])
+
+    await set_line_quantity(db, ItemCache(), "inv", "pen", 4)
+
+    invoice = await db.invoices.find_one({"id": "inv"})
+    assert [cart_line["quantity"] for cart_line in invoice["items"]] == [4, 3]
+    assert invoice["final_total"] == 400 + 270
+    assert (await db.stock_reservations.find_one({"item_id": "pen"}))["quantity"] == 7
+    assert (await db.items.find_one({"id": "pen"}))["reserved_quantity"] == 7
+
+
+async def test_adding_an_item_merges_into_its_line(db):
+    await db.items.insert_one({"id": "pen", "sku": "PEN", "name": "Pen", "selling_price": 100,
+                               "money_scale": MONEY_SCALE, "stock_quantity": 10, "reserved_quantity": 0})
+    await make_cart(db, [])
+
+    await add_line(db, ItemCache(), "inv", "pen", 2)
+    await add_line(db, ItemCache(), "inv", "pen", 1)
+
+    invoice = await db.invoices.find_one({"id": "inv"})
+    assert [(cart_line["quantity"], cart_line["line_total"]) for cart_line in invoice["items"]] == [(3, 300)]
+    assert (await db.items.find_one({"id": "pen"}))["reserved_quantity"] == 3
+
+
+async def test_growing_a_line_beyond_available_stock_is_refused(db):
+    await db.items.insert_one({"id": "pen", "name": "Pen", "stock_quantity": 4, "reserved_quantity": 3})
+    await make_cart(db, [line("pen", 1, 100)])
+
+    with pytest.raises(Exception) as raised:
+        await set_line_quantity(db, ItemCache(), "inv", "pen", 5)
+
+    assert raised.value.status_code == 400
+    invoice = await db.invoices.find_one({"id": "inv"})
+    assert invoice["items"][0]["quantity"] == 1
+    assert (await db.items.find_one({"id": "pen"}))["reserved_quantity"] == 3
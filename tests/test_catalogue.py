@@ -0,0 +1,75 @@
+import gzip
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+from catalogue import CatalogueSnapshots, build_delta, to_version
+
+pytestmark = pytest.mark.anyio
+
+
+def item(item_id: str, updated_at: datetime) -> dict:
+    return {
+        "id": item_id, "sku": item_id.upper(), "name": item_id, "category": "", "sub_category": "", "brand": "",
+        "selling_price": 1000, "stock_quantity": 5, "money_scale": 100, "updated_at": updated_at,
+    }
+
+
+def decode(body: bytes) -> dict:
+    return json.loads(gzip.decompress(body))
+
+
+async def test_delta_picks_up_a_change_committed_after_the_previous_poll(db):
+    now = datetime.utcnow()
+    await db.items.insert_one(item("a", now - timedelta(seconds=1)))
+    first = decode(await build_delta(db, 0))
+    assert first["columns"]["id"] == ["a"]
+
+    # Stamped before the first poll, committed after it
+    await db.items.insert_one(item("b", now - timedelta(seconds=2)))
+    second = decode(await build_delta(db, first["version"]))
+
+    assert "b" in second["columns"]["id"]
+
+
+async def test_delta_version_never_goes_backwards(db):
+    await db.items.insert_one(item("a", datetime.utcnow() - timedelta(days=1)))
+    since = to_version(datetime.utcnow() - timedelta(hours=1))
+
+    delta = decode(await build_delta(db, since))
+
+    assert delta["version"] == since
+    assert delta["columns"]["id"] == []
+
+
+async def test_snapshot_tells_tills_to_resume_before_recent_changes(db):
+    changed_at = datetime.utcnow()
+    await db.items.insert_one(item("a", changed_at))
+
+    version, body = await CatalogueSnapshots().get(db)
+
+    assert version == to_version(changed_at)
+    assert decode(body)["version"] < version
+
+
+@pytest.mark.parametrize("accept_encoding, gzipped", [
+    ("gzip, br", True),
+    ("gzip;q=0.5", True),
+    ("*", True),
+    ("gzip;q=0, br", False),
+    ("br, *;q=0", False),
+    ("", False),
+])
+def test_stored_gzip_is_only_sent_to_clients_that_accept_it(accept_encoding, gzipped):
+    from starlette.requests import Request
+
+    from server import catalogue_response
+
+    body = json.dumps({"version": 1}).encode()
+    request = Request({"type": "http", "headers": [(b"accept-encoding", accept_encoding.encode())]})
+
+    response = catalogue_response(request, gzip.compress(body), {})
+
+    assert (response.headers.get("content-encoding") == "gzip") == gzipped
+    assert (gzip.decompress(response.body) if gzipped else response.body) == body
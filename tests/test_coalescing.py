@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+
+from coalescing import SingleFlight
+from database import Tenant, current_tenant
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_concurrent_identical_calls_share_one_execution():
+    flight = SingleFlight()
+    calls = []
+    release = asyncio.Event()
+
+    @flight.coalesce()
+    async def dashboard(branch_id: str = ""):
+        calls.append(branch_id)
+        await release.wait()
+        return {"branch": branch_id}
+
+    waiting = [asyncio.create_task(dashboard(branch_id="main")) for _ in range(3)]
+    other = asyncio.create_task(dashboard(branch_id="north"))
+    await asyncio.sleep(0)
+    release.set()
+
+    assert [await task for task in waiting] == [{"branch": "main"}] * 3
+    assert await other == {"branch": "north"}
+    assert sorted(calls) == ["main", "north"]
+    assert flight.stats()["dashboard"] == {"requests": 4, "executions": 2, "collapsed": 2, "in_flight": 0}
+
+
+async def test_results_are_not_kept_after_the_call_finishes():
+    flight = SingleFlight()
+    calls = []
+
+    @flight.coalesce("count")
+    async def count():
+        calls.append(1)
+        return len(calls)
+
+    assert await count() == 1
+    assert await count() == 2
+
+
+async def test_tenants_do_not_share_results():
+    flight = SingleFlight()
+    release = asyncio.Event()
+
+    @flight.coalesce()
+    async def tenant_name():
+        await release.wait()
+        return current_tenant.get().id
+
+    async def as_tenant(tenant_id):
+        current_tenant.set(Tenant(tenant_id, f"inventory_{tenant_id}"))
+        return await tenant_name()
+
+    first, second = asyncio.create_task(as_tenant("a")), asyncio.create_task(as_tenant("b"))
+    await asyncio.sleep(0)
+    release.set()
+
+    assert (await first, await second) == ("a", "b")
+
+
+async def test_a_cancelled_caller_does_not_cancel_the_shared_call():
+    flight = SingleFlight()
+    release = asyncio.Event()
+
+    @flight.coalesce()
+    async def report():
+        await release.wait()
+        return "done"
+
+    leaver, stayer = asyncio.create_task(report()), asyncio.create_task(report())
+    await asyncio.sleep(0)
+    leaver.cancel()
+    await asyncio.sleep(0)
+    release.set()
+
+    assert await stayer == "done"
@@ -0,0 +1,90 @@
+import json
+
+import pytest
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from compression import NegotiatedEncodingMiddleware, choose_encoding
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("gzip, deflate, br", "br"),
+    ("gzip", "gzip"),
+    ("br;q=0, gzip", "gzip"),
+    ("br;q=0.5, gzip;q=0.8", "gzip"),
+    ("gzip;q=0, br;q=0", None),
+    ("*", "br"),
+    ("*;q=0, gzip", "gzip"),
+    ("identity", None),
+    ("", None),
+])
+def test_choose_encoding(header, expected):
+    assert choose_encoding(header) == expected
+
+
+@pytest.fixture
+def client():
+    async def listing(request):
+        return JSONResponse({"items": [{"sku": f"SKU{index:04d}", "name": "Brake pad"} for index in range(100)]})
+
+    app = Starlette(routes=[Route("/items", listing)])
+    app.add_middleware(NegotiatedEncodingMiddleware, minimum_size=100)
+    return TestClient(app)
+
+
+def test_large_json_is_compressed(client):
+    response = client.get("/items", headers={"Accept-Encoding": "gzip"})
+
+    assert response.headers["content-encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["vary"]
+    assert len(response.json()["items"]) == 100
+
+
+def test_refused_encodings_are_not_used(client):
+    response = client.get("/items", headers={"Accept-Encoding": "br;q=0, gzip;q=0"})
+
+    assert "content-encoding" not in response.headers
+
+
+def test_msgpack_only_when_acceptable(client):
+    import msgpack
+
+    packed = client.get("/items", headers={"Accept": "application/msgpack", "Accept-Encoding": "identity"})
+    refused = client.get("/items", headers={"Accept": "application/msgpack;q=0, application/json"})
+
+    assert packed.headers["content-type"] == "application/msgpack"
+    assert len(msgpack.unpackb(packed.content)["items"]) == 100
+    assert refused.headers["content-type"] == "application/json"
+
+
+
+def test_file_downloads_are_streamed_untouched(tmp_path):
+    from starlette.responses import FileResponse, StreamingResponse
+
+    result = tmp_path / "result.json"
+    result.write_text(json.dumps([{"sku": f"SKU{index:06d}", "name": "Brake pad"} for index in range(40000)]))
+
+    async def download(request):
+        return FileResponse(result, media_type="application/json", filename="result.json")
+
+    async def stream(request):
+        async def chunks():
+            yield b'{"items": ['
+            yield b"1, 2, 3"
+            yield b"]}"
+        return StreamingResponse(chunks(), media_type="application/json")
+
+    app = Starlette(routes=[Route("/download", download), Route("/stream", stream)])
+    app.add_middleware(NegotiatedEncodingMiddleware, minimum_size=1)
+    client = TestClient(app)
+    downloaded = client.get("/download", headers={"Accept-Encoding": "gzip", "Accept": "application/msgpack"})
+    streamed = client.get("/stream", headers={"Accept-Encoding": "gzip"})
+
+    assert "content-encoding" not in downloaded.headers
+    assert downloaded.headers["content-type"] == "application/json"
+    assert int(downloaded.headers["content-length"]) == result.stat().st_size
+    assert downloaded.content == result.read_bytes()
+    assert "content-encoding" not in streamed.headers
+    assert streamed.json() == {"items": [1, 2, 3]}
@@ -0,0 +1,81 @@
+from datetime import datetime
+
+import pytest
+
+from counters import (
+    ensure_counters_seeded, increment_invoice_count, invoice_counts, move_invoice_count, rebuild_invoice_counters,
+)
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_seeding_counts_invoices_written_before_it(db):
+    await db.invoices.insert_many([
+        {"id": "1", "branch_id": "main", "status": "completed"},
+        {"id": "2", "branch_id": "main", "status": "ongoing"},
+    ])
+    # A sale made after startup but before the backfill job ran
+    await db.invoices.insert_one({"id": "3", "branch_id": "main", "status": "completed"})
+    await increment_invoice_count(db, "main", "completed")
+
+    await ensure_counters_seeded(db)
+
+    assert await invoice_counts(db, "main") == {"completed": 2, "ongoing": 1}
+
+
+async def test_seeding_runs_once(db):
+    await ensure_counters_seeded(db)
+    await increment_invoice_count(db, "main", "ongoing")
+    await move_invoice_count(db, "main", "ongoing", "completed")
+
+    await ensure_counters_seeded(db)
+
+    assert await invoice_counts(db) == {"completed": 1, "ongoing": 0}
+
+
+async def test_rebuild_counts_hot_and_archived_invoices(db):
+    await db.invoices.insert_many([
+        {"id": "1", "branch_id": "main", "status": "completed"},
+        {"id": "2", "branch_id": "north", "status": "ongoing"},
+    ])
+    await db.invoice_archive_totals.insert_one({"branch_id": "main", "invoice_count": 4})
+    await increment_invoice_count(db, "main", "completed", 10)  # drifted
+
+    await rebuild_invoice_counters(db)
+
+    assert await invoice_counts(db, "main") == {"completed": 5, "ongoing": 0}
+    assert await invoice_counts(db) == {"completed": 5, "ongoing": 1}
+
+
+async def test_rebuild_keeps_completing_invoices_counted_as_ongoing(db):
+    await db.invoices.insert_many([
+        {"id": "1", "branch_id": "main", "status": "completing"},
+        {"id": "2", "branch_id": "main", "status": "ongoing"},
+    ])
+    await db.invoice_counters.insert_one({"branch_id": "main", "completed": 0, "ongoing": 0, "completing": 1})
+
+    totals = await rebuild_invoice_counters(db)
+
+    assert totals == {"main": {"completed": 0, "ongoing": 2}}
+    counter = await db.invoice_counters.find_one({"branch_id": "main"}, {"_id": 0})
+    assert counter == {"branch_id": "main", "completed": 0, "ongoing": 2}
+
+
+async def test_dashboard_counters_agree_with_exact_counts(app_db):
+    from server import get_dashboard_stats
+
+    await app_db.items.insert_many([
+        {"id": "pen", "stock_quantity": 2, "min_stock": 5},
+        {"id": "ink", "stock_quantity": 9, "min_stock": 5},
+    ])
+    await app_db.invoices.insert_many([
+        {"id": "1", "branch_id": "main", "status": "completed", "final_total": 250, "created_at": datetime.utcnow()},
+        {"id": "2", "branch_id": "main", "status": "ongoing", "final_total": 100, "created_at": datetime.utcnow()},
+    ])
+    await rebuild_invoice_counters(app_db)
+
+    estimated = await get_dashboard_stats(branch_id="main", exact=False)
+    exact = await get_dashboard_stats(branch_id="main", exact=True)
+
+    assert {**estimated, "exact": True} == exact
+    assert (exact["total_invoices"], exact["ongoing_invoices"], exact["low_stock_items"]) == (1, 1, 1)
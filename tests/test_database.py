@@ -0,0 +1,39 @@
+import pytest
+from pymongo.read_preferences import Primary
+
+from database import DatabaseSettings
+
+
+@pytest.fixture
+def env(monkeypatch):
+    monkeypatch.setenv("MONGO_URL", "mongodb://localhost:27017")
+    monkeypatch.setenv("DB_NAME", "inventory")
+    for name in ("MONGO_SOCKET_TIMEOUT_MS", "MONGO_REPORT_READ_PREFERENCE", "MONGO_INVOICE_WRITE_CONCERN"):
+        monkeypatch.delenv(name, raising=False)
+    return monkeypatch
+
+
+def test_socket_timeout_defaults_to_thirty_seconds(env):
+    assert DatabaseSettings.from_env().client_options()["socketTimeoutMS"] == 30000
+
+
+def test_zero_socket_timeout_disables_it(env):
+    env.setenv("MONGO_SOCKET_TIMEOUT_MS", "0")
+
+    assert DatabaseSettings.from_env().client_options()["socketTimeoutMS"] is None
+
+
+def test_unknown_read_preference_is_rejected(env):
+    env.setenv("MONGO_REPORT_READ_PREFERENCE", "fastest")
+
+    with pytest.raises(ValueError):
+        DatabaseSettings.from_env()
+
+
+def test_primary_reports_and_numeric_write_concern(env):
+    env.setenv("MONGO_REPORT_READ_PREFERENCE", "primary")
+    env.setenv("MONGO_INVOICE_WRITE_CONCERN", "2")
+    settings = DatabaseSettings.from_env()
+
+    assert isinstance(settings.read_preference(), Primary)
+    assert settings.write_concern().document == {"w": 2, "j": True}
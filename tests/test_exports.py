@@ -0,0 +1,77 @@
+from datetime import datetime
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+import archive
+from exports import dataset_schema, export_invoices
+from money import invoice_document
+
+pytestmark = pytest.mark.anyio
+
+MAY = (datetime(2024, 5, 1), datetime(2024, 5, 31, 23, 59, 59))
+
+
+@pytest.fixture(autouse=True)
+def fresh_partitions():
+    # Known partitions are cached per tenant; every test gets a new database
+    archive._known_partitions.clear()
+
+
+def sale(invoice_id, day, *lines, status="completed", branch_id="main"):
+    items = [{"item_id": item_id, "sku": item_id.upper(), "name": item_id, "quantity": quantity,
+              "unit_price": unit_price, "line_total": quantity * unit_price}
+             for item_id, quantity, unit_price in lines]
+    total = sum(item["line_total"] for item in items)
+    return {"id": invoice_id, "invoice_number": f"INV-{invoice_id}", "branch_id": branch_id,
+            "customer_name": "", "customer_phone": "", "payment_mode": "cash", "status": status,
+            "items": items, "subtotal": total, "final_total": total,
+            "created_at": datetime(2024, 5, day), "updated_at": datetime(2024, 5, day)}
+
+
+async def test_invoices_are_exported_in_chunks_in_currency_units(db, tmp_path):
+    await db.invoices.insert_many([
+        invoice_document(sale("1", 2, ("pen", 2, 1.25))),
+        sale("2", 3, ("ink", 1, 4.5)),  # not migrated to minor units yet
+        invoice_document(sale("3", 4, ("pen", 1, 1.25), ("ink", 1, 4.5))),
+        invoice_document(sale("4", 5, ("pen", 1, 1.25), status="ongoing")),
+        invoice_document(sale("5", 6, ("pen", 1, 1.25), branch_id="north")),
+    ])
+    path = tmp_path / "invoices.parquet"
+
+    rows = await export_invoices(db, path, *MAY, chunk_size=2, branch_id="main")
+    table = pq.read_table(path)
+
+    assert rows == 3
+    assert table.schema.equals(dataset_schema("invoices"))
+    assert table.column("id").to_pylist() == ["1", "2", "3"]
+    assert table.column("final_total").to_pylist() == [2.5, 4.5, 5.75]
+    assert table.column("line_count").to_pylist() == [1, 1, 2]
+
+
+async def test_lines_carry_their_invoice_keys(db, tmp_path):
+    await db.invoices.insert_many([
+        invoice_document(sale("1", 2, ("pen", 2, 1.25), ("ink", 1, 4.5))),
+        invoice_document(sale("2", 3, ("pen", 1, 1.25))),
+    ])
+    await db.invoices.update_one({"id": "2"}, {"$set": {"items.0.cost_price": 60}})
+    path = tmp_path / "lines.arrow"
+
+    rows = await export_invoices(db, path, *MAY, dataset="lines", file_format="arrow")
+    with pa.ipc.open_file(str(path)) as reader:
+        table = reader.read_all()
+
+    assert rows == 3
+    assert table.select(["invoice_id", "line_no", "item_id", "line_total", "cost_price"]).to_pylist() == [
+        {"invoice_id": "1", "line_no": 1, "item_id": "pen", "line_total": 2.5, "cost_price": None},
+        {"invoice_id": "1", "line_no": 2, "item_id": "ink", "line_total": 4.5, "cost_price": None},
+        {"invoice_id": "2", "line_no": 1, "item_id": "pen", "line_total": 1.25, "cost_price": 0.6},
+    ]
+
+
+async def test_unknown_datasets_and_formats_are_refused(db, tmp_path):
+    with pytest.raises(ValueError):
+        await export_invoices(db, tmp_path / "out", *MAY, dataset="items")
+    with pytest.raises(ValueError):
+        await export_invoices(db, tmp_path / "out", *MAY, file_format="csv")
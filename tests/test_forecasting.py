@@ -0,0 +1,72 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from forecasting import current_forecast_run, forecast_demand
+from outbox import EventFeed
+
+pytestmark = pytest.mark.anyio
+
+LONG_AGO = datetime(2020, 1, 1)
+
+
+async def sales(db, item_id="pen", days=30, quantity=2):
+    today = datetime.utcnow().replace(hour=12, minute=0, second=0, microsecond=0)
+    await db.stock_transactions.insert_many([
+        {"item_id": item_id, "branch_id": "main", "transaction_type": "OUT", "quantity": quantity,
+         "created_at": today - timedelta(days=day)}
+        for day in range(days)
+    ])
+
+
+async def test_forecast_only_suggests_min_stock_by_default(db):
+    await db.items.insert_one({"id": "pen", "min_stock": 5, "updated_at": LONG_AGO})
+    await sales(db)
+
+    result = await forecast_demand(db, history_days=30, lead_time_days=7)
+
+    pen = await db.items.find_one({"id": "pen"})
+    assert result["updated_items"] == 1 and not result["applied_to_min_stock"]
+    assert pen["suggested_min_stock"] == 14
+    assert pen["min_stock"] == 5
+
+
+async def test_applied_forecast_is_stamped_and_announced(db):
+    await db.items.insert_one({"id": "pen", "min_stock": 5, "updated_at": LONG_AGO})
+    await sales(db)
+    before = datetime.utcnow()
+
+    await forecast_demand(db, history_days=30, lead_time_days=7, apply=True, events=EventFeed())
+
+    pen = await db.items.find_one({"id": "pen"})
+    announced = await db.events.find_one({"type": "item.updated", "entity_id": "pen"})
+    assert pen["min_stock"] == pen["suggested_min_stock"] == 14
+    assert pen["updated_at"] >= before
+    assert announced["data"] == {"suggested_min_stock": 14, "min_stock": 14}
+
+
+async def test_a_new_run_replaces_the_previous_forecasts(db):
+    await db.items.insert_one({"id": "pen"})
+    await sales(db)
+
+    await forecast_demand(db, history_days=30)
+    await forecast_demand(db, history_days=30)
+
+    run_id = await current_forecast_run(db)
+    assert await db.demand_forecasts.distinct("run_id") == [run_id]
+
+
+async def test_an_older_run_finishing_late_keeps_the_newer_forecasts(db):
+    await db.items.insert_one({"id": "pen"})
+    await sales(db)
+    await forecast_demand(db, history_days=30)
+    newer = await current_forecast_run(db)
+    # A run that started before the one above and is only now finishing
+    await db.forecast_runs.update_one({"_id": "demand"}, {"$set": {"started": datetime.utcnow() + timedelta(hours=1)}})
+    await db.demand_forecasts.update_many({}, {"$set": {"created_at": datetime.utcnow() + timedelta(hours=1)}})
+
+    result = await forecast_demand(db, history_days=30)
+
+    assert result["superseded"]
+    assert await current_forecast_run(db) == newer
+    assert await db.demand_forecasts.distinct("run_id") == [newer]
@@ -0,0 +1,50 @@
+from datetime import datetime
+
+from fastapi import Request
+
+from http_caching import cache_headers, content_etag, is_not_modified, version_etag
+
+UPDATED = datetime(2024, 5, 1, 12, 30, 15, 123456)
+
+
+def request(**headers):
+    return Request({"type": "http", "headers": [(name.replace("_", "-").encode(), value.encode())
+                                                for name, value in headers.items()]})
+
+
+def test_version_etag_changes_with_updated_at():
+    etag = version_etag({"id": "pen", "updated_at": UPDATED})
+
+    assert etag == '"pen-2024-05-01T12:30:15.123"'
+    assert version_etag({"id": "pen", "updated_at": datetime(2024, 5, 1, 12, 30, 16)}) != etag
+
+
+def test_content_etag_ignores_key_order():
+    assert content_etag({"a": 1, "b": [1, 2]}) == content_etag({"b": [1, 2], "a": 1})
+    assert content_etag({"a": 1}) != content_etag({"a": 2})
+
+
+def test_if_none_match_accepts_lists_weak_tags_and_wildcards():
+    etag = '"pen-1"'
+
+    assert is_not_modified(request(if_none_match=f'"other", W/{etag}'), etag)
+    assert is_not_modified(request(if_none_match="*"), etag)
+    assert not is_not_modified(request(if_none_match='"other"'), etag)
+
+
+def test_if_none_match_takes_precedence_over_if_modified_since():
+    headers = {"if_none_match": '"other"', "if_modified_since": "Wed, 01 May 2024 13:00:00 GMT"}
+
+    assert not is_not_modified(request(**headers), '"pen-1"', UPDATED)
+
+
+def test_if_modified_since_compares_whole_seconds():
+    assert is_not_modified(request(if_modified_since="Wed, 01 May 2024 12:30:15 GMT"), '"pen-1"', UPDATED)
+    assert not is_not_modified(request(if_modified_since="Wed, 01 May 2024 12:30:14 GMT"), '"pen-1"', UPDATED)
+    assert not is_not_modified(request(if_modified_since="yesterday"), '"pen-1"', UPDATED)
+
+
+def test_cache_headers_include_last_modified_as_http_date():
+    headers = cache_headers('"pen-1"', UPDATED)
+
+    assert headers == {"ETag": '"pen-1"', "Cache-Control": "no-cache", "Last-Modified": "Wed, 01 May 2024 12:30:15 GMT"}
@@ -0,0 +1,89 @@
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+
+import server
+from invoice_search import search_keys
+from money import MONEY_SCALE
+from reservations import reserve_invoice
+from server import InvoiceUpdate, complete_invoice, recover_completions, update_ongoing_invoice
+
+pytestmark = pytest.mark.anyio
+
+LONG_AGO = datetime(2020, 1, 1)
+
+
+async def make_invoice(db, status="ongoing", **fields):
+    await db.items.insert_one({"id": "pen", "sku": "PEN", "name": "Pen", "stock_quantity": 5, "reserved_quantity": 0,
+                               "selling_price": 100, "cost_price": 60, "money_scale": MONEY_SCALE})
+    await db.invoices.insert_one({
+        "id": "inv", "invoice_number": "MAI-000001", "branch_id": "main", "status": status,
+        "customer_name": "", "customer_phone": "", "payment_mode": "cash", **search_keys("", ""),
+        "items": [{"item_id": "pen", "sku": "PEN", "name": "Pen", "quantity": 2, "unit_price": 100, "line_total": 200}],
+        "subtotal": 200, "final_total": 200, "money_scale": MONEY_SCALE,
+        "created_at": datetime.utcnow(), "updated_at": datetime.utcnow(), **fields
+    })
+
+
+async def test_completion_takes_stock_and_records_the_sale(app_db):
+    await make_invoice(app_db)
+    await reserve_invoice(app_db, "inv", "main", {"pen": 2})
+
+    await complete_invoice("inv")
+    await server.stock_ledger.flush()
+
+    invoice = await app_db.invoices.find_one({"id": "inv"})
+    pen = await app_db.items.find_one({"id": "pen"})
+    assert invoice["status"] == "completed" and invoice["stock_committed_at"]
+    assert (pen["stock_quantity"], pen["reserved_quantity"]) == (3, 0)
+    assert await app_db.stock_transactions.count_documents({"reference_id": "MAI-000001"}) == 1
+
+
+async def test_recovery_finishes_a_completion_whose_stock_was_taken(app_db):
+    await make_invoice(app_db, status="completing", completing_at=LONG_AGO, stock_committed_at=LONG_AGO)
+    # The interrupted completion already queued its ledger entries
+    await server.record_invoice_stock_out(await app_db.invoices.find_one({"id": "inv"}, {"_id": 0}))
+
+    assert await recover_completions() == {"completed": 1, "reopened": 0}
+    await server.stock_ledger.flush()
+
+    invoice = await app_db.invoices.find_one({"id": "inv"})
+    assert invoice["status"] == "completed"
+    assert invoice["items"][0]["cost_price"] == 60
+    assert await app_db.stock_transactions.count_documents({"reference_id": "MAI-000001"}) == 1
+    assert (await app_db.items.find_one({"id": "pen"}))["stock_quantity"] == 5
+
+
+async def test_recovery_reopens_a_completion_that_never_took_stock(app_db):
+    await make_invoice(app_db, status="completing", completing_at=LONG_AGO)
+
+    assert await recover_completions() == {"completed": 0, "reopened": 1}
+
+    invoice = await app_db.invoices.find_one({"id": "inv"})
+    assert invoice["status"] == "ongoing"
+    assert (await app_db.items.find_one({"id": "pen"}))["reserved_quantity"] == 2
+
+
+async def test_recovery_leaves_completions_in_progress_alone(app_db):
+    await make_invoice(app_db, status="completing", completing_at=datetime.utcnow() - timedelta(seconds=5))
+
+    assert await recover_completions(timeout_seconds=60) == {"completed": 0, "reopened": 0}
+    assert (await app_db.invoices.find_one({"id": "inv"}))["status"] == "completing"
+
+
+async def test_update_of_an_invoice_completed_meanwhile_gives_back_its_reservations(app_db, monkeypatch):
+    await make_invoice(app_db)
+    stale = await app_db.invoices.find_one({"id": "inv"}, {"_id": 0})
+    await app_db.invoices.update_one({"id": "inv"}, {"$set": {"status": "completing"}})
+
+    async def read_before_completion(invoice_id):
+        return stale
+
+    monkeypatch.setattr(server.repositories.invoices, "get", read_before_completion)
+    with pytest.raises(HTTPException) as raised:
+        await update_ongoing_invoice("inv", InvoiceUpdate(items=[{"item_id": "pen", "quantity": 3}]))
+
+    assert raised.value.status_code == 409
+    assert (await app_db.items.find_one({"id": "pen"}))["reserved_quantity"] == 0
+    assert await app_db.stock_reservations.count_documents({}) == 0
@@ -0,0 +1,79 @@
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+
+import archive
+from invoice_search import decode_cursor, encode_cursor, search_invoices, search_keys, search_query
+
+pytestmark = pytest.mark.anyio
+
+NOON = datetime(2024, 5, 1, 12)
+
+
+@pytest.fixture(autouse=True)
+def fresh_partitions():
+    # Known partitions are cached per tenant; every test gets a new database
+    archive._known_partitions.clear()
+
+
+def invoice(invoice_id, created_at, name="Asha Rao", phone="98450 12345", total=1000):
+    return {"id": invoice_id, "invoice_number": f"MAI-{invoice_id}", "branch_id": "main", "status": "completed",
+            "customer_name": name, "customer_phone": phone, **search_keys(name, phone),
+            "final_total": total, "money_scale": 100, "created_at": created_at}
+
+
+async def pages(db, limit, **filters):
+    found, after = [], ""
+    while True:
+        page = await search_invoices(db, search_query(after=after, **filters), None, None, limit)
+        found.append([result["id"] for result in page["invoices"]])
+        if not page["next"]:
+            return found
+        after = page["next"]
+
+
+def test_cursor_round_trips_to_the_millisecond():
+    created_at = datetime(2024, 5, 1, 12, 30, 15, 123000)
+
+    assert decode_cursor(encode_cursor({"created_at": created_at, "id": "a.b"})) == (created_at, "a.b")
+
+
+@pytest.mark.parametrize("token", ["", "abc", "123", "-5.x", "1e3.x"])
+def test_malformed_cursors_are_rejected(token):
+    with pytest.raises(HTTPException) as raised:
+        decode_cursor(token)
+    assert raised.value.status_code == 400
+
+
+async def test_pages_cover_every_invoice_once_across_equal_timestamps(db):
+    # Three invoices share a timestamp, so the page boundary falls among them
+    await db.invoices.insert_many([
+        invoice("1", NOON - timedelta(hours=1)),
+        invoice("2", NOON), invoice("3", NOON), invoice("4", NOON),
+        invoice("5", NOON + timedelta(hours=1)),
+    ])
+
+    assert await pages(db, limit=2) == [["5", "4"], ["3", "2"], ["1"]]
+
+
+async def test_pages_merge_the_archive_newest_first(db):
+    await db.invoices.insert_many([invoice("hot-1", NOON), invoice("hot-2", NOON - timedelta(days=1))])
+    await db[archive.partition_name(datetime(2023, 1, 1))].insert_many([
+        invoice("old-1", datetime(2023, 6, 1)), invoice("old-2", datetime(2023, 3, 1)),
+    ])
+
+    assert await pages(db, limit=3) == [["hot-1", "hot-2", "old-1"], ["old-2"]]
+
+
+async def test_filters_match_on_normalised_prefixes(db):
+    await db.invoices.insert_many([
+        invoice("1", NOON, name="Asha  Rao", phone="98450-12345"),
+        invoice("2", NOON, name="Ashok Kumar", phone="080 2222 3333", total=50000),
+    ])
+
+    assert await pages(db, limit=10, phone="98450 12") == [["1"]]
+    assert await pages(db, limit=10, name="ASHA r") == [["1"]]
+    assert await pages(db, limit=10, name="ash") == [["2", "1"]]
+    assert await pages(db, limit=10, min_total=100) == [["2"]]
+    assert await pages(db, limit=10, number="mai-2") == [["2"]]
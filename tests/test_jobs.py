@@ -0,0 +1,124 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException, Query
+
+from jobs import JOB_COMPLETED, JOB_FAILED, JOB_QUEUED, PROCESS_ID, Job, JobManager, bind_params
+
+pytestmark = pytest.mark.anyio
+
+
+async def noop(days: int = Query(7, ge=1)):
+    return {"days": days}
+
+
+def manager(db, tmp_path, **settings) -> JobManager:
+    jobs = JobManager(db, tmp_path, **settings)
+    jobs.register("noop", noop)
+    return jobs
+
+
+async def test_schedule_is_claimed_by_one_worker(db, tmp_path):
+    first, second = manager(db, tmp_path), manager(db, tmp_path)
+
+    assert await first.claim_schedule("noop", 3600)
+    assert not await second.claim_schedule("noop", 3600)
+    assert not await first.claim_schedule("noop", 3600)
+
+    schedule = await db.job_schedules.find_one({"_id": "noop"})
+    assert schedule["next_run_at"] > datetime.utcnow() + timedelta(minutes=59)
+
+
+async def test_due_schedule_is_claimed_once(db, tmp_path):
+    first, second = manager(db, tmp_path), manager(db, tmp_path)
+    await db.job_schedules.insert_one({"_id": "noop", "next_run_at": datetime.utcnow() - timedelta(seconds=1)})
+
+    claims = [await first.claim_schedule("noop", 60), await second.claim_schedule("noop", 60)]
+
+    assert claims.count(True) == 1
+
+
+async def test_submit_stores_queued_job(db, tmp_path):
+    jobs = manager(db, tmp_path)
+
+    job = await jobs.submit("noop", {"days": 3})
+
+    stored = await db.jobs.find_one({"id": job.id})
+    assert stored["status"] == JOB_QUEUED
+    assert stored["params"] == {"days": 3}
+
+
+async def test_submit_marks_job_failed_when_queue_fills_meanwhile(db, tmp_path):
+    jobs = manager(db, tmp_path, max_queued=1)
+    await jobs.submit("noop", {})
+    # The queue fills up between the check in submit and the enqueue
+    checks = iter([False])
+    jobs._queue.full = lambda: next(checks, True)
+
+    with pytest.raises(HTTPException) as raised:
+        await jobs.submit("noop", {})
+
+    assert raised.value.status_code == 503
+    assert await db.jobs.count_documents({"status": JOB_QUEUED}) == 1
+    assert await db.jobs.count_documents({"status": JOB_FAILED}) == 1
+
+
+async def test_stop_lets_running_jobs_finish(db, tmp_path):
+    jobs = manager(db, tmp_path, concurrency=1, drain_seconds=5)
+
+    async def report():
+        await asyncio.sleep(0.05)
+        return {"rows": 3}
+
+    jobs.register("report", report)
+    await jobs.start()
+    job = await jobs.submit("report", {})
+    await asyncio.sleep(0.01)
+
+    await jobs.stop()
+
+    stored = await db.jobs.find_one({"id": job.id})
+    assert stored["status"] == JOB_COMPLETED
+    with pytest.raises(HTTPException) as refused:
+        await jobs.submit("noop", {})
+    assert refused.value.status_code == 503
+
+
+async def test_stop_fails_jobs_that_outlast_the_drain(db, tmp_path):
+    jobs = manager(db, tmp_path, concurrency=1, drain_seconds=0.01)
+    release = asyncio.Event()
+
+    async def export():
+        await release.wait()
+
+    jobs.register("export", export)
+    jobs.schedule("export", 3600)
+    await jobs.start()  # the schedule has never run, so it is submitted at once
+    await asyncio.sleep(0.01)
+    running = Job(**await db.jobs.find_one({"kind": "export"}))
+    queued = await jobs.submit("noop", {})
+
+    await jobs.stop()
+
+    for job in (running, queued):
+        stored = await db.jobs.find_one({"id": job.id})
+        assert (stored["status"], stored["error"]) == (JOB_FAILED, "Interrupted by server shutdown")
+    schedule = await db.job_schedules.find_one({"_id": "export"})
+    assert schedule["claimed_by"] == PROCESS_ID
+    assert schedule["next_run_at"] <= datetime.utcnow()
+
+
+def test_bind_params_uses_query_defaults():
+    assert bind_params(noop, {}) == {"days": 7}
+    assert bind_params(noop, {"days": "5"}) == {"days": 5}
+
+
+def test_bind_params_rejects_unknown_and_invalid():
+    with pytest.raises(HTTPException) as unknown:
+        bind_params(noop, {"weeks": 1})
+    assert unknown.value.status_code == 422
+
+    with pytest.raises(HTTPException) as invalid:
+        bind_params(noop, {"days": "many"})
+    assert invalid.value.status_code == 422
@@ -0,0 +1,102 @@
+import json
+from datetime import datetime
+
+import pytest
+
+from ledger import StockLedger
+from repositories import MongoStockTransactions
+
+pytestmark = pytest.mark.anyio
+
+
+def entry(entry_id, quantity=1):
+    return {"id": entry_id, "item_id": "pen", "transaction_type": "OUT", "quantity": quantity,
+            "reference_type": "INVOICE", "reference_id": "MAI-000001", "created_at": datetime(2024, 5, 1, 12)}
+
+
+def write_segment(path, entries, tail=""):
+    with open(path, "w") as segment:
+        for line in entries:
+            segment.write(json.dumps({"tenant": None, "entry": {**line, "created_at": line["created_at"].isoformat()}}) + "\n")
+        segment.write(tail)
+
+
+@pytest.fixture
+async def transactions(db):
+    await db.stock_transactions.create_index("id", unique=True)
+    return MongoStockTransactions(db)
+
+
+async def stored_ids(db):
+    return sorted(document["id"] for document in await db.stock_transactions.find().to_list(None))
+
+
+async def test_replay_skips_entries_already_stored(db, transactions, tmp_path):
+    await transactions.insert_many([entry("a")])
+    write_segment(tmp_path / "ledger-999-1.jsonl", [entry("a"), entry("b"), entry("c")])
+
+    replayed = await StockLedger(transactions, tmp_path, fsync=False).replay()
+
+    assert replayed == 3
+    assert await stored_ids(db) == ["a", "b", "c"]
+    assert not list(tmp_path.glob("ledger-*.jsonl"))
+
+
+async def test_replaying_a_segment_twice_stores_each_entry_once(db, transactions, tmp_path):
+    write_segment(tmp_path / "ledger-999-1.jsonl", [entry("a"), entry("b")])
+    write_segment(tmp_path / "ledger-999-2.jsonl", [entry("b"), entry("c")])
+
+    await StockLedger(transactions, tmp_path, fsync=False).replay()
+
+    assert await stored_ids(db) == ["a", "b", "c"]
+    stored = await db.stock_transactions.find_one({"id": "a"})
+    assert stored["created_at"] == datetime(2024, 5, 1, 12)
+
+
+async def test_replay_stops_at_a_torn_write(db, transactions, tmp_path):
+    write_segment(tmp_path / "ledger-999-1.jsonl", [entry("a")], tail='{"tenant": null, "entry": {"id": "b"')
+
+    assert await StockLedger(transactions, tmp_path, fsync=False).replay() == 1
+    assert await stored_ids(db) == ["a"]
+
+
+async def test_replay_leaves_segments_of_running_processes(db, transactions, tmp_path):
+    running = StockLedger(transactions, tmp_path, fsync=False)
+    await running.start()
+    await running.record([entry("a")])
+
+    assert await StockLedger(transactions, tmp_path, fsync=False).replay() == 0
+    assert len(list(tmp_path.glob("ledger-*.jsonl"))) == 1
+    await running.stop()
+    assert await stored_ids(db) == ["a"]
+
+
+async def test_flush_writes_buffered_entries_and_drops_their_segment(db, transactions, tmp_path):
+    ledger = StockLedger(transactions, tmp_path, flush_seconds=3600, fsync=False)
+    await ledger.start()
+    await ledger.record([entry("a"), entry("b")])
+
+    assert await ledger.flush() == 2
+    assert await stored_ids(db) == ["a", "b"]
+    assert len(list(tmp_path.glob("ledger-*.jsonl"))) == 1  # the fresh, empty segment
+    await ledger.stop()
+    assert not list(tmp_path.glob("ledger-*.jsonl"))
+
+
+async def test_failed_flush_keeps_entries_for_the_next_attempt(db, transactions, tmp_path, monkeypatch):
+    ledger = StockLedger(transactions, tmp_path, flush_seconds=3600, fsync=False)
+    await ledger.start()
+    await ledger.record([entry("a")])
+
+    async def unavailable(documents):
+        raise ConnectionError("no primary")
+
+    monkeypatch.setattr(transactions, "insert_many", unavailable)
+    with pytest.raises(ConnectionError):
+        await ledger.flush()
+    assert ledger.stats()["buffered"] == 1
+    monkeypatch.undo()
+
+    assert await ledger.flush() == 1
+    assert await stored_ids(db) == ["a"]
+    await ledger.stop()
@@ -0,0 +1,72 @@
+from datetime import datetime
+
+import pytest
+
+import archive
+from margins import margin_report, rebuild_margin_rollups, record_invoice_margin, snapshot_line_costs
+from money import MONEY_SCALE
+
+pytestmark = pytest.mark.anyio
+
+MAY_FIRST = datetime(2024, 5, 1, 15)
+
+
+@pytest.fixture(autouse=True)
+def fresh_partitions():
+    # Known partitions are cached per tenant; every test gets a new database
+    archive._known_partitions.clear()
+
+
+def line(item_id, quantity, unit_price, **snapshot):
+    return {"item_id": item_id, "sku": item_id.upper(), "name": item_id, "quantity": quantity,
+            "unit_price": unit_price, "line_total": quantity * unit_price, **snapshot}
+
+
+async def catalogue(db):
+    await db.items.insert_many([
+        {"id": "pen", "cost_price": 60, "category": "Stationery", "brand": "Acme", "money_scale": MONEY_SCALE},
+        {"id": "ink", "cost_price": 200, "category": "Stationery", "brand": "Inko", "money_scale": MONEY_SCALE},
+    ])
+
+
+async def test_snapshot_keeps_the_cost_at_the_time_of_sale(db):
+    await catalogue(db)
+
+    lines = await snapshot_line_costs(db, [line("pen", 2, 100), line("gone", 1, 50)])
+
+    assert lines[0] == {**line("pen", 2, 100), "cost_price": 60, "category": "Stationery", "brand": "Acme"}
+    assert lines[1] == line("gone", 1, 50)
+
+
+async def test_report_groups_recorded_sales(db):
+    await catalogue(db)
+    for invoice_id, lines in (("1", [line("pen", 2, 100), line("ink", 1, 300)]), ("2", [line("pen", 3, 100)])):
+        invoice = {"id": invoice_id, "branch_id": "main", "created_at": MAY_FIRST,
+                   "items": await snapshot_line_costs(db, lines)}
+        await record_invoice_margin(db, invoice)
+
+    by_item = await margin_report(db, datetime(2024, 5, 1), datetime(2024, 5, 31), "item")
+    by_brand = await margin_report(db, datetime(2024, 5, 1), datetime(2024, 5, 31), "brand")
+
+    assert (by_item["total_revenue"], by_item["total_cost"], by_item["total_margin"]) == (8.0, 5.0, 3.0)
+    assert [(row["item_id"], row["quantity"], row["margin"]) for row in by_item["breakdown"]] == [
+        ("pen", 5, 2.0), ("ink", 1, 1.0)
+    ]
+    assert {row["brand"]: row["margin_percent"] for row in by_brand["breakdown"]} == {"Acme": 40.0, "Inko": 33.33}
+
+
+async def test_rebuild_matches_recorded_rollups_and_estimates_old_lines(db):
+    await catalogue(db)
+    await db.invoices.insert_many([
+        {"id": "1", "branch_id": "main", "status": "completed", "created_at": MAY_FIRST,
+         "items": await snapshot_line_costs(db, [line("pen", 2, 100)])},
+        # Completed before cost snapshots existed
+        {"id": "2", "branch_id": "main", "status": "completed", "created_at": MAY_FIRST, "items": [line("ink", 1, 300)]},
+        {"id": "3", "branch_id": "main", "status": "ongoing", "created_at": MAY_FIRST, "items": [line("pen", 9, 100)]},
+    ])
+
+    result = await rebuild_margin_rollups(db)
+    report = await margin_report(db, datetime(2024, 5, 1), datetime(2024, 5, 31), "category")
+
+    assert result == {"rollups_written": 2, "estimated_lines": 1}
+    assert (report["total_revenue"], report["total_cost"], report["estimated_lines"]) == (5.0, 3.2, 1)
@@ -0,0 +1,81 @@
+from datetime import datetime
+
+import pytest
+
+from margins import margin_report, record_invoice_margin
+from money import (
+    MIGRATION_ID, MONEY_SCALE, from_minor, invoice_document, invoice_from_document, item_document, migrate_money,
+    stored_minor, to_minor,
+)
+
+pytestmark = pytest.mark.anyio
+
+
+def test_amounts_round_half_up_to_the_minor_unit():
+    assert to_minor(0.1 + 0.2) == 30
+    assert to_minor(2.675) == 268
+    assert to_minor(19.99) == 1999
+    assert from_minor(1999) == 19.99
+
+
+def test_documents_round_trip_in_currency_units():
+    invoice = {"id": "inv", "subtotal": 3.5, "final_total": 3.5,
+               "items": [{"item_id": "pen", "quantity": 2, "unit_price": 1.75, "line_total": 3.5}]}
+
+    stored = invoice_document(invoice)
+
+    assert stored["final_total"] == 350 and stored["items"][0]["unit_price"] == 175
+    assert stored["money_scale"] == MONEY_SCALE
+    assert invoice_from_document(stored) == invoice
+
+
+def test_unmigrated_documents_are_read_as_currency_units():
+    assert stored_minor({"selling_price": 12.5}, "selling_price") == 1250
+    assert stored_minor(item_document({"selling_price": 12.5}), "selling_price") == 1250
+    assert invoice_from_document({"final_total": 12.5}) == {"final_total": 12.5}
+
+
+async def test_migration_converts_each_document_once(db):
+    await db.items.insert_many([
+        {"id": "old", "cost_price": 1.1, "selling_price": 2.2},
+        item_document({"id": "new", "cost_price": 1.1, "selling_price": 2.2}),
+    ])
+    await db.invoices.insert_one({"id": "inv", "subtotal": 2.2, "final_total": 2.2,
+                                  "items": [{"item_id": "old", "quantity": 1, "unit_price": 2.2, "line_total": 2.2}]})
+    await db.invoice_rollups.insert_one({"revenue": 2.2})
+
+    first = await migrate_money(db)
+    second = await migrate_money(db)
+
+    assert (first["items"], first["invoices"], first["invoice_rollups"]) == (1, 1, 1)
+    assert set(second.values()) == {0}
+    items = {item["id"]: item for item in await db.items.find().to_list(None)}
+    assert items["old"]["selling_price"] == items["new"]["selling_price"] == 220
+    invoice = await db.invoices.find_one({"id": "inv"})
+    assert (invoice["final_total"], invoice["items"][0]["line_total"]) == (220, 220)
+    assert (await db.invoice_rollups.find_one())["revenue"] == 220
+
+
+async def test_rollups_written_by_this_version_are_not_rescaled(db):
+    sale = {"id": "inv", "branch_id": "main", "created_at": datetime(2024, 5, 1, 15),
+            "items": [{"item_id": "pen", "sku": "PEN", "name": "pen", "quantity": 1, "unit_price": 10000,
+                       "line_total": 10000, "cost_price": 6000}]}
+    await record_invoice_margin(db, sale)
+
+    await migrate_money(db)
+    await migrate_money(db)
+    report = await margin_report(db, datetime(2024, 5, 1), datetime(2024, 5, 31), "item")
+
+    assert (report["total_revenue"], report["total_cost"]) == (100.0, 60.0)
+
+
+async def test_tenants_are_migrated_before_they_are_served(app_db):
+    import server
+
+    await app_db.items.insert_one({"id": "old", "cost_price": 1.1, "selling_price": 2.2})
+
+    for provisioner in server.tenants._provisioners:
+        await provisioner()
+
+    assert (await app_db.items.find_one({"id": "old"}))["selling_price"] == 220
+    assert await app_db.migrations.find_one({"_id": MIGRATION_ID})
@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from orchestration import gather_queries
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_queries_run_concurrently_up_to_the_limit():
+    running, peak = 0, 0
+
+    async def query(value):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return value
+
+    results = await gather_queries({name: (lambda name=name: query(name)) for name in "abcde"}, limit=2)
+
+    assert results == {name: name for name in "abcde"}
+    assert peak == 2
+
+
+async def test_a_slow_query_times_out_with_504():
+    async def slow():
+        await asyncio.sleep(1)
+
+    async def fast():
+        return 1
+
+    with pytest.raises(HTTPException) as raised:
+        await gather_queries({"fast": fast, "slow": slow}, timeout=0.01)
+
+    assert raised.value.status_code == 504
+    assert "'slow'" in raised.value.detail
+
+
+async def test_a_failing_query_cancels_the_others():
+    cancelled = asyncio.Event()
+
+    async def failing():
+        raise ValueError("bad pipeline")
+
+    async def waiting():
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    with pytest.raises(ValueError):
+        await gather_queries({"failing": failing, "waiting": waiting})
+
+    assert cancelled.is_set()
@@ -0,0 +1,81 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+
+from outbox import EventFeed, event, parse_token
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_events_are_read_in_order_from_a_token(db):
+    feed = EventFeed()
+    await feed.publish(db, [event("item.created", "pen"), event("stock.changed", "pen", delta=-2)])
+    await feed.publish(db, [event("item.updated", "pen", name="Blue pen")])
+
+    events, next_token = await feed.read(db, 0, 10)
+    later, last_token = await feed.read(db, 1, 10)
+
+    assert [(found["seq"], found["type"]) for found in events] == [
+        (1, "item.created"), (2, "stock.changed"), (3, "item.updated")
+    ]
+    assert events[1]["data"] == {"delta": -2}
+    assert next_token == 3
+    assert [found["seq"] for found in later] == [2, 3] and last_token == 3
+
+
+async def test_reading_stops_at_a_gap_still_being_written(db):
+    feed = EventFeed()
+    await feed.publish(db, [event("item.created", "pen")])
+    # Sequence 2 is allocated but its writer has not inserted it yet
+    await db.event_sequence.update_one({"_id": "events"}, {"$inc": {"seq": 1}})
+    await feed.publish(db, [event("item.created", "ink")])
+
+    events, next_token = await feed.read(db, 0, 10)
+
+    assert [found["seq"] for found in events] == [1] and next_token == 1
+
+
+async def test_an_old_gap_is_skipped(db):
+    feed = EventFeed()
+    await feed.publish(db, [event("item.created", "pen")])
+    await db.event_sequence.update_one({"_id": "events"}, {"$inc": {"seq": 1}})
+    await feed.publish(db, [event("item.created", "ink")])
+    await db.events.update_many({}, {"$set": {"created_at": datetime.utcnow() - timedelta(minutes=1)}})
+
+    events, next_token = await feed.read(db, 1, 10)
+
+    assert [found["seq"] for found in events] == [3] and next_token == 3
+
+
+async def test_tokens_past_the_retention_window_are_refused(db):
+    feed = EventFeed()
+    await feed.publish(db, [event("item.created", item_id) for item_id in ("a", "b", "c")])
+    await db.events.delete_many({"seq": {"$lte": 2}})  # expired
+
+    with pytest.raises(HTTPException) as expired:
+        await feed.read(db, 1, 10)
+    with pytest.raises(HTTPException) as ahead:
+        await feed.read(db, 9, 10)
+
+    assert expired.value.status_code == 410
+    assert ahead.value.status_code == 400
+
+
+async def test_waiting_readers_wake_on_publish(db):
+    feed = EventFeed()
+    waiting = asyncio.create_task(feed.wait(db, 0, 10, timeout=5))
+    await asyncio.sleep(0.01)
+
+    await feed.publish(db, [event("invoice.completed", "inv")])
+    events, _ = await asyncio.wait_for(waiting, 1)
+
+    assert [found["entity_id"] for found in events] == ["inv"]
+
+
+def test_tokens_must_be_numbers():
+    assert parse_token("") == 0
+    assert parse_token("42") == 42
+    with pytest.raises(HTTPException):
+        parse_token("-1")
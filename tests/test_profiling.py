@@ -0,0 +1,90 @@
+import asyncio
+
+import pytest
+
+from profiling import Profiler, ProfilingMiddleware, current_profile, span, traced
+
+pytestmark = pytest.mark.anyio
+
+
+class Repository:
+    async def get(self, item_id):
+        await asyncio.sleep(0)
+        return {"id": item_id}
+
+    def name(self):
+        return "items"
+
+
+async def call(middleware, headers=()):
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b""}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {"type": "http", "method": "GET", "path": "/api/items/pen", "headers": list(headers)}
+    await middleware(scope, receive, send)
+    return dict(messages[0].get("headers", []))
+
+
+def handler(body):
+    async def app(scope, receive, send):
+        await body()
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"{}"})
+    return app
+
+
+async def test_spans_are_free_outside_profiled_requests():
+    with span("unprofiled"):
+        pass
+
+    assert current_profile.get() is None
+
+
+async def test_profiled_requests_report_span_timings():
+    profiler = Profiler(on_header=True)
+    repository = traced(Repository(), "items")
+
+    async def body():
+        assert repository.name() == "items"
+        await repository.get("pen")
+        with span("render"):
+            await asyncio.sleep(0.01)
+
+    headers = await call(ProfilingMiddleware(handler(body), profiler), [(b"x-profile", b"1")])
+    profile = profiler.find(headers[b"x-profile-id"].decode())
+
+    assert [recorded["name"] for recorded in profile.spans] == ["items.get", "render"]
+    assert profile.status == 200 and profile.task is None
+    assert b'desc="items.get"' in headers[b"server-timing"]
+    assert b'desc="render"' in headers[b"server-timing"]
+
+
+async def test_requests_without_the_header_are_not_profiled():
+    profiler = Profiler(on_header=True)
+
+    headers = await call(ProfilingMiddleware(handler(lambda: asyncio.sleep(0)), profiler))
+
+    assert b"server-timing" not in headers
+    assert not profiler.profiles
+
+
+async def test_waiting_requests_show_up_in_the_flamegraph():
+    profiler = Profiler(sample_rate=1.0, interval_ms=1)
+
+    async def body():
+        await asyncio.sleep(0.05)
+
+    await call(ProfilingMiddleware(handler(body), profiler))
+    profile = profiler.profiles[0]
+    collapsed = profiler.flamegraph("wait").splitlines()
+
+    assert profile.wait_samples > 0
+    assert collapsed and all(line.startswith("GET /api/items/pen;") for line in collapsed)
+    # Suspended samples run from the handler down to what the sleep awaits
+    assert any("<locals>.body (" in line and ";sleep (" in line and ";[await " in line for line in collapsed)
+    assert profiler.flamegraph("wall", route="/other") == ""
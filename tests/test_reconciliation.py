@@ -0,0 +1,95 @@
+from datetime import datetime, timedelta
+
+import pytest
+from bson import ObjectId
+
+from reconciliation import STATE_ID, reconcile_stock, stock_discrepancies
+
+pytestmark = pytest.mark.anyio
+
+LONG_AGO = datetime(2020, 1, 1)
+
+
+async def sale(db, item_id, quantity, minutes_ago):
+    written = datetime.utcnow() - timedelta(minutes=minutes_ago)
+    await db.stock_transactions.insert_one({
+        "_id": ObjectId.from_datetime(written), "item_id": item_id, "transaction_type": "OUT",
+        "quantity": quantity, "created_at": written,
+    })
+    await db.items.update_one({"id": item_id}, {"$inc": {"stock_quantity": -quantity}})
+
+
+@pytest.fixture
+async def items(db):
+    await db.items.insert_many([
+        {"id": "pen", "sku": "PEN", "name": "Pen", "stock_quantity": 10, "updated_at": LONG_AGO},
+        {"id": "ink", "sku": "INK", "name": "Ink", "stock_quantity": 5, "updated_at": LONG_AGO},
+    ])
+    return db
+
+
+async def test_first_run_checkpoints_every_item(items):
+    result = await reconcile_stock(items, settle_seconds=60)
+
+    assert (result["checkpointed"], result["mismatches"]) == (2, 0)
+    assert (await items.stock_checkpoints.find_one({"item_id": "pen"}))["expected"] == 10
+
+
+async def test_sales_recorded_in_the_ledger_agree(items):
+    await reconcile_stock(items, settle_seconds=600)
+    await sale(items, "pen", 3, minutes_ago=5)
+    await sale(items, "pen", 1, minutes_ago=3)
+
+    result = await reconcile_stock(items, settle_seconds=60, full=True)
+
+    assert (result["entries"], result["mismatches"]) == (2, 0)
+    assert (await items.stock_checkpoints.find_one({"item_id": "pen"}))["expected"] == 6
+
+
+async def test_entries_still_settling_count_as_pending(items):
+    await reconcile_stock(items, settle_seconds=60)
+    await sale(items, "pen", 2, minutes_ago=0)
+
+    result = await reconcile_stock(items, settle_seconds=60, full=True)
+
+    assert (result["entries"], result["mismatches"]) == (0, 0)
+
+
+async def test_stock_changed_outside_the_ledger_is_flagged_and_adjusted(items):
+    await reconcile_stock(items, settle_seconds=60)
+    await items.items.update_one({"id": "ink"}, {"$set": {"stock_quantity": 7}})
+
+    flagged = await reconcile_stock(items, settle_seconds=60, full=True)
+    assert flagged["discrepancies"][0]["difference"] == 2
+    assert [found["item_id"] for found in await stock_discrepancies(items)] == ["ink"]
+
+    adjusted = await reconcile_stock(items, settle_seconds=0, full=True, adjust=True)
+    settled = await reconcile_stock(items, settle_seconds=0, full=True)
+
+    assert adjusted["adjusted"] == 1
+    assert settled["mismatches"] == 0
+    assert (await items.stock_checkpoints.find_one({"item_id": "ink"}))["status"] == "ok"
+
+
+async def test_run_is_skipped_while_another_holds_the_lease(items):
+    await items.stock_reconciliation.insert_one(
+        {"_id": STATE_ID, "lease_owner": "other", "lease_until": datetime.utcnow() + timedelta(minutes=5)}
+    )
+
+    result = await reconcile_stock(items, settle_seconds=60)
+
+    assert result["skipped"]
+    assert await items.stock_checkpoints.count_documents({}) == 0
+
+
+async def test_expired_lease_is_taken_over_and_released_after_the_run(items):
+    await items.stock_reconciliation.insert_one(
+        {"_id": STATE_ID, "lease_owner": "crashed", "lease_until": datetime.utcnow() - timedelta(minutes=1)}
+    )
+
+    result = await reconcile_stock(items, settle_seconds=60)
+
+    state = await items.stock_reconciliation.find_one({"_id": STATE_ID})
+    assert result["checkpointed"] == 2
+    assert state["lease_owner"] == result["run_id"] and state["lease_until"] is None
+    assert (await reconcile_stock(items, settle_seconds=60)).get("skipped") is None
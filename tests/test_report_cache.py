@@ -0,0 +1,69 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from report_cache import ReportCache
+
+pytestmark = pytest.mark.anyio
+
+LAST_WEEK = datetime.utcnow() - timedelta(days=7)
+
+
+def cached_range(cache: ReportCache, version: int, end: datetime = LAST_WEEK, branch_id: str = "") -> str:
+    key = ReportCache.key("sales", end=end, branch_id=branch_id)
+    cache.put(key, {"total": 1}, "sales", end - timedelta(days=1), end, version, branch_id=branch_id)
+    return key
+
+
+async def test_past_range_is_cached(db):
+    cache = ReportCache()
+    key = cached_range(cache, await cache.sync(db))
+
+    assert cache.get(key) == {"total": 1}
+
+
+async def test_range_reaching_today_is_not_cached(db):
+    cache = ReportCache()
+    key = cached_range(cache, await cache.sync(db), end=datetime.utcnow() + timedelta(hours=1))
+
+    assert cache.get(key) is None
+
+
+async def test_bump_in_one_process_invalidates_the_others(db):
+    worker, other = ReportCache(), ReportCache()
+    key = cached_range(worker, await worker.sync(db))
+
+    await other.invalidate(db, "main", LAST_WEEK - timedelta(hours=1))
+    await worker.sync(db)
+
+    assert worker.get(key) is None
+
+
+async def test_sale_today_does_not_invalidate_past_ranges(db):
+    worker, other = ReportCache(), ReportCache()
+    key = cached_range(worker, await worker.sync(db))
+
+    await other.invalidate(db, "main", datetime.utcnow())
+    await worker.sync(db)
+
+    assert worker.get(key) == {"total": 1}
+
+
+async def test_nothing_is_cached_right_after_a_bump(db):
+    cache = ReportCache(settle_seconds=60)
+    await cache.bump(db)
+
+    key = cached_range(cache, await cache.sync(db))
+
+    assert cache.get(key) is None
+
+
+async def test_result_computed_before_a_bump_is_not_cached(db):
+    cache = ReportCache(settle_seconds=0)
+    version = await cache.sync(db)
+    await ReportCache().bump(db)
+    await cache.sync(db)
+
+    key = cached_range(cache, version)
+
+    assert cache.get(key) is None
@@ -0,0 +1,60 @@
+from datetime import datetime
+
+import pytest
+
+from repositories import MongoRepositories
+from sqlite_repositories import SqliteRepositories
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture(params=["mongo", "sqlite"])
+async def repositories(request, db, tmp_path):
+    if request.param == "mongo":
+        yield MongoRepositories(db)
+        return
+    repositories = SqliteRepositories(tmp_path / "inventory.sqlite3", synchronous="OFF")
+    yield repositories
+    await repositories.close()
+
+
+def invoice(invoice_id, status="ongoing"):
+    return {"id": invoice_id, "invoice_number": f"MAI-{invoice_id}", "branch_id": "main", "status": status,
+            "items": [], "subtotal": 0, "final_total": 0, "created_at": datetime(2024, 5, 1, 12)}
+
+
+async def test_invoice_update_is_guarded_on_status(repositories):
+    await repositories.invoices.insert(invoice("1"))
+
+    assert await repositories.invoices.update("1", {"status": "completing"}, status="ongoing")
+    assert not await repositories.invoices.update("1", {"status": "completing"}, status="ongoing")
+    assert (await repositories.invoices.get("1"))["status"] == "completing"
+
+
+async def test_invoice_delete_is_guarded_on_status(repositories):
+    await repositories.invoices.insert(invoice("1", status="completing"))
+    await repositories.invoices.insert(invoice("2"))
+
+    assert not await repositories.invoices.delete("1", status="ongoing")
+    assert await repositories.invoices.delete("2", status="ongoing")
+    assert await repositories.invoices.get("1") is not None
+    assert await repositories.invoices.get("2") is None
+    assert await repositories.invoices.delete("1")
+
+
+async def test_invoices_are_counted_and_listed_by_status(repositories):
+    await repositories.invoices.insert(invoice("1"))
+    await repositories.invoices.insert(invoice("2", status="completed"))
+
+    assert await repositories.invoices.count() == 2
+    assert await repositories.invoices.count(status="ongoing", branch_id="main") == 1
+    assert [found["id"] for found in await repositories.invoices.list(status="completed")] == ["2"]
+
+
+async def test_low_stock_items_are_listed_and_counted(repositories):
+    for item_id, stock_quantity in (("pen", 2), ("ink", 5), ("pad", 9)):
+        await repositories.items.insert({"id": item_id, "sku": item_id.upper(), "name": item_id,
+                                         "stock_quantity": stock_quantity, "min_stock": 5})
+
+    assert sorted(item["id"] for item in await repositories.items.low_stock()) == ["ink", "pen"]
+    assert await repositories.items.count_low_stock() == 2
@@ -0,0 +1,105 @@
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+
+from reservations import (
+    commit_stock, rebuild_reserved_quantities, release_reservations, reserve_invoice, set_reservation,
+    sweep_expired_reservations,
+)
+
+pytestmark = pytest.mark.anyio
+
+LONG_AGO = datetime(2020, 1, 1)
+
+
+async def item(db, item_id):
+    return await db.items.find_one({"id": item_id})
+
+
+async def stock(db, **quantities):
+    await db.items.insert_many([
+        {"id": item_id, "name": item_id, "stock_quantity": quantity, "reserved_quantity": 0, "updated_at": LONG_AGO}
+        for item_id, quantity in quantities.items()
+    ])
+
+
+async def test_reservations_count_against_other_invoices(db):
+    await stock(db, pen=5)
+    await set_reservation(db, "a", "main", "pen", 3)
+
+    with pytest.raises(HTTPException) as raised:
+        await set_reservation(db, "b", "main", "pen", 3)
+
+    assert raised.value.status_code == 400
+    assert "Available: 2" in raised.value.detail
+    assert (await item(db, "pen"))["reserved_quantity"] == 3
+
+
+async def test_reservation_changes_move_updated_at(db):
+    await stock(db, pen=5)
+
+    await set_reservation(db, "a", "main", "pen", 2)
+    reserved = await item(db, "pen")
+    await db.items.update_one({"id": "pen"}, {"$set": {"updated_at": LONG_AGO}})
+    await release_reservations(db, "a")
+    released = await item(db, "pen")
+
+    assert reserved["reserved_quantity"] == 2 and reserved["updated_at"] > LONG_AGO
+    assert released["reserved_quantity"] == 0 and released["updated_at"] > LONG_AGO
+
+
+async def test_sweep_releases_expired_reservations(db):
+    await stock(db, pen=5)
+    await set_reservation(db, "a", "main", "pen", 2, expires_at=datetime.utcnow() - timedelta(minutes=1))
+    await set_reservation(db, "b", "main", "pen", 1)
+
+    assert await sweep_expired_reservations(db) == 1
+    assert (await item(db, "pen"))["reserved_quantity"] == 1
+
+
+async def test_reserve_invoice_is_all_or_nothing(db):
+    await stock(db, pen=5, ink=1)
+    await reserve_invoice(db, "a", "main", {"pen": 2})
+
+    with pytest.raises(HTTPException):
+        await reserve_invoice(db, "a", "main", {"pen": 4, "ink": 2})
+
+    assert (await item(db, "pen"))["reserved_quantity"] == 2
+    assert (await item(db, "ink"))["reserved_quantity"] == 0
+    assert await db.stock_reservations.count_documents({"invoice_id": "a"}) == 1
+
+
+async def test_commit_stock_puts_back_what_it_took_when_an_item_is_short(db):
+    await stock(db, pen=5, ink=1)
+    await reserve_invoice(db, "a", "main", {"pen": 2})
+    await set_reservation(db, "b", "main", "ink", 1)
+
+    with pytest.raises(HTTPException):
+        await commit_stock(db, "a", {"pen": 2, "ink": 1})
+
+    pen = await item(db, "pen")
+    assert (pen["stock_quantity"], pen["reserved_quantity"]) == (5, 2)
+    assert await db.stock_reservations.count_documents({"invoice_id": "a"}) == 1
+
+
+async def test_commit_stock_consumes_the_reservation(db):
+    await stock(db, pen=5)
+    await reserve_invoice(db, "a", "main", {"pen": 2})
+
+    await commit_stock(db, "a", {"pen": 2})
+
+    pen = await item(db, "pen")
+    assert (pen["stock_quantity"], pen["reserved_quantity"]) == (3, 0)
+    assert await db.stock_reservations.count_documents({}) == 0
+
+
+async def test_rebuild_recomputes_drifted_counters(db):
+    await stock(db, pen=5, ink=5)
+    await set_reservation(db, "a", "main", "pen", 2)
+    await db.items.update_one({"id": "ink"}, {"$set": {"reserved_quantity": 4}})
+
+    await rebuild_reserved_quantities(db)
+
+    assert (await item(db, "pen"))["reserved_quantity"] == 2
+    assert (await item(db, "ink"))["reserved_quantity"] == 0
@@ -0,0 +1,34 @@
+import subprocess
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+from fastapi import Response
+
+pytestmark = pytest.mark.anyio
+
+BACKEND = Path(__file__).resolve().parent.parent / "backend"
+
+
+def test_importing_the_server_defers_heavy_dependencies():
+    heavy = ("pandas", "pyarrow", "numpy", "msgpack", "brotli")
+    script = f"import sys, server; print(','.join(m for m in {heavy!r} if m in sys.modules))"
+
+    loaded = subprocess.run([sys.executable, "-c", script], cwd=BACKEND, capture_output=True, text=True, check=True,
+                            env={"MONGO_URL": "mongodb://localhost:27017", "DB_NAME": "inventory"})
+
+    assert loaded.stdout.strip() == ""
+
+
+async def test_readiness_waits_for_startup(app_db):
+    import server
+
+    request = SimpleNamespace(app=SimpleNamespace(state=SimpleNamespace(ready=False)))
+    before, after = Response(), Response()
+    starting = await server.readiness(request, before)
+    request.app.state.ready = True
+    ready = await server.readiness(request, after)
+
+    assert (starting, before.status_code) == ({"status": "starting"}, 503)
+    assert (ready, after.status_code) == ({"status": "ready"}, 200)
@@ -0,0 +1,68 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from database import Database, DatabaseSettings, Tenant, current_tenant
+from tenants import TenantRegistry
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def registry(db):
+    database = Database(DatabaseSettings(mongo_url="", db_name=db.name))
+    database.client = db.client
+    registry = TenantRegistry(database)
+    yield registry
+    for tenant in registry._tenants.values():
+        await db.client.drop_database(tenant.db_name)
+
+
+async def test_slow_provisioning_does_not_block_other_tenants(registry):
+    release = asyncio.Event()
+
+    @registry.on_provision
+    async def provision():
+        if current_tenant.get().id == "slow":
+            await release.wait()
+
+    async def serve(tenant):
+        async with registry.scope(tenant):
+            return tenant.id
+
+    slow = asyncio.create_task(serve(Tenant("slow", "inventory_slow")))
+    await asyncio.sleep(0)
+    served = await asyncio.wait_for(serve(Tenant("fast", "inventory_fast")), timeout=1)
+    release.set()
+
+    assert served == "fast"
+    assert await slow == "slow"
+
+
+async def test_register_maps_tenant_once(registry, db):
+    tenant = await registry.register("acme", f"{db.name}_acme")
+
+    assert await registry.register("acme", f"{db.name}_acme") == tenant
+    assert await registry.lookup("acme") == tenant
+
+
+@pytest.mark.parametrize("db_name, status_code", [
+    ("bad/name", 400),
+    ("admin", 400),
+    ("x" * 64, 400),
+])
+async def test_register_rejects_invalid_database_names(registry, db_name, status_code):
+    with pytest.raises(HTTPException) as raised:
+        await registry.register("acme", db_name)
+
+    assert raised.value.status_code == status_code
+
+
+async def test_register_rejects_databases_in_use(registry, db):
+    await registry.register("acme", f"{db.name}_acme")
+
+    for tenant_id, db_name in [("other", db.name), ("other", f"{db.name}_acme"), ("acme", f"{db.name}_moved")]:
+        with pytest.raises(HTTPException) as raised:
+            await registry.register(tenant_id, db_name)
+        assert raised.value.status_code == 409